@@ -4,6 +4,8 @@ import argparse
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--platform", help="the platform to build for", choices=["windows", "macos"], required=True)
+parser.add_argument("--onedir", action="store_true",
+                    help="build a folder instead of a single file, which launches faster since nothing is unpacked on each start")
 args = parser.parse_args()
 script_dir = os.path.dirname(os.path.realpath(__file__))
 icon_path = os.path.join(script_dir, 'icon.ico')
@@ -15,10 +17,11 @@ dist_dir = os.path.join(work_dir, 'dist/')
 os.makedirs(dist_dir, exist_ok=True)
 
 # Build the application using PyInstaller
-if args.platform == "windows":
-    command = f'pyinstaller --onefile --add-data "{icon_path};." --windowed --name candlecleaner --icon "{icon_path}" --distpath "{dist_dir}" --workpath "{build_dir}" --specpath "{build_dir}" {main_script_path}'
-else:
-    command = f'pyinstaller --onefile --add-data "{icon_path}:." --windowed --name candlecleaner --icon "{icon_path}" --distpath "{dist_dir}" --workpath "{build_dir}" --specpath "{build_dir}" {main_script_path}'
-    
+separator = ";" if args.platform == "windows" else ":"
+# A single file unpacks itself to a temporary folder on every launch, a folder build starts from
+# its files directly, and skipping UPX saves decompressing the libraries on load
+bundle = '--onedir --noupx' if args.onedir else '--onefile'
+command = f'pyinstaller {bundle} --add-data "{icon_path}{separator}." --windowed --name candlecleaner --icon "{icon_path}" --distpath "{dist_dir}" --workpath "{build_dir}" --specpath "{build_dir}" {main_script_path}'
+
 print(command)
 subprocess.run(command, shell=True)
@@ -12,19 +12,156 @@
 #
 ###################################################################################################
 
+import time
+
+# Taken before anything else is imported, the time to first window is measured from here
+LAUNCHED = time.perf_counter()
+
 import os
-import re
-import webbrowser
+import queue
+import sys
+import threading
+from collections import namedtuple
+from cleanerengine import (data_directory, CleanerOptions, ScanRules, ScanEntry, ScannedDirectory, Snapshot, iter_scan, scan_directory, refresh_directories, plan_directory,
+                          make_plan, update_regex_index, build_plan, StageCache, compile_pattern, PatternError, PatternWorker)
+from cleanersearch import NameIndex, filter_plan
+from cleanerstats import Stats, count_scan, profile_path, profiled
+
+# Command line use prints or applies the plan without starting Tk or loading Pillow. Modules the
+# window only needs once a directory is scanned, renamed or watched are imported where they are
+# used, and Pillow once the window is on screen, so it opens as early as possible
+if __name__ == '__main__' and len(sys.argv) > 1:
+    # Lets the worker processes of batch start from a frozen build
+    import multiprocessing
+    multiprocessing.freeze_support()
+    from cleanercli import main
+    sys.exit(main())
+
 try:
     import tkinter as tk
     from tkinter import *
     from tkinter import filedialog, messagebox, ttk
-    from PIL.Image import open as popen
-    from PIL.ImageTk import PhotoImage
 except ImportError:
     print("Tkinter is not installed. Please install it before running this script.")
     exit()
 
+# How long typing has to pause before the preview is recomputed
+PREVIEW_DELAY_MS = 250
+
+# Seconds a preview may spend matching a regex typed into the text to replace field before it is
+# given up on and the names are shown unchanged
+PATTERN_BUDGET = 1.0
+
+# How often the Tk thread picks up scan results, and for how long it may insert rows each time
+SCAN_POLL_MS = 50
+SCAN_POLL_BUDGET = 0.03
+
+# Files and folders the scan worker collects before handing a batch to the Tk thread
+SCAN_BATCH_SIZE = 500
+
+# How often the rename progress is refreshed
+RENAME_POLL_MS = 100
+
+# How often changes found by the directory watcher are applied to the preview
+WATCH_POLL_MS = 500
+
+# Files listed at a time when a folder is opened with Lazy Folders enabled
+VIRTUAL_PAGE_SIZE = 1000
+LOADING_TEXT = "Loading..."
+
+# The item IDs of a folder's node in both trees
+FolderRows = namedtuple('FolderRows', ['file_tree', 'updated_file_tree'])
+
+class ScanWorker(threading.Thread):
+    # Walks a directory off the Tk thread and hands the directories back in batches through a queue,
+    # a None batch marks the end of the scan. Unchanged directories come from the scan cache, which
+    # is only saved when the scan ran to the end. When the scan service is running the directories
+    # come from it instead, verify has it restat every folder first, after files were renamed here.
+    # With prefixes, for smart cleaning, the prefixes of the folders are worked out here too
+    def __init__(self, directory_path, use_cache=True, stats=None, profile_path=None, rules=None, verify=False, prefixes=False):
+        super().__init__(daemon=True)
+        self.directory_path = directory_path
+        self.use_cache = use_cache
+        self.rules = rules
+        self.verify = verify
+        self.prefixes = prefixes
+        self.stats = stats or Stats("scan")
+        self.profile_path = profile_path
+        self.cache = None
+        self.cancel = threading.Event()
+        self.batches = queue.Queue()
+
+    def run(self):
+        try:
+            with profiled(self.profile_path):
+                if self.scan_with_daemon():
+                    return
+                with self.stats.phase("cache_load"):
+                    from cleanercache import ScanCache
+                    if self.use_cache:
+                        self.cache = ScanCache.load(self.directory_path, self.rules)
+                    else:
+                        self.cache = ScanCache(self.directory_path, rules=self.rules)
+                with self.stats.phase("walk"):
+                    self.put_batches(iter_scan(self.directory_path, self.cancel, self.cache, self.rules))
+                if not self.cancel.is_set():
+                    if self.prefixes:
+                        with self.stats.phase("prefixes"):
+                            self.cache.prefixes()
+                    with self.stats.phase("cache_save"):
+                        self.cache.save()
+        finally:
+            self.batches.put(None)
+
+    def put_batches(self, directories):
+        batch = []
+        batch_size = 0
+        for directory in directories:
+            batch.append(directory)
+            batch_size += len(directory.files) + 1
+            if batch_size >= SCAN_BATCH_SIZE:
+                self.batches.put(batch)
+                batch = []
+                batch_size = 0
+        if batch:
+            self.batches.put(batch)
+
+    # Returns False when the service isn't running or failed, the directory is then walked here
+    def scan_with_daemon(self):
+        if os.path.abspath(self.directory_path) != self.directory_path:
+            # The service lists every library by its absolute path
+            return False
+        from cleanerdaemon import DaemonError, connect_daemon, library_params
+        client = connect_daemon()
+        if client is None:
+            return False
+        with self.stats.phase("daemon"):
+            try:
+                reply = client.scan(verify=self.verify, rescan=not self.use_cache, **library_params(self.directory_path, self.rules))
+            except (DaemonError, OSError, ValueError):
+                client.close()
+                return False
+        from cleanercache import CachedDirectory, ScanCache
+        # Only holds the prefixes and counters of the scan, it is never saved
+        self.cache = ScanCache(self.directory_path, rules=self.rules)
+
+        def directories():
+            for path, inode, dirnames, files, prefixes in reply["rows"]:
+                if self.cancel.is_set():
+                    return
+                directory = ScannedDirectory(path, inode, tuple(dirnames),
+                                             tuple(ScanEntry(name, size, False, file_inode) for name, size, file_inode in files))
+                self.cache.seen[path] = CachedDirectory(None, 0, directory, (), prefixes)
+                self.cache.hits += 1
+                yield directory
+        with client, self.stats.phase("walk"):
+            try:
+                self.put_batches(directories())
+            except (DaemonError, OSError, ValueError):
+                # Some folders may be listed already, the scan ends like a cancelled one
+                self.cancel.set()
+        return True
+
 class CleanerApp(tk.Tk):
 
     def file_tree_scroll_mouse_wheel(self, event):
@@ -40,27 +177,73 @@ class CleanerApp(tk.Tk):
 
         # Check if the script is being run as a patch unit test
         self.is_unit_test = is_unit_test
-        if not self.is_unit_test:
-            script_dir = os.path.dirname(os.path.abspath(__file__))
-            icon_path = os.path.join(script_dir, "icon.ico")
-
-            # Load the image file using PIL
-            image = popen(icon_path)
-            photo = PhotoImage(image)
-
-            # Set the photo as the icon image
-            self.iconphoto(True, photo)
+        # Seconds from launch until the window was first mapped
+        self.startup_seconds = None
+        self.icon_photo = None
+        self.bind("<Map>", self.window_mapped, add="+")
 
         self.directory_var = tk.StringVar()
         self.string_var = tk.StringVar()
         self.replace_var = tk.StringVar()
+        self.regex_var = tk.BooleanVar()
         self.scroll_sync_var = tk.BooleanVar(value=True)
         self.leading_zero_var = tk.BooleanVar(value=True)
         self.smart_update_var = tk.BooleanVar()
         self.upper_bpm_var = tk.BooleanVar()
         self.capitalize_var = tk.BooleanVar()
         self.underscore_var = tk.BooleanVar()
-        self.regex_list = []
+        self.virtual_var = tk.BooleanVar()
+        self.watch_var = tk.BooleanVar()
+        self.profile_var = tk.BooleanVar()
+        self.search_var = tk.StringVar()
+        self.changed_only_var = tk.BooleanVar()
+        # The Stats of the last scan, preview and rename, shown by Help > Timings
+        self.stats = {}
+        self.last_profile = None
+        self.scan_started = None
+        self.rename_started = None
+        # File rows inserted into each tree since the last scan started
+        self.rows_inserted = 0
+        self.snapshot = None
+        # The ScanRules the snapshot was scanned with, loaded from the rules file for every scan
+        self.scan_rules = ScanRules()
+        self.plan = None
+        self.regex_index = None
+        self.regex_index_leading_zero = None
+        # Prefixes, normalized and stripped names of every directory, so toggling a cleaner option
+        # only redoes the steps it changes. Seeded with the prefixes kept by the scan cache
+        self.stages = StageCache()
+        # Row IDs in updated_file_tree for every planned file, by directory path
+        self.updated_rows = {}
+        self.preview_job = None
+        self.scanner = None
+        # Files were renamed since the last scan started, so the scan service restats every folder
+        self.files_renamed = False
+        self.watcher = None
+        self.renamer = None
+        self.rename_thread = None
+        self.last_journal = None
+        self.scanned_directories = []
+        self.scanned_file_count = 0
+        self.planned_directories = []
+        # FolderRows of every folder in the trees, by path
+        self.parent_ids = {}
+        # Lazy Folders state, tree item IDs of folders and "more" rows, and the folders listed so far
+        self.folder_paths = {}
+        self.more_rows = {}
+        self.directory_index = {}
+        self.materialized = set()
+        # Whether the trees only show the files matching the search box and Show Only Changed, and
+        # the NameIndex of the plan it was built for
+        self.filtered = False
+        self.search_index = None
+        self.search_index_plan = None
+        # Why the text to replace is left out of the preview, None when it isn't. Regexes that ran
+        # out of PATTERN_BUDGET on this tree are kept with their message and not matched again
+        self.pattern_error = None
+        self.slow_patterns = {}
+        # Matches regexes away from the Tk thread, started with the first one
+        self.pattern_worker = None
 
         self.directory_frame = tk.Frame(self)
         self.directory_frame.grid(row=1, column=1, pady=10, padx=10, sticky="we")
@@ -86,6 +269,9 @@ class CleanerApp(tk.Tk):
         self.string_entry.pack(side="left", anchor="w")
         self.string_entry.config(state='normal')
 
+        self.regex_check = tk.Checkbutton(self.to_replace, text="Regex", variable=self.regex_var, command=self.update_file_list)
+        self.regex_check.pack(side="left", anchor="w")
+
         self.string_remove = tk.Label(self.replacer, text="Replacement:", padx=5)
         self.string_remove.pack(side="left", anchor="center")
 
@@ -93,13 +279,38 @@ class CleanerApp(tk.Tk):
         self.replace_entry.pack(side="left", anchor="w")
         self.replace_entry.config(state='normal')
 
+        self.search_frame = tk.Frame(self)
+        self.search_frame.grid(row=2, column=1, columnspan=2, padx=10, sticky="we")
+
+        self.search_label = tk.Label(self.search_frame, text="Search:", padx=5)
+        self.search_label.pack(side="left", anchor="center")
+
+        self.search_entry = tk.Entry(self.search_frame, textvariable=self.search_var)
+        self.search_entry.pack(side="left", fill=X, expand=True)
+
+        self.changed_only_check = tk.Checkbutton(self.search_frame, text="Show only changed", variable=self.changed_only_var,
+                                                 command=self.apply_filter)
+        self.changed_only_check.pack(side="left", padx=5)
+
         self.rename_button = tk.Button(self, text="Rename Files", command=self.rename_files, justify=CENTER, bd=3)
         self.rename_button.grid(row=4, column=2, pady=10)
 
+        self.status_frame = tk.Frame(self)
+        self.status_frame.grid(row=4, column=1, padx=10, pady=10, sticky="we")
+
+        self.status_label = tk.Label(self.status_frame, text="", anchor="w")
+        self.status_label.pack(side="left", fill=X, expand=True)
+
+        # Only shown while a scan or rename is running
+        self.scan_progress = ttk.Progressbar(self.status_frame, mode="indeterminate", length=120)
+        self.cancel_button = tk.Button(self.status_frame, text="Cancel", command=self.cancel_running, bd=3)
+
         # Associate the validation function with the string variable
-        self.string_var.trace("w", lambda *args: (self.validate_string_entry(), self.update_file_list()) )
-        self.replace_var.trace("w", lambda *args: (self.validate_string_entry(), self.update_file_list()) )
+        self.string_var.trace("w", lambda *args: (self.validate_string_entry(), self.schedule_preview()) )
+        self.replace_var.trace("w", lambda *args: (self.validate_string_entry(), self.schedule_preview()) )
         self.directory_var.trace("w", lambda *args: (self.verify_directory()))
+        # Queries are answered from the NameIndex right away, no need to wait for typing to pause
+        self.search_var.trace("w", lambda *args: self.apply_filter())
 
         self.file_tree = ttk.Treeview(self, columns=("size"))
         self.file_tree.heading("#0", text="Files", anchor="w")
@@ -131,26 +342,37 @@ class CleanerApp(tk.Tk):
         self.file_menu = tk.Menu(self.menu, tearoff=0)
         self.menu.add_cascade(label="File", menu=self.file_menu)
         self.file_menu.add_command(label="Select Directory", command=self.select_directory)
+        self.file_menu.add_command(label="Refresh", accelerator="F5", command=self.refresh)
+        self.file_menu.add_command(label="Undo Last Rename", command=self.undo_last_rename, state='disabled')
+        self.file_menu.add_command(label="Export Plan...", command=self.export_plan)
         self.file_menu.add_separator()
         self.file_menu.add_command(label="Exit", command=self.quit)
 
         self.options_menu = tk.Menu(self.menu, tearoff=0)
         self.menu.add_cascade(label="Options", menu=self.options_menu)
         self.options_menu.add_checkbutton(label="Scroll Sync", variable=self.scroll_sync_var, command=self.scroll_sync_toggle, state='active')
+        self.options_menu.add_checkbutton(label="Lazy Folders", variable=self.virtual_var, command=self.populate_file_trees)
+        self.options_menu.add_checkbutton(label="Watch for Changes", variable=self.watch_var, command=self.toggle_watching)
+        self.options_menu.add_checkbutton(label="Show Only Changed", variable=self.changed_only_var, command=self.apply_filter)
+        self.options_menu.add_separator()
+        self.options_menu.add_command(label="Scan Rules...", command=self.show_rules_dialog)
 
         self.cleaner_menu = tk.Menu(self.menu, tearoff=0)
         self.menu.add_cascade(label="Candle Cleaner", menu=self.cleaner_menu)
-        self.cleaner_menu.add_checkbutton(label="Enable", variable=self.smart_update_var, command=lambda : self.update_file_list(True))
+        self.cleaner_menu.add_checkbutton(label="Enable", variable=self.smart_update_var, command=self.update_file_list)
         self.cleaner_menu.add_separator()
-        self.cleaner_menu.add_checkbutton(label="Including Leading 0s", variable=self.leading_zero_var, state='disabled', command=lambda : self.update_file_list(True))
-        self.cleaner_menu.add_checkbutton(label="Capitalize BPM", variable=self.upper_bpm_var, state='disabled', command=lambda : self.update_file_list(True))
-        self.cleaner_menu.add_checkbutton(label="Capitalize Words", variable=self.capitalize_var, state='disabled', command=lambda : self.update_file_list(True))
-        self.cleaner_menu.add_checkbutton(label="Replace Underscores", variable=self.underscore_var, state='disabled', command=lambda : self.update_file_list(True))
+        self.cleaner_menu.add_checkbutton(label="Including Leading 0s", variable=self.leading_zero_var, state='disabled', command=self.update_file_list)
+        self.cleaner_menu.add_checkbutton(label="Capitalize BPM", variable=self.upper_bpm_var, state='disabled', command=self.update_file_list)
+        self.cleaner_menu.add_checkbutton(label="Capitalize Words", variable=self.capitalize_var, state='disabled', command=self.update_file_list)
+        self.cleaner_menu.add_checkbutton(label="Replace Underscores", variable=self.underscore_var, state='disabled', command=self.update_file_list)
 
         self.help_menu = tk.Menu(self.menu, tearoff=0)
         self.menu.add_cascade(label="Help", menu=self.help_menu)
         self.help_menu.add_command(label="About", command=self.show_help)
         self.help_menu.add_command(label="Source", command=self.show_source)
+        self.help_menu.add_separator()
+        self.help_menu.add_command(label="Timings", command=self.show_timings)
+        self.help_menu.add_checkbutton(label="Profile Next Operation", variable=self.profile_var)
 
         # Add a callback to each scrollbar that sets the position of the other scrollbar
         def sync_scrolls(first_treeview, second_treeview):
@@ -165,6 +387,11 @@ class CleanerApp(tk.Tk):
         self.file_tree_scroll.config(command=sync_scrolls(self.file_tree, self.updated_file_tree))
         self.updated_file_tree_scroll.config(command=sync_scrolls(self.updated_file_tree, self.file_tree))
 
+        self.bind("<F5>", lambda event: self.refresh())
+        for tree in (self.file_tree, self.updated_file_tree):
+            tree.bind("<<TreeviewOpen>>", self.open_folder)
+            tree.bind("<<TreeviewClose>>", self.close_folder)
+
         # Configure the grid layout
         self.grid_rowconfigure(3, weight=1)
         self.grid_columnconfigure(1, weight=1)
@@ -188,6 +415,7 @@ class CleanerApp(tk.Tk):
             self.cleaner_menu.entryconfig(5, state='normal')
             self.string_entry.config(state='disabled')
             self.replace_entry.config(state='disabled')
+            self.regex_check.config(state='disabled')
         else:
             self.cleaner_menu.entryconfig(2, state='disabled')
             self.cleaner_menu.entryconfig(3, state='disabled')
@@ -195,171 +423,710 @@ class CleanerApp(tk.Tk):
             self.cleaner_menu.entryconfig(5, state='disabled')
             self.string_entry.config(state='normal')
             self.replace_entry.config(state='normal')
+            self.regex_check.config(state='normal')
 
     def verify_directory(self):
         if os.path.isdir(self.directory_var.get()):
             self.update_file_list(True)
 
+    # The selected directory as scanned, without a trailing separator
+    def selected_directory(self):
+        directory_path = self.directory_var.get()
+        return os.path.normpath(directory_path) if directory_path else directory_path
+
     def select_directory(self):
         directory_path = filedialog.askdirectory()
         if directory_path:
+            # Setting the variable triggers verify_directory, which rescans
             self.directory_var.set(directory_path)
-            self.update_file_list(True)
 
+    # A regex that doesn't compile, could backtrack forever or already ran out of time is left out,
+    # so the names show unchanged and pattern_error says why
+    def cleaner_options(self):
+        options = CleanerOptions(string_to_remove=self.string_var.get(), replacement=self.replace_var.get(),
+                                 smart_update=self.smart_update_var.get(), leading_zero=self.leading_zero_var.get(),
+                                 upper_bpm=self.upper_bpm_var.get(), capitalize=self.capitalize_var.get(),
+                                 underscore=self.underscore_var.get(), use_regex=self.regex_var.get())
+        self.pattern_error = None
+        if options.use_regex and not options.smart_update and options.string_to_remove:
+            self.pattern_error = self.slow_patterns.get(options.string_to_remove)
+            if self.pattern_error is None:
+                try:
+                    compile_pattern(options.string_to_remove, options.replacement, True)
+                except PatternError as error:
+                    self.pattern_error = str(error)
+            if self.pattern_error is not None:
+                options = options._replace(string_to_remove="")
+        return options
+
+    # Shows pattern_error in the status line, or the file count again once the pattern is fixed
+    def show_pattern_error(self, shown_error):
+        if self.pattern_error is not None:
+            self.status_label.config(text=self.pattern_error)
+        elif shown_error is not None and self.status_label.cget("text") == shown_error and self.snapshot is not None:
+            self.status_label.config(text=str(len(self.snapshot)) + " files")
+
+    # Recompute the preview once typing pauses instead of on every keystroke
+    def schedule_preview(self):
+        if self.preview_job is not None:
+            self.after_cancel(self.preview_job)
+        self.preview_job = self.after(PREVIEW_DELAY_MS, self.update_file_list)
+
+    # Rescan only when make_regex is set or the directory changed, otherwise the names are
+    # replanned from the snapshot and only the rows that changed are updated
     def update_file_list(self, make_regex = False):
-        directory_path = self.directory_var.get()
-        smart_update = self.smart_update_var.get()
-        if make_regex: self.regex_list = []
+        if self.preview_job is not None:
+            self.after_cancel(self.preview_job)
+            self.preview_job = None
+        directory_path = self.selected_directory()
         self.validate_string_entry()
+        if self.renamer is not None:
+            # The directory is rescanned once the rename finishes
+            return
+        shown_error = self.pattern_error
         if os.path.isdir(directory_path):
-            # Clear the file tree
-            self.file_tree.delete(*self.file_tree.get_children())
-            self.updated_file_tree.delete(*self.updated_file_tree.get_children())
-            # Dictionary to hold parent node IDs
-            parent_ids = {}
-            # Traverse the directory tree
-            for dirpath, dirnames, filenames in os.walk(directory_path):
-                # Get the name of the current folder
-                folder_name = os.path.basename(dirpath)
-
-                # Create a new node in the tree for the current folder
-                if not parent_ids.get(dirpath):
-                    if not os.path.samefile(dirpath, directory_path):
-                        parent_dirpath = os.path.dirname(dirpath)
-                        parent_id = parent_ids.get(parent_dirpath)['file_tree']
-                        updated_parent_id = parent_ids.get(parent_dirpath)['updated_file_tree']
-                    else:
-                        parent_id = ""
-                        updated_parent_id = ""
-                    parent_id = self.file_tree.insert(parent_id, END, text=folder_name, open=True)
-                    updated_parent_id = self.updated_file_tree.insert(updated_parent_id, END, text=folder_name, open=True)
-                    parent_ids[dirpath] = {'file_tree': parent_id, 'updated_file_tree': updated_parent_id}
-
-                # Add subdirectories to the current folder node
-                for dirname in dirnames:
-                    sub_dirpath = os.path.join(dirpath, dirname)
-                    if not parent_ids.get(sub_dirpath):
-                        parent_id = parent_ids.get(dirpath)['file_tree']
-                        updated_parent_id = parent_ids.get(dirpath)['updated_file_tree']
-                        sub_dirname = os.path.basename(sub_dirpath)
-                        sub_parent_id = self.file_tree.insert(parent_id, END, text=sub_dirname, open=True)
-                        updated_sub_parent_id = self.updated_file_tree.insert(updated_parent_id, END, text=sub_dirname, open=True)
-                        parent_ids[sub_dirpath] = {'file_tree': sub_parent_id, 'updated_file_tree': updated_sub_parent_id}
-
-                # Create regex list for selected directory
-                if make_regex:
-                    if filenames:
-                        directory_name = os.path.basename(dirpath)
-                        self.generate_regex(filenames, directory_name)
-
-                # Add files to the current folder node
-                for filename in filenames:
-                    if not filename.startswith("."):  # Ignore hidden files
-                        file_path = os.path.join(dirpath, filename)
-                        file_size = os.path.getsize(file_path)
-                        self.file_tree.insert(parent_ids[dirpath]['file_tree'], END, text=filename, values=(file_size,))
-                        if smart_update:
-                            current_directory = os.path.basename(dirpath)
-                            current_regex = next((regex[0] for regex in self.regex_list if regex[1] == current_directory), "")
-                            string_to_remove = current_regex
-                            file_shown = re.sub(r'[ \-_]+', '_', os.path.splitext(filename)[0].lower()) + os.path.splitext(filename)[1]
-                            replacement = ""
-                        else:
-                            string_to_remove = self.string_var.get()
-                            replacement = self.replace_var.get()
-                            file_shown = filename
-                        if string_to_remove:
-                            pattern = re.compile(re.escape(string_to_remove), re.IGNORECASE)
-                            updated_file_name = re.sub(pattern, replacement, file_shown)
-                            updated_file_size = os.path.getsize(file_path)
-                            if self.upper_bpm_var.get(): updated_file_name = updated_file_name.replace('bpm', 'BPM')
-                            if self.capitalize_var.get(): updated_file_name = self.capitalize_string(updated_file_name)
-                            if self.underscore_var.get(): updated_file_name = self.replace_underscore(updated_file_name)
-                            self.updated_file_tree.insert(parent_ids[dirpath]['updated_file_tree'], END, text=updated_file_name, values=(updated_file_size,))
-                        else:
-                            self.updated_file_tree.insert(parent_ids[dirpath]['updated_file_tree'], END, text=filename, values=(file_size,))
-    
+            if self.scanner is not None and self.scanner.directory_path == directory_path and not make_regex:
+                # The running scan replans with the latest options once it finishes
+                return
+            if make_regex or self.snapshot is None or self.snapshot.root != directory_path:
+                self.start_scan(directory_path)
+            else:
+                stats = Stats("preview")
+                with profiled(self.take_profile_path("preview")):
+                    try:
+                        plan = self.plan_snapshot(stats)
+                    except PatternError as error:
+                        self.slow_patterns[self.string_var.get()] = str(error)
+                        plan = self.plan_snapshot(stats)
+                    with stats.phase("tree"):
+                        stats.count("rows_updated", self.update_changed_rows(self.plan, plan))
+                self.stats["preview"] = stats
+                self.plan = plan
+                self.planned_directories = list(plan.directories)
+                if self.filtered or self.filter_active():
+                    # Which files match may have changed with the names
+                    self.populate_file_trees()
+                self.show_pattern_error(shown_error)
+
+    # Rescans every directory, ignoring the scan cache
+    def refresh(self):
+        directory_path = self.selected_directory()
+        if self.renamer is None and os.path.isdir(directory_path):
+            self.start_scan(directory_path, use_cache=False)
+
+    # Prefix regexes only depend on the snapshot and the leading zero option, so the index is kept
+    # until either changes and renaming uses the same regexes the preview showed. Toggling leading
+    # zeros only turns the kept prefixes into regexes again, the other options only rerun the
+    # casing and underscore steps over the stripped names. A regex typed into the text to replace
+    # field raises PatternTimeout once it took PATTERN_BUDGET seconds, or PatternError when its worker
+    # stopped
+    def plan_snapshot(self, stats=None):
+        stats = stats or Stats("preview")
+        options = self.cleaner_options()
+        if not options.smart_update:
+            with stats.phase("plan"):
+                names = [name for index in range(len(self.snapshot.folder_names)) for name in self.snapshot.file_names(index)]
+                known_targets = self.pattern_targets(options, names, PATTERN_BUDGET)
+                return build_plan(self.snapshot, options, known_targets=known_targets)
+        if self.regex_index is None or self.regex_index_leading_zero != options.leading_zero:
+            with stats.phase("regex"):
+                self.regex_index = self.stages.regex_index(self.snapshot, options.leading_zero)
+            self.regex_index_leading_zero = options.leading_zero
+        with stats.phase("plan"):
+            return build_plan(self.snapshot, options, self.regex_index, stages=self.stages)
+
+    # {name: new name} for the names when the text to replace is a regex, matched in the
+    # PatternWorker so one that backtracks on a name can be stopped after budget seconds
+    def pattern_targets(self, options, names, budget):
+        if not options.use_regex or options.smart_update or not options.string_to_remove:
+            return None
+        if self.pattern_worker is None:
+            self.pattern_worker = PatternWorker()
+        return self.pattern_worker.targets(options, names, budget)
+
+    # Starting a scan cancels the one still running, its results are dropped
+    def start_scan(self, directory_path, use_cache=True):
+        if self.scanner is not None:
+            self.scanner.cancel.set()
+        self.stop_watching()
+        from cleanerrules import load_rules
+        self.scan_rules = load_rules()
+        self.snapshot = None
+        self.plan = None
+        self.regex_index = None
+        self.stages = StageCache()
+        self.slow_patterns = {}
+        self.scanned_directories = []
+        self.scanned_file_count = 0
+        self.planned_directories = []
+        self.clear_file_trees()
+        self.filtered = self.filter_active()
+
+        self.stats["scan"] = Stats("scan")
+        self.scan_started = time.perf_counter()
+        self.rows_inserted = 0
+        self.scanner = ScanWorker(directory_path, use_cache, self.stats["scan"], self.take_profile_path("scan"), self.scan_rules,
+                                  self.files_renamed, self.smart_update_var.get())
+        self.files_renamed = False
+        self.scanner.start()
+        self.show_progress("Scanning...")
+        self.after(SCAN_POLL_MS, self.poll_scan, self.scanner)
+
+    # A scan has no known total, so its progress bar just runs until the scan finishes
+    def show_progress(self, status, total=None):
+        if total is None:
+            self.scan_progress.config(mode="indeterminate")
+            self.scan_progress.start()
+        else:
+            self.scan_progress.config(mode="determinate", maximum=max(total, 1), value=0)
+        self.scan_progress.pack(side="left", padx=5)
+        self.cancel_button.pack(side="left")
+        self.status_label.config(text=status)
+
+    def hide_progress(self, status):
+        self.scan_progress.stop()
+        self.scan_progress.pack_forget()
+        self.cancel_button.pack_forget()
+        self.status_label.config(text=status)
+
+    # Stops the running rename, or the running scan keeping the files found so far listed
+    def cancel_running(self):
+        if self.renamer is not None:
+            self.renamer.cancel.set()
+        elif self.scanner is not None:
+            self.scanner.cancel.set()
+
+    def poll_scan(self, scanner):
+        if scanner is not self.scanner:
+            return
+        deadline = time.monotonic() + SCAN_POLL_BUDGET
+        options = self.cleaner_options()
+        pattern_deadline = time.perf_counter() + PATTERN_BUDGET
+        while time.monotonic() < deadline:
+            try:
+                batch = scanner.batches.get_nowait()
+            except queue.Empty:
+                break
+            if batch is None:
+                self.finish_scan(scanner)
+                return
+            with scanner.stats.phase("tree"):
+                try:
+                    known_targets = self.pattern_targets(options, [file.name for directory in batch for file in directory.files],
+                                                         pattern_deadline - time.perf_counter())
+                except PatternError as error:
+                    self.slow_patterns[options.string_to_remove] = str(error)
+                    options = self.cleaner_options()
+                    known_targets = None
+                for directory in batch:
+                    self.scanned_directories.append(directory)
+                    self.scanned_file_count += len(directory.files)
+                    planned_directory = plan_directory(directory, options, known_targets=known_targets)
+                    self.planned_directories.append(planned_directory)
+                    self.add_planned_directory(len(self.planned_directories) - 1, planned_directory)
+        self.status_label.config(text="Scanning... " + str(self.scanned_file_count) + " files")
+        self.after(SCAN_POLL_MS, self.poll_scan, scanner)
+
+    def finish_scan(self, scanner):
+        self.scanner = None
+        self.snapshot = Snapshot(scanner.directory_path, self.scanned_directories)
+        self.scanned_directories = []
+        self.plan = make_plan(scanner.directory_path, self.planned_directories)
+        elapsed = time.perf_counter() - self.scan_started
+        scanner.stats.add_time("total", elapsed)
+        count_scan(scanner.stats, self.snapshot, scanner.cache)
+        scanner.stats.count("rows_inserted", self.rows_inserted)
+        status = str(self.scanned_file_count) + " files"
+        if scanner.cancel.is_set():
+            status = "Scan cancelled, " + status + " listed"
+        else:
+            status += " in " + format(elapsed, ".2f") + "s"
+            # Smart cleaning works out the ones the scan didn't when it is turned on
+            self.stages = StageCache(scanner.cache.prefixes(compute=False))
+        self.hide_progress(status)
+        # The options may have changed while the scan was running
+        self.update_file_list()
+        if self.watch_var.get() and not scanner.cancel.is_set():
+            self.start_watching()
+
+    def clear_file_trees(self):
+        self.file_tree.delete(*self.file_tree.get_children())
+        self.updated_file_tree.delete(*self.updated_file_tree.get_children())
+        self.updated_rows = {}
+        self.parent_ids = {}
+        self.folder_paths = {}
+        self.more_rows = {}
+        self.directory_index = {}
+        self.materialized = set()
+
+    # Rebuild both trees from the planned directories, used when the view mode changes
+    def populate_file_trees(self):
+        if self.scanner is not None:
+            self.update_file_list(True)
+            return
+        self.clear_file_trees()
+        self.filtered = self.filter_active()
+        if self.filtered:
+            self.populate_filtered_trees()
+            return
+        for index, directory in enumerate(self.planned_directories):
+            self.add_planned_directory(index, directory)
+
+    def filter_active(self):
+        return bool(self.search_var.get()) or self.changed_only_var.get()
+
+    # The search box and Show Only Changed, a running scan shows the result once it finishes
+    def apply_filter(self):
+        if self.scanner is None and self.renamer is None and self.plan is not None:
+            self.populate_file_trees()
+
+    def populate_filtered_trees(self):
+        # Only the matching files and the folders above them get rows, with every folder open
+        query = self.search_var.get()
+        if query and self.search_index_plan is not self.plan:
+            self.search_index = NameIndex(self.planned_directories)
+            self.search_index_plan = self.plan
+        groups, count, more = filter_plan(self.planned_directories, query, self.changed_only_var.get(), self.search_index)
+        self.directory_index = {directory.path: index for index, directory in enumerate(self.planned_directories)}
+        for index, positions in groups:
+            directory = self.planned_directories[index]
+            ids = self.filtered_folder(directory.path)
+            rows = self.updated_rows[directory.path] = [None] * len(directory.entries)
+            for position in positions:
+                entry = directory.entries[position]
+                self.file_tree.insert(ids.file_tree, END, text=entry.filename, values=(entry.size,))
+                rows[position] = self.updated_file_tree.insert(ids.updated_file_tree, END, text=entry.target, values=(entry.size,))
+        if more:
+            self.status_label.config(text="First " + str(count) + " matching files shown")
+        else:
+            self.status_label.config(text=str(count) + " matching files")
+
+    def filtered_folder(self, path):
+        # The FolderRows of a folder in the filtered trees, added with its parents when missing
+        ids = self.parent_ids.get(path)
+        if ids is None:
+            root = self.planned_directories[0].path
+            parent_path = os.path.dirname(path)
+            if path == root or parent_path == path:
+                # The root, or the top of the filesystem should a folder outside it come up
+                parent = FolderRows("", "")
+            else:
+                parent = self.filtered_folder(parent_path)
+            self.insert_folder(parent.file_tree, parent.updated_file_tree, path, os.path.basename(path), True)
+            # Opening a folder doesn't list the files that didn't match
+            self.materialized.add(path)
+            ids = self.parent_ids[path]
+        return ids
+
+    def add_planned_directory(self, index, directory):
+        self.directory_index[directory.path] = index
+        if self.filtered:
+            # The filtered trees are built once the scan finishes
+            return
+        self.updated_rows[directory.path] = [None] * len(directory.entries)
+        if index == 0:
+            self.insert_folder("", "", directory.path, os.path.basename(directory.path), True)
+        # In lazy mode a folder is only listed once it is opened, os.walk order means its
+        # node already exists if its parent was listed
+        ids = self.parent_ids.get(directory.path)
+        if ids is not None and (not self.virtual_var.get() or self.file_tree.item(ids.file_tree, 'open')):
+            self.materialize_directory(index)
+
+    def insert_folder(self, parent_id, updated_parent_id, path, folder_name, is_open=False):
+        lazy = self.virtual_var.get() and not is_open
+        folder_id = self.file_tree.insert(parent_id, END, text=folder_name, open=not lazy)
+        updated_folder_id = self.updated_file_tree.insert(updated_parent_id, END, text=folder_name, open=not lazy)
+        self.parent_ids[path] = FolderRows(folder_id, updated_folder_id)
+        self.folder_paths[folder_id] = path
+        self.folder_paths[updated_folder_id] = path
+        if lazy:
+            # A placeholder child gives the folder an expand arrow without listing it
+            self.file_tree.insert(folder_id, END, text=LOADING_TEXT)
+            self.updated_file_tree.insert(updated_folder_id, END, text=LOADING_TEXT)
+
+    def materialize_directory(self, index):
+        directory = self.planned_directories[index]
+        ids = self.parent_ids[directory.path]
+        self.materialized.add(directory.path)
+        if self.virtual_var.get():
+            self.file_tree.delete(*self.file_tree.get_children(ids.file_tree))
+            self.updated_file_tree.delete(*self.updated_file_tree.get_children(ids.updated_file_tree))
+
+        # Add subdirectories to the current folder node
+        for dirname in directory.dirnames:
+            self.insert_folder(ids.file_tree, ids.updated_file_tree, os.path.join(directory.path, dirname), dirname)
+        self.insert_files(index, 0)
+
+    def insert_files(self, index, start):
+        directory = self.planned_directories[index]
+        ids = self.parent_ids[directory.path]
+        rows = self.updated_rows[directory.path]
+        end = len(directory.entries)
+        if self.virtual_var.get():
+            end = min(end, start + VIRTUAL_PAGE_SIZE)
+
+        # Add files to the current folder node
+        for position in range(start, end):
+            entry = directory.entries[position]
+            self.file_tree.insert(ids.file_tree, END, text=entry.filename, values=(entry.size,))
+            rows[position] = self.updated_file_tree.insert(ids.updated_file_tree, END, text=entry.target, values=(entry.size,))
+            self.rows_inserted += 1
+
+        # The rest of a large folder is listed a page at a time from a row that opens like a folder
+        if end < len(directory.entries):
+            more_text = "... " + str(len(directory.entries) - end) + " more"
+            more_id = self.file_tree.insert(ids.file_tree, END, text=more_text)
+            updated_more_id = self.updated_file_tree.insert(ids.updated_file_tree, END, text=more_text)
+            self.file_tree.insert(more_id, END, text=LOADING_TEXT)
+            self.updated_file_tree.insert(updated_more_id, END, text=LOADING_TEXT)
+            self.more_rows[more_id] = self.more_rows[updated_more_id] = (directory.path, end, more_id, updated_more_id)
+
+    # Opening a folder in either tree opens it in both, so the columns stay row for row for scroll sync
+    def open_folder(self, event):
+        item_id = event.widget.focus()
+        if item_id in self.more_rows:
+            path, start, more_id, updated_more_id = self.more_rows.pop(item_id)
+            self.more_rows.pop(more_id, None)
+            self.more_rows.pop(updated_more_id, None)
+            self.file_tree.delete(more_id)
+            self.updated_file_tree.delete(updated_more_id)
+            self.insert_files(self.directory_index[path], start)
+            return
+        path = self.folder_paths.get(item_id)
+        if path is None:
+            return
+        ids = self.parent_ids[path]
+        self.file_tree.item(ids.file_tree, open=True)
+        self.updated_file_tree.item(ids.updated_file_tree, open=True)
+        index = self.directory_index.get(path)
+        if index is not None and path not in self.materialized:
+            self.materialize_directory(index)
+
+    def close_folder(self, event):
+        path = self.folder_paths.get(event.widget.focus())
+        if path is not None:
+            ids = self.parent_ids[path]
+            self.file_tree.item(ids.file_tree, open=False)
+            self.updated_file_tree.item(ids.updated_file_tree, open=False)
+
+    def update_changed_rows(self, old_plan, new_plan):
+        # Both plans come from the same snapshot, so directories and entries line up. Returns the
+        # number of rows updated
+        updated = 0
+        for old_directory, new_directory in zip(old_plan.directories, new_plan.directories):
+            rows = self.updated_rows.get(new_directory.path, ())
+            for row, old_entry, new_entry in zip(rows, old_directory.entries, new_directory.entries):
+                if row is not None and old_entry.target != new_entry.target:
+                    self.updated_file_tree.item(row, text=new_entry.target)
+                    updated += 1
+        return updated
+
+    def toggle_watching(self):
+        if self.watch_var.get():
+            if self.snapshot is not None and self.scanner is None and self.renamer is None:
+                self.start_watching()
+        else:
+            self.stop_watching()
+
+    def start_watching(self):
+        self.stop_watching()
+        from cleanerwatch import DirectoryWatcher
+        self.watcher = DirectoryWatcher(self.snapshot.paths())
+        self.watcher.start()
+        self.after(WATCH_POLL_MS, self.poll_watcher, self.watcher)
+
+    def stop_watching(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+
+    def poll_watcher(self, watcher):
+        if watcher is not self.watcher:
+            return
+        changed = set()
+        while True:
+            try:
+                changed.update(watcher.changes.get_nowait())
+            except queue.Empty:
+                break
+        if changed:
+            self.apply_directory_changes(changed)
+        self.after(WATCH_POLL_MS, self.poll_watcher, watcher)
+
+    # Relist only the directories that changed, regenerate their prefix regexes and replace
+    # their rows, the rest of the model and both trees are left alone
+    def apply_directory_changes(self, dirpaths):
+        snapshot, changed, removed = refresh_directories(self.snapshot, dirpaths, self.scan_rules)
+        self.snapshot = snapshot
+        self.watcher.unwatch(removed)
+        self.watcher.watch(changed)
+        options = self.cleaner_options()
+        paths = snapshot.paths()
+        changed_directories = [snapshot.directory(index, path) for index, path in enumerate(paths) if path in changed]
+        self.stages.discard(changed | removed)
+        if self.regex_index is not None:
+            self.regex_index = update_regex_index(self.regex_index, changed_directories, removed, self.regex_index_leading_zero)
+        regex_index = self.regex_index if options.smart_update and self.regex_index_leading_zero == options.leading_zero else None
+
+        try:
+            known_targets = self.pattern_targets(options, [file.name for directory in changed_directories for file in directory.files],
+                                                 PATTERN_BUDGET)
+        except PatternError as error:
+            self.slow_patterns[options.string_to_remove] = str(error)
+            options = self.cleaner_options()
+            known_targets = None
+
+        planned = {directory.path: directory for directory in self.planned_directories if directory.path not in removed}
+        for directory in changed_directories:
+            planned[directory.path] = plan_directory(directory, options, regex_index, known_targets, self.stages)
+        self.planned_directories = [planned[path] for path in paths]
+        self.directory_index = {directory.path: index for index, directory in enumerate(self.planned_directories)}
+        self.plan = make_plan(snapshot.root, self.planned_directories)
+
+        if self.filtered:
+            self.populate_file_trees()
+            self.show_pattern_error(None)
+            return
+        for path in sorted(removed, key=len):
+            self.remove_folder(path)
+        for directory in changed_directories:
+            self.refresh_folder(directory.path)
+        self.status_label.config(text=str(len(snapshot)) + " files")
+        self.show_pattern_error(None)
+
+    def remove_folder(self, path):
+        ids = self.parent_ids.get(path)
+        if ids is not None:
+            self.file_tree.delete(ids.file_tree)
+            self.updated_file_tree.delete(ids.updated_file_tree)
+        for other in [other for other in self.parent_ids if other == path or other.startswith(os.path.join(path, ""))]:
+            other_ids = self.parent_ids.pop(other)
+            self.folder_paths.pop(other_ids.file_tree, None)
+            self.folder_paths.pop(other_ids.updated_file_tree, None)
+            self.updated_rows.pop(other, None)
+            self.materialized.discard(other)
+
+    # Replace the rows of a folder that is already in the trees, new subfolders are added after the
+    # existing ones so both trees stay row for row
+    def refresh_folder(self, path):
+        index = self.directory_index[path]
+        ids = self.parent_ids.get(path)
+        if ids is None:
+            # Its parent folder hasn't been listed yet, it is listed with it
+            return
+        if path not in self.materialized:
+            self.updated_rows[path] = [None] * len(self.planned_directories[index].entries)
+            # A new folder, or a lazy folder that is listed once it is opened
+            if not self.virtual_var.get() or self.file_tree.item(ids.file_tree, 'open'):
+                self.materialize_directory(index)
+            return
+        for tree, key in ((self.file_tree, 'file_tree'), (self.updated_file_tree, 'updated_file_tree')):
+            for item_id in tree.get_children(getattr(ids, key)):
+                if item_id not in self.folder_paths:
+                    self.more_rows.pop(item_id, None)
+                    tree.delete(item_id)
+        directory = self.planned_directories[index]
+        for dirname in directory.dirnames:
+            subdirectory_path = os.path.join(path, dirname)
+            if subdirectory_path not in self.parent_ids:
+                # Its files are listed when the new folder itself is refreshed
+                self.insert_folder(ids.file_tree, ids.updated_file_tree, subdirectory_path, dirname)
+        self.updated_rows[path] = [None] * len(directory.entries)
+        self.insert_files(index, 0)
+
     def rename_files(self):
-        directory_path = self.directory_var.get()
-        smart_update = self.smart_update_var.get()
-        success = True
+        directory_path = self.selected_directory()
+        if self.scanner is not None or self.renamer is not None:
+            messagebox.showinfo("Busy", "Wait for the scan or rename to finish before renaming.")
+            return
+
+        self.cleaner_options()
+        if self.pattern_error is not None:
+            messagebox.showerror("Invalid Pattern", self.pattern_error)
+            return
 
         if messagebox.askyesno("Confirmation", "Rename Files?"):
             if os.path.isdir(directory_path):
-                for dirpath, dirnames, filenames in os.walk(directory_path):
-                    for filename in filenames:
-                        if filename != ".DS_Store" and filename != "":
-                            if smart_update:
-                                current_directory = os.path.basename(dirpath)
-                                current_regex = next((regex[0] for regex in self.regex_list if regex[1] == current_directory), "")
-                                string_to_remove = current_regex
-                                file_shown = re.sub(r'[ \-_]+', '_', os.path.splitext(filename)[0].lower()) + os.path.splitext(filename)[1]
-                                replacement = ""
-                            else:
-                                string_to_remove = self.string_var.get()
-                                replacement = self.replace_var.get()
-                                file_shown = filename
-                            pattern = re.compile(re.escape(string_to_remove), re.IGNORECASE)
-                            updated_file_name = re.sub(pattern, replacement, file_shown)
-                            if self.upper_bpm_var.get(): updated_file_name = updated_file_name.replace('bpm', 'BPM')
-                            if self.capitalize_var.get(): updated_file_name = self.capitalize_string(updated_file_name)
-                            if self.underscore_var.get(): updated_file_name = self.replace_underscore(updated_file_name)
-                            src = os.path.join(dirpath, filename)
-                            dst = os.path.join(dirpath, updated_file_name)
-                            try:
-                                os.rename(src, dst)
-                            except:
-                                success = False
-                                messagebox.showerror("Failed" "Couldn't rename file: " + file_shown)
-                self.smart_update_var.set(False)
-                self.update_file_list()
-                if success:
-                    messagebox.showinfo("Success", "Files renamed successfully!")
+                if self.snapshot is None or self.snapshot.root != directory_path:
+                    from cleanerrules import load_rules
+                    self.scan_rules = load_rules()
+                    self.snapshot = scan_directory(directory_path, rules=self.scan_rules)
+                    self.regex_index = None
+                    self.stages = StageCache()
+                try:
+                    renames = self.plan_snapshot().renames()
+                except PatternError as error:
+                    self.slow_patterns[self.string_var.get()] = str(error)
+                    messagebox.showerror("Invalid Pattern", str(error))
+                    return
+                from cleanerrename import RenameExecutor, default_journal_path
+                self.start_rename(RenameExecutor(renames, journal_path=default_journal_path()), "Renaming...")
+
+    # Writes the renames shown in the preview to a JSONL or CSV file, see cleanerplanfile
+    def export_plan(self):
+        if self.preview_job is not None:
+            self.update_file_list()
+        if self.scanner is not None or self.renamer is not None or self.plan is None:
+            messagebox.showinfo("Busy", "Wait for the scan or rename to finish before exporting the plan.")
+            return
+        path = filedialog.asksaveasfilename(defaultextension=".jsonl", filetypes=[("JSON Lines", "*.jsonl"), ("CSV", "*.csv")])
+        if not path:
+            return
+        from cleanerplanfile import write_plan_file
+        try:
+            written = write_plan_file(self.plan.directories, path)
+        except OSError as error:
+            messagebox.showerror("Export Failed", "Couldn't write the plan: " + str(error))
+            return
+        self.status_label.config(text=str(written) + " renames exported")
+
+    def undo_last_rename(self):
+        if self.scanner is not None or self.renamer is not None or self.last_journal is None:
+            return
+        if messagebox.askyesno("Confirmation", "Undo the last rename?"):
+            from cleanerrename import undo_executor
+            self.start_rename(undo_executor(self.last_journal), "Undoing...")
+
+    # The renames run on a thread pool, the Tk thread only follows the progress
+    def start_rename(self, renamer, status):
+        # The files are rescanned once the rename finishes, its own changes aren't watched
+        self.stop_watching()
+        self.renamer = renamer
+        self.files_renamed = True
+        self.rename_started = time.perf_counter()
+        self.rename_thread = threading.Thread(target=self.run_renamer, args=(renamer, self.take_profile_path("rename")), daemon=True)
+        self.rename_thread.start()
+        self.show_progress(status, renamer.total)
+        self.after(RENAME_POLL_MS, self.poll_rename, renamer, status)
+
+    # Only the thread driving the pool is profiled, not the pool threads doing the renames
+    def run_renamer(self, renamer, path):
+        with profiled(path):
+            renamer.run()
+
+    def poll_rename(self, renamer, status):
+        if renamer.report is None and self.rename_thread.is_alive():
+            # The total is only final once the plan was checked for collisions
+            self.scan_progress.config(maximum=max(renamer.total, 1), value=renamer.done)
+            self.status_label.config(text=status + " " + str(renamer.done) + " of " + str(renamer.total))
+            self.after(RENAME_POLL_MS, self.poll_rename, renamer, status)
+            return
+        self.renamer = None
+        report = renamer.report
+        if report is None:
+            self.hide_progress("Rename failed")
+            messagebox.showerror("Rename Failed", "The rename stopped unexpectedly, check the journals in " + data_directory("journals"))
+            return
+        stats = Stats("rename")
+        stats.add_time("total", time.perf_counter() - self.rename_started)
+        stats.count("rename_calls", renamer.done)
+        stats.count("renamed", report.renamed)
+        stats.count("failures", len(report.failures))
+        self.stats["rename"] = stats
+        self.last_journal = report.journal
+        self.file_menu.entryconfig("Undo Last Rename", state='normal')
+        self.hide_progress(str(report.renamed) + " files renamed")
+        self.smart_update_var.set(False)
+        self.update_file_list(True)
+        # One summary for the whole run instead of a dialog per failed file
+        if report.failures or report.cancelled:
+            messagebox.showerror("Rename Incomplete", report.summary())
+        else:
+            messagebox.showinfo("Success", "Files renamed successfully!")
+
+    # Edits the ScanRules saved in ~/.candlecleaner/rules.json, which every scan from the window and
+    # the command line starts from
+    def show_rules_dialog(self):
+        from cleanerrules import load_rules
+        rules = load_rules()
+        dialog = tk.Toplevel(self)
+        dialog.title("Scan Rules")
+        dialog.transient(self)
+        exclude_var = tk.StringVar(value=", ".join(rules.exclude))
+        extensions_var = tk.StringVar(value=", ".join(rules.extensions))
+        max_depth_var = tk.StringVar(value="" if rules.max_depth is None else str(rules.max_depth))
+        hidden_var = tk.BooleanVar(value=rules.include_hidden)
+        fields = [("Exclude (globs like .git, *.mov, Projects/*):", exclude_var),
+                  ("Only extensions (like wav, aif, flac):", extensions_var),
+                  ("Max folder depth:", max_depth_var)]
+        for row, (text, variable) in enumerate(fields):
+            tk.Label(dialog, text=text, padx=5).grid(row=row, column=0, sticky="w", pady=2)
+            tk.Entry(dialog, textvariable=variable, width=40).grid(row=row, column=1, padx=5, pady=2, sticky="we")
+        tk.Checkbutton(dialog, text="Include hidden files and folders", variable=hidden_var).grid(row=3, column=1, sticky="w")
+        save = lambda: self.save_scan_rules(exclude_var.get(), extensions_var.get(), max_depth_var.get(), hidden_var.get(), dialog)
+        tk.Button(dialog, text="Save", command=save, bd=3).grid(row=4, column=1, padx=5, pady=10, sticky="e")
+        return dialog
+
+    # Saves the rules from the dialog and rescans with them, returns whether they were valid
+    def save_scan_rules(self, exclude, extensions, max_depth, include_hidden, dialog=None):
+        from cleanerrules import save_rules, split_list
+        max_depth = max_depth.strip()
+        if max_depth and not max_depth.isdigit():
+            messagebox.showerror("Scan Rules", "The max folder depth must be a number of levels, or empty for no limit.")
+            return False
+        rules = ScanRules(split_list(exclude), split_list(extensions), int(max_depth) if max_depth else None, include_hidden)
+        try:
+            save_rules(rules)
+        except OSError as error:
+            messagebox.showerror("Scan Rules", "Couldn't save the rules: " + str(error))
+            return False
+        if dialog is not None:
+            dialog.destroy()
+        self.update_file_list(True)
+        return True
+
+    # Returns where to save the profile of an operation when Help > Profile Next Operation is
+    # checked, which it unchecks
+    def take_profile_path(self, operation):
+        if not self.profile_var.get():
+            return None
+        self.profile_var.set(False)
+        self.last_profile = profile_path(operation)
+        return self.last_profile
+
+    def window_mapped(self, event):
+        # <Map> reaches the window for every widget in it, only the window's first one counts
+        if event.widget is not self or self.startup_seconds is not None:
+            return
+        self.startup_seconds = time.perf_counter() - LAUNCHED
+        if os.environ.get("CANDLECLEANER_STARTUP_PROBE"):
+            # Used by cleanerbench --tk to time launches
+            print(format(self.startup_seconds, ".4f"), flush=True)
+            self.after_idle(self.destroy)
+            return
+        if not self.is_unit_test:
+            self.after_idle(self.load_icon)
+
+    def load_icon(self):
+        # Decoded once the window is on screen. Windows reads the .ico itself, elsewhere it goes
+        # through Pillow and the window keeps the default icon when Pillow isn't installed
+        icon_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "icon.ico")
+        try:
+            if sys.platform == "win32":
+                self.iconbitmap(default=icon_path)
+                return
+            from PIL.Image import open as popen
+            from PIL.ImageTk import PhotoImage
+            # Kept on the window, Tk only holds a reference to the image name
+            self.icon_photo = PhotoImage(popen(icon_path))
+            self.iconphoto(True, self.icon_photo)
+        except (ImportError, OSError, tk.TclError):
+            pass
+
+    def show_timings(self):
+        sections = [self.stats[operation].summary() for operation in ("scan", "preview", "rename") if operation in self.stats]
+        if self.startup_seconds is not None:
+            sections.insert(0, "Startup:\n  first window: " + format(self.startup_seconds, ".3f") + "s")
+        if self.last_profile is not None:
+            sections.append("Last profile: " + self.last_profile)
+        messagebox.showinfo("Timings", "\n\n".join(sections) or "Nothing has been timed yet.")
 
     def show_help(self):
         messagebox.showinfo("About", "Mass file renamer, specifically geared toward audio sample libraries.")
 
     def show_source(self):
+        import webbrowser
         webbrowser.open_new_tab("https://github.com/SuluCandles/candlecleaner")
-            
-    def generate_regex(self, filenames, dirname):
-            # Filter out any filenames that are not hidden
-            filenames = [f for f in filenames if not f.startswith(".")]
-            if not filenames:
-                # If all filenames were named .DS_Store, return an empty string
-                return ""
-
-            # Normalize the filenames by replacing spaces, underscores, and hyphens with a common separator,
-            # and removing the file extension from each filename
-            normalized_filenames = [re.sub(r'[ \-_]+', '_', os.path.splitext(f)[0].lower()) for f in filenames]
-            common_prefix = os.path.commonprefix(normalized_filenames)
-            if not common_prefix:
-                common_prefix = "*"
-            else:
-                if self.leading_zero_var.get():
-                    common_prefix = common_prefix.removesuffix('0')
-            prefix_regex = re.escape(common_prefix).replace('\\_', '[ _-]')
-
-            regex = prefix_regex.replace('\\-', '-')
-            # Add the regex and the directory to the regex list
-            self.regex_list.append((regex, dirname))
-
-    def capitalize_string(self, filename):
-        words = filename.split("_")
-        capitalized_words = []
-        if words[0].lower() == "the":
-            words[0] = words[0].capitalize()
-        for word in words:
-            if not (word.lower() in {"and", "the", "of", "or", "a", "an", "in", "to", "for", "with", "on", "at", "by", "but", "nor", "from", "bpm"}):
-                word = word.capitalize()
-            capitalized_words.append(word)
-        output_string = "_".join(capitalized_words)
-        return output_string
-
-    def replace_underscore(self, filename):
-        words = filename.split("_")
-        words = " ".join(words)
-        return words
 
 if __name__ == '__main__':
     # create the application instance
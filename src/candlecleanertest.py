@@ -1,14 +1,36 @@
 import unittest
 import os
 import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+from types import SimpleNamespace
 from unittest.mock import patch
 from candlecleaner import CleanerApp
+from cleanerengine import scan_directory, PatternError
 
 class TestCleanerApp(unittest.TestCase):
     def setUp(self):
+        # Rename journals go to a throwaway home instead of ~/.candlecleaner
+        home = tempfile.mkdtemp()
+        environment = patch.dict(os.environ, {'CANDLECLEANER_HOME': home})
+        environment.start()
+        self.addCleanup(shutil.rmtree, home)
+        self.addCleanup(environment.stop)
         self.app = CleanerApp(True)
+        self.addCleanup(self.stop_pattern_worker)
         self.directory = os.getcwd()
 
+    def stop_pattern_worker(self):
+        if self.app.pattern_worker is not None:
+            self.app.pattern_worker.stop()
+
+    # Scans and renames run on worker threads, pump the Tk event loop until both are done
+    def wait_for_scan(self):
+        while self.app.scanner is not None or self.app.renamer is not None:
+            self.app.update()
+
     def test_select_directory(self):
         with patch('tkinter.filedialog.askdirectory', return_value=self.directory):
             self.app.select_directory()
@@ -25,10 +47,371 @@ class TestCleanerApp(unittest.TestCase):
 
     def test_update_file_list(self):
         self.app.directory_var.set(self.directory)
+        self.wait_for_scan()
         self.app.update_file_list()
         self.assertNotEqual(len(self.app.file_tree.get_children()), 0)
         self.assertNotEqual(len(self.app.updated_file_tree.get_children()), 0)
 
+    def test_new_scan_cancels_running_scan(self):
+        self.app.directory_var.set(self.directory)
+        first_scanner = self.app.scanner
+        self.app.update_file_list(True)
+        self.assertTrue(first_scanner.cancel.is_set())
+        self.assertIsNot(self.app.scanner, first_scanner)
+        self.wait_for_scan()
+        self.assertEqual(len(self.app.file_tree.get_children()), 1)
+        self.assertIsNotNone(self.app.snapshot)
+
+    def test_lazy_folders(self):
+        temp_directory = 'tmp'
+        os.mkdir(temp_directory)
+        os.mkdir(os.path.join(temp_directory, 'subdir1'))
+        open(os.path.join(temp_directory, 'subdir1', 'test_file1.txt'), 'w').close()
+        self.app.virtual_var.set(True)
+        self.app.directory_var.set(os.path.abspath(temp_directory))
+        self.wait_for_scan()
+
+        # The collapsed folder only holds a placeholder until it is opened
+        root = self.app.file_tree.get_children()[0]
+        folder = self.app.file_tree.get_children(root)[0]
+        updated_root = self.app.updated_file_tree.get_children()[0]
+        updated_folder = self.app.updated_file_tree.get_children(updated_root)[0]
+        self.assertFalse(self.app.file_tree.item(folder, 'open'))
+        self.assertEqual(self.app.file_tree.item(self.app.file_tree.get_children(folder)[0], 'text'), 'Loading...')
+
+        # Opening it in one tree lists it in both
+        self.app.file_tree.focus(folder)
+        self.app.file_tree.event_generate("<<TreeviewOpen>>")
+        self.assertTrue(self.app.updated_file_tree.item(updated_folder, 'open'))
+        self.assertEqual(self.app.file_tree.item(self.app.file_tree.get_children(folder)[0], 'text'), 'test_file1.txt')
+        self.assertEqual(len(self.app.updated_file_tree.get_children(updated_folder)), 1)
+
+        shutil.rmtree(temp_directory)
+
+    def test_undo_last_rename(self):
+        temp_directory = 'tmp'
+        os.mkdir(temp_directory)
+        open(os.path.join(temp_directory, 'test_file1.txt'), 'w').close()
+        self.app.directory_var.set(os.path.abspath(temp_directory))
+        self.wait_for_scan()
+        self.app.string_var.set('test_')
+
+        with patch('tkinter.messagebox.showinfo', return_value="ok"):
+            with patch('tkinter.messagebox.askyesno', return_value=True):
+                self.app.rename_files()
+                self.wait_for_scan()
+                self.assertTrue(os.path.exists(os.path.join(temp_directory, 'file1.txt')))
+                self.app.undo_last_rename()
+                self.wait_for_scan()
+
+        self.assertTrue(os.path.exists(os.path.join(temp_directory, 'test_file1.txt')))
+        self.assertFalse(os.path.exists(os.path.join(temp_directory, 'file1.txt')))
+        shutil.rmtree(temp_directory)
+
+    def test_preview_updates_rows_in_place(self):
+        temp_directory = 'tmp'
+        os.mkdir(temp_directory)
+        open(os.path.join(temp_directory, 'test_file1.txt'), 'w').close()
+        self.app.directory_var.set(os.path.abspath(temp_directory))
+        self.wait_for_scan()
+        root = self.app.updated_file_tree.get_children()[0]
+        row = self.app.updated_file_tree.get_children(root)[0]
+
+        # Typing only schedules the preview, update_file_list replans from the snapshot
+        self.app.string_var.set('test_')
+        self.assertIsNotNone(self.app.preview_job)
+        self.app.update_file_list()
+        self.assertIsNone(self.app.preview_job)
+        self.assertEqual(self.app.updated_file_tree.get_children(root), (row,))
+        self.assertEqual(self.app.updated_file_tree.item(row, 'text'), 'file1.txt')
+
+        shutil.rmtree(temp_directory)
+
+    def test_option_toggles_reuse_names(self):
+        temp_directory = 'tmp'
+        os.mkdir(temp_directory)
+        for name in ['Pack_Kick_01.wav', 'Pack_Kick_02.wav']:
+            open(os.path.join(temp_directory, name), 'w').close()
+        self.app.directory_var.set(os.path.abspath(temp_directory))
+        self.wait_for_scan()
+        self.app.smart_update_var.set(True)
+        self.app.update_file_list()
+        path = os.path.abspath(temp_directory)
+        snapshot, stripped = self.app.snapshot, self.app.stages.stripped[path]
+
+        # Neither toggle rescans, casing only reruns over the stripped names
+        self.app.capitalize_var.set(True)
+        self.app.update_file_list()
+        self.assertIs(self.app.stages.stripped[path], stripped)
+        self.assertEqual(sorted(os.path.basename(dst) for src, dst in self.app.plan.renames()), ['01.wav', '02.wav'])
+        self.app.leading_zero_var.set(False)
+        self.app.update_file_list()
+        self.assertIs(self.app.snapshot, snapshot)
+        self.assertIsNone(self.app.scanner)
+        self.assertEqual(sorted(os.path.basename(dst) for src, dst in self.app.plan.renames()), ['1.wav', '2.wav'])
+
+        shutil.rmtree(temp_directory)
+
+    def test_regex_mode(self):
+        temp_directory = 'tmp'
+        os.mkdir(temp_directory)
+        open(os.path.join(temp_directory, 'Loop_120bpm.wav'), 'w').close()
+        self.app.directory_var.set(os.path.abspath(temp_directory))
+        self.wait_for_scan()
+        root = self.app.updated_file_tree.get_children()[0]
+        row = self.app.updated_file_tree.get_children(root)[0]
+
+        self.app.regex_var.set(True)
+        self.app.string_var.set('_(\\d+)bpm')
+        self.app.replace_var.set(' \\1 BPM')
+        self.app.update_file_list()
+        self.assertEqual(self.app.updated_file_tree.item(row, 'text'), 'Loop 120 BPM.wav')
+
+        # A pattern that can't be used leaves the names alone and can't be renamed with
+        self.app.string_var.set('(\\w+)*bpm')
+        self.app.update_file_list()
+        self.assertEqual(self.app.updated_file_tree.item(row, 'text'), 'Loop_120bpm.wav')
+        self.assertIn('repeat inside a repeat', self.app.status_label.cget('text'))
+        self.app.string_var.set('(.|\\w)*_bpm')
+        self.app.update_file_list()
+        self.assertIn('options match the same text', self.app.status_label.cget('text'))
+        self.app.string_var.set('(\\w+)*bpm')
+        self.app.update_file_list()
+        with patch('tkinter.messagebox.showerror') as showerror, patch('tkinter.messagebox.askyesno') as askyesno:
+            self.app.rename_files()
+        showerror.assert_called_once()
+        askyesno.assert_not_called()
+        self.app.string_var.set('_(\\d+)bpm')
+        self.app.update_file_list()
+        self.assertEqual(self.app.status_label.cget('text'), '1 files')
+
+        # A pattern that runs out of time is stopped and isn't matched again on this tree
+        slow_pattern = '.*' * 16 + '='
+        with patch('candlecleaner.PATTERN_BUDGET', 0.2):
+            self.app.replace_var.set('')
+            self.app.string_var.set(slow_pattern)
+            self.app.update_file_list()
+        self.assertEqual(self.app.updated_file_tree.item(row, 'text'), 'Loop_120bpm.wav')
+        self.assertEqual(self.app.status_label.cget('text'), 'Pattern too slow, the preview was stopped')
+        self.assertIn(slow_pattern, self.app.slow_patterns)
+
+        # So does one whose worker stopped
+        with patch('cleanerengine.PatternWorker.targets', side_effect=PatternError('The pattern worker stopped unexpectedly')):
+            self.app.string_var.set('_(\\d+)bpm')
+            self.app.update_file_list()
+        self.assertEqual(self.app.updated_file_tree.item(row, 'text'), 'Loop_120bpm.wav')
+        self.assertEqual(self.app.status_label.cget('text'), 'The pattern worker stopped unexpectedly')
+
+        shutil.rmtree(temp_directory)
+
+    def test_scan_rules(self):
+        temp_directory = os.path.abspath('tmp')
+        for path in ('Kicks/Kick_01.wav', 'Kicks/notes.txt', 'Renders/Mix.wav', '.hidden.wav'):
+            os.makedirs(os.path.dirname(os.path.join(temp_directory, path)), exist_ok=True)
+            open(os.path.join(temp_directory, path), 'w').close()
+        self.app.show_rules_dialog()
+        with patch('tkinter.messagebox.showerror') as showerror:
+            self.assertFalse(self.app.save_scan_rules('', '', 'two', False))
+        showerror.assert_called_once()
+
+        self.assertTrue(self.app.save_scan_rules('Renders', 'wav', '', False))
+        self.app.directory_var.set(temp_directory)
+        self.wait_for_scan()
+        root = self.app.file_tree.get_children()[0]
+        self.assertEqual([self.app.file_tree.item(row, 'text') for row in self.app.file_tree.get_children(root)], ['Kicks'])
+        # Saving rules rescans with them, hidden files are listed and renamed only when included
+        self.app.save_scan_rules('Renders', 'wav', '0', True)
+        self.wait_for_scan()
+        root = self.app.file_tree.get_children()[0]
+        self.assertEqual([self.app.file_tree.item(row, 'text') for row in self.app.file_tree.get_children(root)], ['.hidden.wav'])
+        self.app.string_var.set('hidden')
+        self.app.update_file_list()
+        self.assertEqual([os.path.basename(dst) for src, dst in self.app.plan.renames()], ['..wav'])
+        shutil.rmtree(temp_directory)
+
+    def test_scan_service(self):
+        from cleanerdaemon import DaemonServer, connect_daemon
+        temp_directory = 'tmp'
+        os.mkdir(temp_directory)
+        for name in ['Pack_Kick_01.wav', 'Pack_Kick_02.wav']:
+            open(os.path.join(temp_directory, name), 'w').close()
+        server = DaemonServer()
+        thread = threading.Thread(target=server.serve)
+        thread.start()
+        try:
+            # The directories come from the running service instead of a walk here
+            self.app.smart_update_var.set(True)
+            self.app.directory_var.set(os.path.abspath(temp_directory))
+            self.wait_for_scan()
+            self.assertIn('daemon', self.app.stats['scan'].as_dict()['phases'])
+            self.assertEqual(sorted(os.path.basename(dst) for src, dst in self.app.plan.renames()), ['01.wav', '02.wav'])
+            self.assertEqual(len(server.service.libraries), 1)
+        finally:
+            with connect_daemon() as client:
+                client.request("stop")
+            thread.join(5)
+        shutil.rmtree(temp_directory)
+
+    def test_timings_and_profile(self):
+        temp_directory = 'tmp'
+        os.mkdir(temp_directory)
+        open(os.path.join(temp_directory, 'test_file1.txt'), 'w').close()
+        self.app.profile_var.set(True)
+        self.app.directory_var.set(os.path.abspath(temp_directory))
+        self.wait_for_scan()
+        scan = self.app.stats['scan'].as_dict()
+        self.assertTrue({'walk', 'tree', 'total'} <= set(scan['phases']))
+        self.assertEqual((scan['counters']['files'], scan['counters']['rows_inserted']), (1, 1))
+        self.assertFalse(self.app.profile_var.get())
+        self.assertTrue(os.path.exists(self.app.last_profile))
+
+        self.app.string_var.set('test_')
+        self.app.update_file_list()
+        self.assertEqual(self.app.stats['preview'].counters['rows_updated'], 1)
+        with patch('tkinter.messagebox.showinfo') as showinfo:
+            self.app.show_timings()
+        message = showinfo.call_args[0][1]
+        self.assertIn('Scan:', message)
+        self.assertIn('Preview:', message)
+        self.assertIn('Last profile: ' + self.app.last_profile, message)
+
+        shutil.rmtree(temp_directory)
+
+    def test_startup(self):
+        # Only the window's own first <Map> is the time to first window
+        self.app.window_mapped(SimpleNamespace(widget=self.app.file_tree))
+        self.assertIsNone(self.app.startup_seconds)
+        self.app.window_mapped(SimpleNamespace(widget=self.app))
+        startup = self.app.startup_seconds
+        self.assertGreater(startup, 0)
+        self.app.window_mapped(SimpleNamespace(widget=self.app))
+        self.assertEqual(self.app.startup_seconds, startup)
+        with patch('tkinter.messagebox.showinfo') as showinfo:
+            self.app.show_timings()
+        self.assertIn('first window: ', showinfo.call_args[0][1])
+
+        # Pillow, the browser and the modules for scanning, renaming and watching aren't loaded
+        # before the window opens
+        code = ("import sys, candlecleaner; print(' '.join(name for name in ('PIL', 'webbrowser', 'cProfile', 'cleanercache', "
+                "'cleanerplanfile', 'cleanerrename', 'cleanerwatch') if name in sys.modules))")
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.strip(), '')
+
+    def test_export_plan(self):
+        temp_directory = 'tmp'
+        os.mkdir(temp_directory)
+        open(os.path.join(temp_directory, 'test_file1.txt'), 'w').close()
+        self.app.directory_var.set(os.path.abspath(temp_directory))
+        self.wait_for_scan()
+        self.app.string_var.set('test_')
+        plan_path = os.path.abspath(os.path.join(temp_directory, 'plan.csv'))
+        with patch('tkinter.filedialog.asksaveasfilename', return_value=plan_path):
+            self.app.export_plan()
+        with open(plan_path) as f:
+            self.assertEqual(f.read().splitlines()[1], os.path.abspath(temp_directory) + '/test_file1.txt,' + os.path.abspath(temp_directory) + '/file1.txt,')
+        shutil.rmtree(temp_directory)
+
+    def test_search_and_changed_only(self):
+        temp_directory = os.path.abspath('tmp')
+        for path in ('Kicks/Pack_Kick_01.wav', 'Kicks/Pack_Kick_02.wav', 'Snares/Pack_Snare_01.wav', 'readme.txt'):
+            os.makedirs(os.path.dirname(os.path.join(temp_directory, path)), exist_ok=True)
+            open(os.path.join(temp_directory, path), 'w').close()
+        # Typed with a trailing separator
+        self.app.directory_var.set(temp_directory + os.sep)
+        self.wait_for_scan()
+        self.assertEqual((self.app.snapshot.root, self.app.planned_directories[0].path), (temp_directory, temp_directory))
+        self.app.string_var.set('pack_')
+        self.app.update_file_list()
+
+        def shown(tree):
+            rows = []
+            def walk(item, depth):
+                for child in tree.get_children(item):
+                    rows.append('  ' * depth + tree.item(child, 'text'))
+                    walk(child, depth + 1)
+            walk('', 0)
+            return rows
+
+        # Only the matching files and the folders above them get rows
+        self.app.search_var.set('kick_02')
+        self.assertEqual(shown(self.app.file_tree), ['tmp', '  Kicks', '    Pack_Kick_02.wav'])
+        self.assertEqual(shown(self.app.updated_file_tree), ['tmp', '  Kicks', '    Kick_02.wav'])
+        self.assertEqual(self.app.status_label.cget('text'), '1 matching files')
+        # New names are searched too, and the search follows the preview
+        self.app.search_var.set('snare_01')
+        self.assertEqual(shown(self.app.updated_file_tree), ['tmp', '  Snares', '    Snare_01.wav'])
+        self.app.string_var.set('')
+        self.app.update_file_list()
+        self.assertEqual(shown(self.app.updated_file_tree), ['tmp', '  Snares', '    Pack_Snare_01.wav'])
+
+        self.app.string_var.set('pack_')
+        self.app.update_file_list()
+        self.app.search_var.set('')
+        self.app.changed_only_var.set(True)
+        self.app.apply_filter()
+        self.assertEqual(len(shown(self.app.file_tree)), 6)
+        self.assertNotIn('  readme.txt', shown(self.app.file_tree))
+
+        # Back to every file
+        self.app.changed_only_var.set(False)
+        self.app.apply_filter()
+        self.assertIn('  readme.txt', shown(self.app.file_tree))
+        self.assertFalse(self.app.filtered)
+        shutil.rmtree(temp_directory)
+
+    def test_watch_for_changes(self):
+        temp_directory = os.path.abspath('tmp')
+        for path in ('subdir1/Pack_Kick_01.wav', 'subdir1/Pack_Kick_02.wav', 'subdir2/Pack_Snare_01.wav'):
+            os.makedirs(os.path.dirname(os.path.join(temp_directory, path)), exist_ok=True)
+            open(os.path.join(temp_directory, path), 'w').close()
+        self.app.smart_update_var.set(True)
+        self.app.directory_var.set(temp_directory)
+        self.wait_for_scan()
+        self.app.watch_var.set(True)
+        self.app.toggle_watching()
+        self.assertIsNotNone(self.app.watcher)
+        root = self.app.updated_file_tree.get_children()[0]
+        subdir1, subdir2 = self.app.updated_file_tree.get_children(root)
+        subdir2_rows = self.app.updated_file_tree.get_children(subdir2)
+
+        # Only the changed folder is relisted and gets a new prefix
+        open(os.path.join(temp_directory, 'subdir1', 'Pack_Snare_03.wav'), 'w').close()
+        self.app.apply_directory_changes({os.path.join(temp_directory, 'subdir1')})
+        names = [self.app.updated_file_tree.item(row, 'text') for row in self.app.updated_file_tree.get_children(subdir1)]
+        self.assertEqual(sorted(names), ['kick_01.wav', 'kick_02.wav', 'snare_03.wav'])
+        self.assertEqual(self.app.updated_file_tree.get_children(subdir2), subdir2_rows)
+
+        # New folders are added and deleted ones removed
+        os.mkdir(os.path.join(temp_directory, 'subdir3'))
+        open(os.path.join(temp_directory, 'subdir3', 'Loop_01.wav'), 'w').close()
+        open(os.path.join(temp_directory, 'subdir3', 'Loop_02.wav'), 'w').close()
+        shutil.rmtree(os.path.join(temp_directory, 'subdir2'))
+        self.app.apply_directory_changes({temp_directory})
+        folders = self.app.updated_file_tree.get_children(root)
+        self.assertEqual([self.app.updated_file_tree.item(folder, 'text') for folder in folders], ['subdir1', 'subdir3'])
+        self.assertEqual(sorted(self.app.updated_file_tree.item(row, 'text') for row in self.app.updated_file_tree.get_children(folders[1])), ['01.wav', '02.wav'])
+        self.assertEqual(len(self.app.file_tree.get_children(self.app.file_tree.get_children()[0])), 2)
+        self.assertEqual(self.app.snapshot, scan_directory(temp_directory))
+
+        # A regex is matched in the pattern worker for the changed folders only
+        self.app.smart_update_var.set(False)
+        self.app.regex_var.set(True)
+        self.app.string_var.set('_0(\\d)')
+        self.app.replace_var.set('-\\1')
+        self.app.update_file_list()
+        open(os.path.join(temp_directory, 'subdir1', 'Pack_Hat_04.wav'), 'w').close()
+        with patch.object(self.app, 'pattern_targets', wraps=self.app.pattern_targets) as pattern_targets:
+            self.app.apply_directory_changes({os.path.join(temp_directory, 'subdir1')})
+        self.assertEqual(sorted(pattern_targets.call_args.args[1]), ['Pack_Hat_04.wav', 'Pack_Kick_01.wav', 'Pack_Kick_02.wav', 'Pack_Snare_03.wav'])
+        subdir1 = self.app.updated_file_tree.get_children(root)[0]
+        names = [self.app.updated_file_tree.item(row, 'text') for row in self.app.updated_file_tree.get_children(subdir1)]
+        self.assertEqual(sorted(names), ['Pack_Hat-4.wav', 'Pack_Kick-1.wav', 'Pack_Kick-2.wav', 'Pack_Snare-3.wav'])
+
+        self.app.watch_var.set(False)
+        self.app.toggle_watching()
+        self.assertIsNone(self.app.watcher)
+        shutil.rmtree(temp_directory)
+
     # .
     # ├── .DS_Store
     # ├── .btest_file7.txt
@@ -83,6 +466,7 @@ class TestCleanerApp(unittest.TestCase):
         open('subdir3/.DS_Store', 'w').close()
 
         self.app.directory_var.set(os.getcwd())
+        self.wait_for_scan()
         self.app.string_var.set('test_')
         self.app.update_file_list()
 
@@ -97,40 +481,41 @@ class TestCleanerApp(unittest.TestCase):
         with patch('tkinter.messagebox.showinfo', side_effect=messagebox_callback):
             with patch('tkinter.messagebox.askyesno', side_effect=messagebox_callback):
                 self.app.rename_files()
+                self.wait_for_scan()
 
-        # Check that the files have been renamed correctly
+        # Check that the files have been renamed correctly, hidden files are left out of the scan by default
         self.assertFalse(os.path.exists('test_file1.txt'))
         self.assertFalse(os.path.exists('test_file2.txt'))
         self.assertFalse(os.path.exists('btest_file7.txt'))
-        self.assertFalse(os.path.exists('.test_file1.txt'))
-        self.assertFalse(os.path.exists('.test_file2.txt'))
-        self.assertFalse(os.path.exists('.btest_file7.txt'))
+        self.assertTrue(os.path.exists('.test_file1.txt'))
+        self.assertTrue(os.path.exists('.test_file2.txt'))
+        self.assertTrue(os.path.exists('.btest_file7.txt'))
         self.assertTrue(os.path.exists('file1.txt'))
         self.assertTrue(os.path.exists('file2.txt'))
         self.assertTrue(os.path.exists('bfile7.txt'))
-        self.assertTrue(os.path.exists('.file1.txt'))
-        self.assertTrue(os.path.exists('.file2.txt'))
-        self.assertTrue(os.path.exists('.bfile7.txt'))
+        self.assertFalse(os.path.exists('.file1.txt'))
+        self.assertFalse(os.path.exists('.file2.txt'))
+        self.assertFalse(os.path.exists('.bfile7.txt'))
         self.assertTrue(os.path.exists('.DS_Store'))
 
         self.assertFalse(os.path.exists('subdir1/test_file3.txt'))
         self.assertFalse(os.path.exists('subdir1/test_file4.txt'))
-        self.assertFalse(os.path.exists('subdir1/.test_file3.txt'))
-        self.assertFalse(os.path.exists('subdir1/.test_file4.txt'))
+        self.assertTrue(os.path.exists('subdir1/.test_file3.txt'))
+        self.assertTrue(os.path.exists('subdir1/.test_file4.txt'))
         self.assertTrue(os.path.exists('subdir1/file3.txt'))
         self.assertTrue(os.path.exists('subdir1/file4.txt'))
-        self.assertTrue(os.path.exists('subdir1/.file3.txt'))
-        self.assertTrue(os.path.exists('subdir1/.file4.txt'))
+        self.assertFalse(os.path.exists('subdir1/.file3.txt'))
+        self.assertFalse(os.path.exists('subdir1/.file4.txt'))
         self.assertTrue(os.path.exists('subdir1/.DS_Store'))
 
         self.assertFalse(os.path.exists('subdir2/test_file5.txt'))
         self.assertFalse(os.path.exists('subdir2/test_file6.txt'))
-        self.assertFalse(os.path.exists('subdir2/.test_file5.txt'))
-        self.assertFalse(os.path.exists('subdir2/.test_file6.txt'))  
+        self.assertTrue(os.path.exists('subdir2/.test_file5.txt'))
+        self.assertTrue(os.path.exists('subdir2/.test_file6.txt'))  
         self.assertTrue(os.path.exists('subdir2/file5.txt'))
         self.assertTrue(os.path.exists('subdir2/file6.txt'))      
-        self.assertTrue(os.path.exists('subdir2/.file5.txt'))
-        self.assertTrue(os.path.exists('subdir2/.file6.txt'))
+        self.assertFalse(os.path.exists('subdir2/.file5.txt'))
+        self.assertFalse(os.path.exists('subdir2/.file6.txt'))
         self.assertTrue(os.path.exists('subdir2/.DS_Store'))
 
         self.assertTrue(os.path.exists('subdir3/.DS_Store'))
@@ -191,6 +576,7 @@ class TestCleanerApp(unittest.TestCase):
         open('subdir3/.DS_Store', 'w').close()
 
         self.app.directory_var.set(os.getcwd())
+        self.wait_for_scan()
         self.app.update_file_list()
         self.app.smart_update_var.set(True)
 
@@ -205,40 +591,41 @@ class TestCleanerApp(unittest.TestCase):
         with patch('tkinter.messagebox.showinfo', side_effect=messagebox_callback):
             with patch('tkinter.messagebox.askyesno', side_effect=messagebox_callback):
                 self.app.rename_files()
+                self.wait_for_scan()
 
-        # Check that the files have been renamed correctly
+        # Check that the files have been renamed correctly, hidden files are left out of the scan by default
         self.assertFalse(os.path.exists('test_cool1.txt'))
         self.assertFalse(os.path.exists('test_sad2.txt'))
-        self.assertFalse(os.path.exists('.test_cool1.txt'))
-        self.assertFalse(os.path.exists('.test_sad2.txt'))
-        self.assertFalse(os.path.exists('.test_really7.txt'))
+        self.assertTrue(os.path.exists('.test_cool1.txt'))
+        self.assertTrue(os.path.exists('.test_sad2.txt'))
+        self.assertTrue(os.path.exists('.test_really7.txt'))
         self.assertFalse(os.path.exists('test_really7.txt'))
         self.assertFalse(os.path.exists('really7.txt'))
         self.assertTrue(os.path.exists('cool1.txt'))
         self.assertTrue(os.path.exists('sad2.txt'))
-        self.assertTrue(os.path.exists('.cool1.txt'))
-        self.assertTrue(os.path.exists('.sad2.txt'))
-        self.assertTrue(os.path.exists('.really7.txt'))
+        self.assertFalse(os.path.exists('.cool1.txt'))
+        self.assertFalse(os.path.exists('.sad2.txt'))
+        self.assertFalse(os.path.exists('.really7.txt'))
         self.assertTrue(os.path.exists('.DS_Store'))
 
         self.assertFalse(os.path.exists('subdir1/test_mellow3.txt'))
         self.assertFalse(os.path.exists('subdir1/test_wild4.txt'))
-        self.assertFalse(os.path.exists('subdir1/.test_mellow3.txt'))
-        self.assertFalse(os.path.exists('subdir1/.test_wild4.txt'))
+        self.assertTrue(os.path.exists('subdir1/.test_mellow3.txt'))
+        self.assertTrue(os.path.exists('subdir1/.test_wild4.txt'))
         self.assertTrue(os.path.exists('subdir1/mellow3.txt'))
         self.assertTrue(os.path.exists('subdir1/wild4.txt'))
-        self.assertTrue(os.path.exists('subdir1/.mellow3.txt'))
-        self.assertTrue(os.path.exists('subdir1/.wild4.txt'))
+        self.assertFalse(os.path.exists('subdir1/.mellow3.txt'))
+        self.assertFalse(os.path.exists('subdir1/.wild4.txt'))
         self.assertTrue(os.path.exists('subdir1/.DS_Store'))
 
         self.assertFalse(os.path.exists('subdir2/test_weird5.txt'))
         self.assertFalse(os.path.exists('subdir2/test_normal6.txt'))
-        self.assertFalse(os.path.exists('subdir2/.test_weird5.txt'))
-        self.assertFalse(os.path.exists('subdir2/.test_normal6.txt'))  
+        self.assertTrue(os.path.exists('subdir2/.test_weird5.txt'))
+        self.assertTrue(os.path.exists('subdir2/.test_normal6.txt'))  
         self.assertTrue(os.path.exists('subdir2/weird5.txt'))
         self.assertTrue(os.path.exists('subdir2/normal6.txt'))      
-        self.assertTrue(os.path.exists('subdir2/.weird5.txt'))
-        self.assertTrue(os.path.exists('subdir2/.normal6.txt'))
+        self.assertFalse(os.path.exists('subdir2/.weird5.txt'))
+        self.assertFalse(os.path.exists('subdir2/.normal6.txt'))
         self.assertTrue(os.path.exists('subdir2/.DS_Store'))
 
         self.assertTrue(os.path.exists('subdir3/.DS_Store'))
@@ -0,0 +1,127 @@
+###################################################################################################
+# cleanerbatch.py
+#
+# Plans or renames many libraries at once with the same options, one worker process per library,
+# or per top level folder with split, so scanning, normalizing and regex generation use every core.
+# Each worker plans its folders with plan_directory, so the names come out exactly as they would
+# one library at a time. The results are merged into a single report.
+#
+###################################################################################################
+
+import hashlib
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from cleanerengine import ScanFilter, ScanRules, iter_scan, list_directory, plan_directory
+from cleanerplanfile import plan_rows, write_plan_file
+from cleanerrename import DEFAULT_WORKERS, RenameExecutor, default_journal_path
+
+# A folder for one worker, with or without its subfolders. relative is its path within the library
+# for the ScanRules
+BatchTask = namedtuple('BatchTask', ['path', 'recursive', 'relative'], defaults=[""])
+
+# What a worker did, failures are (source, target, message) so the result pickles and serializes
+BatchResult = namedtuple('BatchResult', ['path', 'directories', 'files', 'renames', 'renamed', 'failures', 'journal',
+                                         'plan_file', 'seconds', 'error'])
+
+def overlapping_roots(roots):
+    # Pairs of roots where one is inside the other, their files would be renamed twice
+    paths = sorted(os.path.join(os.path.realpath(root), "") for root in roots)
+    return [(first, second) for first, second in zip(paths, paths[1:]) if second.startswith(first)]
+
+def batch_tasks(roots, split=False, rules=None):
+    # One task per root, or with split one for the files of each root and one per top level folder
+    # the rules don't exclude. Roots are made absolute, so plan files can be applied from anywhere
+    tasks = []
+    for root in map(os.path.abspath, roots):
+        if not split:
+            tasks.append(BatchTask(root, True))
+            continue
+        tasks.append(BatchTask(root, False))
+        listed = list_directory(root, 0, None, ScanFilter(rules or ScanRules()))
+        if listed is not None:
+            directory, subdirectories = listed
+            tasks.extend(BatchTask(os.path.join(root, name), True, name + "/") for name, inode in subdirectories)
+    return tasks
+
+def task_directories(task, rules=None):
+    if task.recursive:
+        return iter_scan(task.path, rules=rules, relative=task.relative)
+    listed = list_directory(task.path, 0, None, ScanFilter(rules or ScanRules()), task.relative)
+    return [] if listed is None else [listed[0]]
+
+def plan_file_path(plans_directory, task):
+    key = hashlib.sha1(os.path.abspath(task.path).encode("utf-8", "surrogateescape")).hexdigest()[:12]
+    return os.path.join(plans_directory, os.path.basename(task.path.rstrip(os.sep)) + "-" + key + ".jsonl")
+
+def run_task(task, options, apply=False, workers=DEFAULT_WORKERS, plans_directory=None, rules=None):
+    # Runs in a worker process, any error is returned instead of raised so one bad library
+    # doesn't stop the batch
+    start = time.perf_counter()
+    counts = {"directories": 0, "files": 0}
+
+    def planned():
+        for directory in task_directories(task, rules):
+            counts["directories"] += 1
+            counts["files"] += len(directory.files)
+            yield plan_directory(directory, options)
+
+    renames = 0
+    renamed = 0
+    failures = []
+    journal = None
+    plan_file = None
+    try:
+        if apply:
+            steps = [(row.src, row.dst) for row in plan_rows(planned())]
+            renames = len(steps)
+            if steps:
+                journal = default_journal_path()
+                report = RenameExecutor(steps, workers, journal_path=journal).run()
+                renamed = report.renamed
+                failures = [(failure.source, failure.target, failure.error.strerror or str(failure.error)) for failure in report.failures]
+        elif plans_directory:
+            plan_file = plan_file_path(plans_directory, task)
+            renames = write_plan_file(planned(), plan_file)
+        else:
+            renames = sum(1 for row in plan_rows(planned()))
+    except Exception as error:
+        return BatchResult(task.path, counts["directories"], counts["files"], renames, renamed, failures, journal,
+                           plan_file, time.perf_counter() - start, str(error))
+    return BatchResult(task.path, counts["directories"], counts["files"], renames, renamed, failures, journal,
+                       plan_file, time.perf_counter() - start, None)
+
+def run_batch(roots, options, apply=False, processes=None, split=False, workers=DEFAULT_WORKERS, plans_directory=None, rules=None):
+    # Returns the BatchResults in task order
+    tasks = batch_tasks(roots, split, rules)
+    if plans_directory:
+        os.makedirs(plans_directory, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = [pool.submit(run_task, task, options, apply, workers, plans_directory, rules) for task in tasks]
+        return [future.result() for future in futures]
+
+def batch_report(results, seconds=None):
+    # The merged report as a dictionary ready for json
+    totals = {name: sum(getattr(result, name) for result in results) for name in ("directories", "files", "renames", "renamed")}
+    totals["failures"] = sum(len(result.failures) for result in results)
+    totals["errors"] = sum(1 for result in results if result.error)
+    report = {"totals": totals, "libraries": [result._asdict() for result in results]}
+    if seconds is not None:
+        report["seconds"] = seconds
+    return report
+
+def batch_summary(results, apply=False):
+    lines = []
+    for result in results:
+        if result.error:
+            lines.append(f"{result.path}: failed, {result.error}")
+        elif apply:
+            lines.append(f"{result.path}: {result.renamed} of {result.renames} files renamed in {result.seconds:.2f}s")
+        else:
+            lines.append(f"{result.path}: {result.renames} of {result.files} files would be renamed")
+        lines.extend(f"  Couldn't rename {source}: {message}" for source, target, message in result.failures)
+    totals = batch_report(results)["totals"]
+    done = f"{totals['renamed']} files renamed" if apply else f"{totals['renames']} files would be renamed"
+    lines.append(f"{len(results)} jobs, {totals['files']} files, {done}, {totals['failures']} failures, {totals['errors']} errors")
+    return "\n".join(lines)
@@ -0,0 +1,53 @@
+import unittest
+import io
+import json
+import os
+import shutil
+import tempfile
+from unittest.mock import patch
+from cleanerengine import CleanerOptions, scan_directory, build_plan
+from cleanerbatch import batch_tasks, overlapping_roots, run_batch
+from cleanercli import main
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.environ = patch.dict(os.environ, {"CANDLECLEANER_HOME": os.path.join(self.directory, "home")})
+        self.environ.start()
+        self.roots = [os.path.join(self.directory, name) for name in ('Pack A', 'Pack B')]
+        for path in ('Pack A/PackA_Kick_01.wav', 'Pack A/PackA_Kick_02.wav', 'Pack A/Snares/PackA_Snare_01.wav',
+                     'Pack A/Snares/PackA_Snare_02.wav', 'Pack B/Loops/PackB_Loop_01.wav', 'Pack B/Loops/PackB_Loop_02.wav'):
+            full_path = os.path.join(self.directory, path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            open(full_path, 'w').close()
+
+    def tearDown(self):
+        self.environ.stop()
+        shutil.rmtree(self.directory)
+
+    def test_tasks(self):
+        self.assertEqual(len(batch_tasks(self.roots)), 2)
+        self.assertEqual([(os.path.basename(task.path), task.recursive) for task in batch_tasks(self.roots, split=True)],
+                         [('Pack A', False), ('Snares', True), ('Pack B', False), ('Loops', True)])
+        self.assertEqual(len(overlapping_roots(self.roots + [os.path.join(self.roots[0], 'Snares')])), 1)
+
+    def test_plan_matches_single_library(self):
+        options = CleanerOptions(smart_update=True)
+        expected = sum(len(list(build_plan(scan_directory(root), options).renames())) for root in self.roots)
+        for split in (False, True):
+            results = run_batch(self.roots, options, processes=2, split=split)
+            self.assertEqual(sum(result.renames for result in results), expected)
+            self.assertEqual(sum(result.files for result in results), 6)
+            self.assertEqual([result.error for result in results], [None] * len(results))
+
+    def test_cli_apply(self):
+        report_path = os.path.join(self.directory, 'report.json')
+        self.assertEqual(main(['batch', *self.roots, '--smart', '--apply', '--processes', '2', '--report', report_path], io.StringIO()), 0)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.roots[1], 'Loops'))), ['01.wav', '02.wav'])
+        with open(report_path) as f:
+            report = json.load(f)
+        self.assertEqual((report['totals']['renamed'], report['totals']['failures']), (6, 0))
+        self.assertEqual(len(report['libraries']), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,257 @@
+###################################################################################################
+# cleanerbench.py
+#
+# Benchmarks for candlecleaner on generated sample libraries. Builds deep or wide trees of empty
+# files named like real packs (Candle_Dusk_Kick_01.wav), times every phase from the scan to the
+# rename, optionally through the Tk window too along with the time to launch it, and writes the
+# results as JSON. A previous results file can be passed as a baseline to fail the run when a phase
+# got slower.
+#
+#     python cleanerbench.py --sizes 1k 100k --shapes deep wide --output results.json
+#     python cleanerbench.py --sizes 1k --baseline results.json --tolerance 0.25
+#
+###################################################################################################
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from unittest.mock import patch
+import cleanerengine
+from cleanerengine import SNAPSHOT_BYTES_PER_FILE, CleanerOptions, scan_directory, build_regex_index, build_plan, StageCache
+from cleanercache import MTIME_SLACK, ScanCache
+from cleanerrename import RenameExecutor, undo_executor
+
+RESULTS_VERSION = 1
+
+PACK_WORDS = ["Candle", "Dusk", "Velvet", "Lofi", "Analog", "Neon", "Dusty", "Tape", "Vinyl", "Midnight", "Gold", "Smoke"]
+CATEGORIES = ["Kick", "Snare", "Hat", "Clap", "Perc", "Loop", "FX", "Bass", "Vox", "Keys"]
+
+# Files per folder and folder nesting of each shape
+SHAPES = {
+    "wide": {"files_per_folder": 250, "depth": 1},
+    "deep": {"files_per_folder": 8, "depth": 8},
+    "nested": {"files_per_folder": 8, "depth": 32},
+}
+
+# Phases that don't change the library are run this many times and the fastest run is kept
+DEFAULT_REPEAT = 3
+
+def parse_size(text):
+    # 1000, 1k or 1m
+    text = text.lower()
+    multiplier = {"k": 1000, "m": 1000000}.get(text[-1:], 1)
+    return int(text.rstrip("km")) * multiplier
+
+def library_files(file_count, shape, seed=0):
+    # Yield the relative paths of a generated library, the same paths for the same arguments
+    settings = SHAPES[shape]
+    rng = random.Random(seed)
+    pack = 0
+    produced = 0
+    while produced < file_count:
+        pack_name = rng.choice(PACK_WORDS) + "_" + rng.choice(PACK_WORDS)
+        pack_folder = pack_name.replace("_", " ") + " " + str(pack + 1)
+        for category in CATEGORIES:
+            folder = os.path.join(pack_folder, category + "s")
+            for level in range(settings["depth"]):
+                if level:
+                    folder = os.path.join(folder, category + " " + str(level))
+                for number in range(1, settings["files_per_folder"] + 1):
+                    if produced == file_count:
+                        return
+                    yield os.path.join(folder, pack_name + "_" + category + "_" + str(number).zfill(2) + ".wav")
+                    produced += 1
+        pack += 1
+
+def make_library(root, file_count, shape, seed=0):
+    made = set()
+    for path in library_files(file_count, shape, seed):
+        full_path = os.path.join(root, path)
+        folder = os.path.dirname(full_path)
+        if folder not in made:
+            os.makedirs(folder, exist_ok=True)
+            made.add(folder)
+        open(full_path, "w").close()
+    # Folders changed within MTIME_SLACK are listed again by every cached scan, a real library's
+    # were changed long before it is scanned
+    aged = time.time() - MTIME_SLACK - 60
+    for dirpath, dirnames, filenames in os.walk(root):
+        os.utime(dirpath, (aged, aged))
+
+def timed(function, repeat=1):
+    # Returns (fastest time in seconds, result of the last run)
+    best = None
+    result = None
+    for run in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def scan_cached(root):
+    # (snapshot, cache) of a scan with the cache saved for root
+    cache = ScanCache.load(root)
+    return scan_directory(root, cache=cache), cache
+
+def run_tk(root, phases):
+    # Time the same work through the window, skipped when Tk can't open one
+    try:
+        from candlecleaner import CleanerApp
+        app = CleanerApp(True)
+    except Exception as error:
+        return "skipped: " + str(error).splitlines()[0]
+    try:
+        start = time.perf_counter()
+        app.directory_var.set(root)
+        while app.scanner is not None:
+            app.update()
+        phases["tk_scan_preview"] = time.perf_counter() - start
+        app.smart_update_var.set(True)
+        phases["tk_smart_preview"], result = timed(app.update_file_list)
+        app.smart_update_var.set(False)
+        app.string_var.set("_")
+        phases["tk_text_preview"], result = timed(app.update_file_list)
+        app.update()
+    finally:
+        app.destroy()
+    return "ok"
+
+def measure_startup(repeat=DEFAULT_REPEAT):
+    # Launch the window repeat times, each closing itself as soon as it is mapped. Returns the
+    # fastest {"launch": seconds until the process exited, "first_window": seconds from launch to the
+    # window being mapped}, or why it was skipped
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "candlecleaner.py")
+    environment = dict(os.environ, CANDLECLEANER_STARTUP_PROBE="1")
+    launches = []
+    windows = []
+    for run in range(repeat):
+        start = time.perf_counter()
+        try:
+            result = subprocess.run([sys.executable, script], env=environment, capture_output=True, text=True, timeout=60)
+        except subprocess.TimeoutExpired:
+            return "skipped: the window didn't open within a minute"
+        launches.append(time.perf_counter() - start)
+        try:
+            windows.append(float(result.stdout.split()[-1]))
+        except (ValueError, IndexError):
+            lines = (result.stderr or result.stdout).strip().splitlines()
+            return "skipped: " + (lines[-1] if lines else "no window")
+    return {"launch": min(launches), "first_window": min(windows)}
+
+def run_benchmark(root, file_count, shape, repeat=DEFAULT_REPEAT, tk=False, seed=0):
+    phases = {}
+    start = time.perf_counter()
+    make_library(root, file_count, shape, seed)
+    phases["generate"] = time.perf_counter() - start
+
+    phases["scan"], snapshot = timed(lambda: scan_directory(root), repeat)
+    # The same scan and rename with full paths instead of folder handles, for comparison
+    with patch.object(cleanerengine, "USE_DIR_FD", False):
+        phases["scan_paths"], path_snapshot = timed(lambda: scan_directory(root), repeat)
+    # Loading the cache and scanning with it is timed apart from saving it
+    snapshot, cache = scan_cached(root)
+    phases["cache_save"], result = timed(cache.save, repeat)
+    phases["scan_cached"], (snapshot, cache) = timed(lambda: scan_cached(root), repeat)
+    phases["regex"], regex_index = timed(lambda: build_regex_index(snapshot), repeat)
+    smart = CleanerOptions(smart_update=True, capitalize=True, underscore=True)
+    phases["preview_smart"], plan = timed(lambda: build_plan(snapshot, smart, regex_index), repeat)
+    # Toggling an option in the window replans from the names kept in a StageCache
+    stages = StageCache()
+    build_plan(snapshot, smart, stages.regex_index(snapshot), stages=stages)
+    phases["preview_toggle"], toggled_plan = timed(lambda: build_plan(snapshot, smart._replace(capitalize=False), regex_index, stages=stages), repeat)
+    phases["preview_text"], text_plan = timed(lambda: build_plan(snapshot, CleanerOptions(string_to_remove="_")), repeat)
+
+    tk_status = run_tk(root, phases) if tk else "off"
+
+    # Renamed and put back, so the library ends up as it was generated
+    renames = list(plan.renames())
+    journal = root + ".journal.jsonl"
+    phases["rename"], report = timed(RenameExecutor(renames, journal_path=journal).run)
+    phases["undo"], undo_report = timed(undo_executor(journal, undo_journal_path=journal + ".undo").run)
+    with patch.object(cleanerengine, "USE_DIR_FD", False):
+        phases["rename_paths"], path_report = timed(RenameExecutor(renames, journal_path=journal + ".paths").run)
+        phases["undo_paths"], path_undo_report = timed(undo_executor(journal + ".paths", undo_journal_path=journal + ".paths.undo").run)
+
+    return {"files": len(snapshot), "directories": len(snapshot.directories), "shape": shape, "size": file_count,
+            "cache_hits": cache.hits, "renamed": report.renamed,
+            "rename_failures": sum(len(each.failures) for each in (report, undo_report, path_report, path_undo_report)),
+            "snapshot_bytes_per_file": round(snapshot.memory_size() / max(1, len(snapshot)), 1),
+            "tk": tk_status, "phases": phases}
+
+def find_regressions(results, baseline, tolerance):
+    # Phases at least tolerance (0.25 = 25%) slower than the same size and shape in the baseline
+    previous = {(result["size"], result["shape"]): result["phases"] for result in baseline.get("results", [])}
+    regressions = []
+    old_startup = baseline.get("startup")
+    new_startup = results.get("startup")
+    if isinstance(old_startup, dict) and isinstance(new_startup, dict):
+        for name, elapsed in new_startup.items():
+            old = old_startup.get(name)
+            if old and elapsed > old * (1 + tolerance):
+                regressions.append(f"startup {name}: {old:.3f}s -> {elapsed:.3f}s")
+    for result in results["results"]:
+        old_phases = previous.get((result["size"], result["shape"]), {})
+        for phase, elapsed in result["phases"].items():
+            old = old_phases.get(phase)
+            if phase != "generate" and old and elapsed > old * (1 + tolerance):
+                regressions.append(f"{result['shape']} {result['size']} {phase}: {old:.3f}s -> {elapsed:.3f}s")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark candlecleaner on generated sample libraries.")
+    parser.add_argument("--sizes", nargs="+", default=["1k"], help="file counts to generate, like 1k 100k 1m")
+    parser.add_argument("--shapes", nargs="+", default=list(SHAPES), choices=list(SHAPES), help="folder shapes to generate")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="runs of each read-only phase, the fastest is kept")
+    parser.add_argument("--tk", action="store_true", help="also time launching the Tk window and the preview through it")
+    parser.add_argument("--workdir", help="where to generate the libraries, a temporary directory by default")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="slowdown over the baseline that counts as a regression")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="candlecleaner-bench-", dir=args.workdir)
+    results = {"version": RESULTS_VERSION, "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+               "platform": platform.platform(), "results": []}
+    if args.tk:
+        results["startup"] = measure_startup(max(1, args.repeat))
+        sys.stderr.write(f"startup: {results['startup']}\n")
+    try:
+        # Scan caches and journals stay inside the work directory
+        with patch.dict(os.environ, {"CANDLECLEANER_HOME": os.path.join(workdir, "home")}):
+            for size in map(parse_size, args.sizes):
+                for shape in args.shapes:
+                    root = os.path.join(workdir, shape + "-" + str(size))
+                    result = run_benchmark(root, size, shape, max(1, args.repeat), args.tk)
+                    results["results"].append(result)
+                    phases = ", ".join(f"{phase} {elapsed:.3f}s" for phase, elapsed in result["phases"].items())
+                    sys.stderr.write(f"{shape} {size}: {phases}, snapshot {result['snapshot_bytes_per_file']} bytes per file"
+                                     f" (target {SNAPSHOT_BYTES_PER_FILE})\n")
+                    shutil.rmtree(root)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = find_regressions(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            sys.stderr.write("Slower than the baseline: " + regression + "\n")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
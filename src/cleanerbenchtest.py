@@ -0,0 +1,68 @@
+import unittest
+import os
+import shutil
+import tempfile
+from unittest.mock import patch
+from cleanerengine import SNAPSHOT_BYTES_PER_FILE, ScanEntry, ScannedDirectory, Snapshot
+from cleanerbench import library_files, make_library, parse_size, run_benchmark, find_regressions
+
+class TestBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.environ = patch.dict(os.environ, {"CANDLECLEANER_HOME": os.path.join(self.directory, "home")})
+        self.environ.start()
+
+    def tearDown(self):
+        self.environ.stop()
+        shutil.rmtree(self.directory)
+
+    def test_library_files(self):
+        self.assertEqual(parse_size('100k'), 100000)
+        for shape in ('wide', 'deep', 'nested'):
+            paths = list(library_files(300, shape))
+            self.assertEqual(len(set(paths)), 300)
+            self.assertEqual(paths, list(library_files(300, shape)))
+        self.assertRegex(os.path.basename(paths[0]), r'^[A-Za-z]+_[A-Za-z]+_Kick_01\.wav$')
+
+    def test_run_benchmark(self):
+        root = os.path.join(self.directory, 'library')
+        result = run_benchmark(root, 300, 'deep', repeat=1)
+        self.assertEqual((result['files'], result['renamed'], result['rename_failures']), (300, 300, 0))
+        self.assertIn('preview_smart', result['phases'])
+        self.assertIn('scan_paths', result['phases'])
+        self.assertIn('preview_toggle', result['phases'])
+        # Every folder of the generated tree is old enough for the cached scan to reuse
+        self.assertEqual(result['cache_hits'], result['directories'])
+        self.assertIn('cache_save', result['phases'])
+        self.assertIn('snapshot_bytes_per_file', result)
+        # The renames are undone, so the library is as generated
+        generated = os.path.join(self.directory, 'generated')
+        make_library(generated, 300, 'deep')
+        self.assertEqual(sorted(os.path.relpath(os.path.join(dirpath, name), root) for dirpath, dirnames, filenames in os.walk(root) for name in filenames),
+                         sorted(os.path.relpath(os.path.join(dirpath, name), generated) for dirpath, dirnames, filenames in os.walk(generated) for name in filenames))
+
+    def test_snapshot_memory(self):
+        # Built from the generated paths without touching the disk, the size of a real scan
+        for shape in ('wide', 'deep', 'nested'):
+            files = {}
+            for path in library_files(20000, shape):
+                files.setdefault(os.path.join('/library', os.path.dirname(path)), []).append(ScanEntry(os.path.basename(path), 0, False, len(files)))
+            directories = [ScannedDirectory('/library', 1, (), ())]
+            directories.extend(ScannedDirectory(path, index, (), tuple(entries)) for index, (path, entries) in enumerate(files.items()))
+            snapshot = Snapshot('/library', directories)
+            self.assertEqual(list(snapshot.directories), directories)
+            self.assertLessEqual(snapshot.memory_size() / len(snapshot), SNAPSHOT_BYTES_PER_FILE)
+
+    def test_find_regressions(self):
+        baseline = {"results": [{"size": 1000, "shape": "wide", "phases": {"scan": 1.0, "regex": 1.0}}]}
+        results = {"results": [{"size": 1000, "shape": "wide", "phases": {"scan": 1.1, "regex": 2.0, "undo": 1.0}}]}
+        self.assertEqual(find_regressions(results, baseline, 0.25), ['wide 1000 regex: 1.000s -> 2.000s'])
+        baseline["startup"] = {"launch": 0.5, "first_window": 0.2}
+        results["startup"] = {"launch": 0.5, "first_window": 0.4}
+        self.assertEqual(find_regressions(results, baseline, 0.25)[0], 'startup first_window: 0.200s -> 0.400s')
+        # A skipped measurement is not compared
+        results["startup"] = "skipped: no display"
+        self.assertEqual(len(find_regressions(results, baseline, 0.25)), 1)
+
+if __name__ == '__main__':
+    unittest.main()
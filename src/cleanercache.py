@@ -0,0 +1,150 @@
+###################################################################################################
+# cleanercache.py
+#
+# Keeps the scan of a library on disk between runs, one file per library under
+# ~/.candlecleaner/cache, and one per set of ScanRules it was scanned with. Every directory is stored with its mtime and link count, its listing and
+# the prefixes of its file names, once they were asked for. When the library is scanned again each directory is only
+# stat'ed; directories whose mtime and link count didn't move are taken from the cache instead of
+# being listed and having every file stat'ed. The cache directory is kept under a size limit by
+# dropping the least recently used libraries.
+#
+###################################################################################################
+
+import hashlib
+import json
+import os
+import time
+from collections import namedtuple
+from cleanerengine import data_directory, ScanRules, ScanEntry, ScannedDirectory, list_directory, prefix_clusters
+
+# Bumped whenever the file format changes, older files are ignored
+CACHE_VERSION = 4
+
+# Total size of the cache directory before the least recently used libraries are evicted
+CACHE_LIMIT = 256 * 1024 * 1024
+
+# A directory changed less than this many seconds before it was listed may change again within the
+# same mtime tick, so it is listed again on the next scan
+MTIME_SLACK = 2
+
+# A cached directory. mtime_ns is None when it can't be trusted, subdirectories are the
+# (name, inode) pairs the scan descends into, prefixes is PREFIXES_PENDING until they are asked for
+CachedDirectory = namedtuple('CachedDirectory', ['mtime_ns', 'nlink', 'directory', 'subdirectories', 'prefixes'])
+
+# prefix_clusters itself gives None or a list
+PREFIXES_PENDING = False
+
+def cache_path(root, rules=None):
+    key = os.path.abspath(root)
+    if rules is not None and rules != ScanRules():
+        # Listings only hold what the rules took in, so other rules get their own file
+        key += "\0" + repr(tuple(rules))
+    key = hashlib.sha1(key.encode("utf-8", "surrogateescape")).hexdigest()
+    return os.path.join(data_directory("cache"), key + ".json")
+
+def evict(limit=CACHE_LIMIT, keep=None):
+    # Remove the least recently used cache files until the directory fits in limit
+    directory = data_directory("cache")
+    files = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for mtime, size, path in files)
+    for mtime, size, path in sorted(files):
+        if total <= limit:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+
+class ScanCache:
+    # Pass an instance as the cache of iter_scan. Only the directories seen by the last scan are
+    # saved, so deleted folders drop out of the cache
+    def __init__(self, root, directories=None, rules=None):
+        self.root = root
+        self.path = cache_path(root, rules)
+        self.directories = directories or {}
+        self.seen = {}
+        self.hits = 0
+        self.misses = 0
+        self.listed_files = 0
+
+    @classmethod
+    def load(cls, root, rules=None):
+        path = cache_path(root, rules)
+        try:
+            with open(path, encoding="utf-8") as file:
+                data = json.load(file)
+            if data.get("version") != CACHE_VERSION or data.get("root") != root:
+                return cls(root, rules=rules)
+            directories = {}
+            for dirpath, mtime_ns, nlink, inode, dirnames, files, subdirectories, prefixes in data["directories"]:
+                directory = ScannedDirectory(dirpath, inode, tuple(dirnames),
+                                             tuple(ScanEntry(name, size, False, file_inode) for name, size, file_inode in files))
+                directories[dirpath] = CachedDirectory(mtime_ns, nlink, directory, tuple(map(tuple, subdirectories)), prefixes)
+            # Touching the file marks the library as recently used for eviction
+            os.utime(path)
+        except (OSError, ValueError, KeyError, TypeError):
+            # A missing, old or damaged cache is rebuilt by the scan
+            return cls(root, rules=rules)
+        return cls(root, directories, rules)
+
+    # Called by iter_scan, the scan_filter must be the one of the rules the cache was loaded for
+    def list_directory(self, dirpath, inode, fd=None, scan_filter=None, relative=""):
+        try:
+            stat = os.stat(dirpath if fd is None else fd)
+        except OSError:
+            return None
+        cached = self.directories.get(dirpath)
+        if (cached is not None and cached.mtime_ns is not None and cached.mtime_ns == stat.st_mtime_ns
+                and cached.nlink == stat.st_nlink and cached.directory.inode == stat.st_ino):
+            self.hits += 1
+            self.seen[dirpath] = cached
+            return cached.directory, cached.subdirectories
+        self.misses += 1
+        listed = list_directory(dirpath, stat.st_ino, fd, scan_filter, relative)
+        if listed is not None:
+            directory, subdirectories = listed
+            self.listed_files += len(directory.files)
+            mtime_ns = stat.st_mtime_ns if time.time() - stat.st_mtime > MTIME_SLACK else None
+            self.seen[dirpath] = CachedDirectory(mtime_ns, stat.st_nlink, directory, subdirectories, PREFIXES_PENDING)
+        return listed
+
+    # The prefix_clusters of every directory of the last scan, for build_regex_index. The ones not
+    # known yet are worked out and kept for save, unless compute is false and they are left out
+    def prefixes(self, compute=True):
+        prefixes = {}
+        for dirpath, cached in self.seen.items():
+            if cached.prefixes is PREFIXES_PENDING:
+                if not compute:
+                    continue
+                cached = self.seen[dirpath] = cached._replace(prefixes=prefix_clusters([file.name for file in cached.directory.files]))
+            prefixes[dirpath] = cached.prefixes
+        return prefixes
+
+    def save(self, limit=CACHE_LIMIT):
+        data = {"version": CACHE_VERSION, "root": self.root, "directories": [
+            [dirpath, cached.mtime_ns, cached.nlink, cached.directory.inode, cached.directory.dirnames,
+             [[file.name, file.size, file.inode] for file in cached.directory.files], cached.subdirectories, cached.prefixes]
+            for dirpath, cached in self.seen.items()]}
+        # Written next to the old file and moved over it, so a second instance never reads half a cache
+        temp = self.path + "." + str(os.getpid()) + ".tmp"
+        try:
+            with open(temp, "w", encoding="utf-8") as file:
+                json.dump(data, file, separators=(",", ":"))
+            os.replace(temp, self.path)
+        except OSError:
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+            return
+        evict(limit, keep=self.path)
@@ -0,0 +1,115 @@
+import unittest
+import os
+import shutil
+import tempfile
+from unittest.mock import patch
+from cleanerengine import ScanRules, scan_directory, build_regex_index, prefix_clusters
+from cleanercache import ScanCache, cache_path, evict
+
+class TestScanCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.home = tempfile.mkdtemp()
+        self.environ = patch.dict(os.environ, {"CANDLECLEANER_HOME": self.home})
+        self.environ.start()
+        for path in ('Pack_Kick_01.wav', 'Pack_Kick_02.wav', 'drums/Pack_Snare_01.wav', 'drums/Pack_Snare_02.wav', 'drums/hats/hat.wav'):
+            self.make_file(path)
+        self.age_directories()
+
+    def tearDown(self):
+        self.environ.stop()
+        shutil.rmtree(self.directory)
+        shutil.rmtree(self.home)
+
+    def make_file(self, path):
+        full_path = os.path.join(self.directory, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'w') as f:
+            f.write(path)
+
+    # Freshly written directories aren't trusted by the cache, so their mtimes are moved back
+    def age_directories(self):
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            os.utime(dirpath, (1000000000, 1000000000))
+
+    def scan(self):
+        cache = ScanCache.load(self.directory)
+        snapshot = scan_directory(self.directory, cache=cache)
+        cache.save()
+        return cache, snapshot
+
+    def test_unchanged_directories_come_from_the_cache(self):
+        cache, snapshot = self.scan()
+        self.assertEqual((cache.hits, cache.misses), (0, 3))
+        cache, cached_snapshot = self.scan()
+        self.assertEqual((cache.hits, cache.misses), (3, 0))
+        self.assertEqual(cached_snapshot, snapshot)
+        self.assertEqual(cached_snapshot, scan_directory(self.directory))
+
+    def test_changed_directories_are_listed_again(self):
+        self.scan()
+        self.make_file('drums/Pack_Snare_03.wav')
+        shutil.rmtree(os.path.join(self.directory, 'drums', 'hats'))
+        cache, snapshot = self.scan()
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(snapshot, scan_directory(self.directory))
+        self.assertNotIn(os.path.join(self.directory, 'drums', 'hats'), cache.prefixes())
+
+    def test_recently_changed_directories_are_not_trusted(self):
+        self.make_file('Pack_Kick_03.wav')
+        self.scan()
+        cache, snapshot = self.scan()
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_cached_prefixes_give_the_same_regexes(self):
+        self.scan()
+        cache, snapshot = self.scan()
+        for leading_zero in (True, False):
+            self.assertEqual(dict(build_regex_index(snapshot, leading_zero, cache.prefixes()).by_path),
+                             dict(build_regex_index(snapshot, leading_zero).by_path))
+
+    def test_prefixes_are_worked_out_when_asked_for(self):
+        with patch('cleanercache.prefix_clusters', side_effect=prefix_clusters) as clusters:
+            cache, snapshot = self.scan()
+            self.assertEqual(clusters.call_count, 0)
+            self.assertEqual(cache.prefixes(compute=False), {})
+            prefixes = cache.prefixes()
+            self.assertEqual(clusters.call_count, 3)
+            self.assertEqual(prefixes[self.directory], ['pack_kick_0'])
+            cache.save()
+            # Saved with the cache, the next scan doesn't work them out again
+            cache, snapshot = self.scan()
+            self.assertEqual(cache.prefixes(), prefixes)
+            self.assertEqual(clusters.call_count, 3)
+
+    def test_rules_have_their_own_cache(self):
+        self.scan()
+        rules = ScanRules(exclude=('hats',))
+        self.assertEqual(cache_path(self.directory, ScanRules()), cache_path(self.directory))
+        self.assertNotEqual(cache_path(self.directory, rules), cache_path(self.directory))
+        cache = ScanCache.load(self.directory, rules)
+        snapshot = scan_directory(self.directory, cache=cache, rules=rules)
+        self.assertEqual((cache.hits, cache.misses, len(snapshot)), (0, 2, 4))
+        self.assertEqual(snapshot, scan_directory(self.directory, rules=rules))
+
+    def test_damaged_cache_is_ignored(self):
+        self.scan()
+        with open(cache_path(self.directory), 'w') as f:
+            f.write('{"version": 1, "root"')
+        cache, snapshot = self.scan()
+        self.assertEqual((cache.hits, cache.misses), (0, 3))
+
+    def test_least_recently_used_libraries_are_evicted(self):
+        self.scan()
+        old_path = cache_path(self.directory)
+        os.utime(old_path, (1000000000, 1000000000))
+        other = os.path.join(self.directory, 'drums')
+        other_cache = ScanCache.load(other)
+        scan_directory(other, cache=other_cache)
+        other_cache.save()
+        evict(limit=os.path.getsize(cache_path(other)))
+        self.assertFalse(os.path.exists(old_path))
+        self.assertTrue(os.path.exists(cache_path(other)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,289 @@
+###################################################################################################
+# cleanercli.py
+#
+# Command line interface for candlecleaner, run with "python -m candlecleaner <command> ...".
+# Prints or applies the rename plan for a directory without starting Tk.
+#
+###################################################################################################
+
+import argparse
+import json
+import os
+import sys
+import time
+from cleanerengine import CleanerOptions, ScanRules, compile_pattern, PatternError, scan_directory, iter_plan, build_regex_index, build_plan
+from cleanercache import ScanCache
+from cleanerrules import load_rules, split_list
+from cleanerbatch import overlapping_roots, run_batch, batch_report, batch_summary
+from cleanerdaemon import DaemonError, DaemonServer, LibraryService, connect_daemon, library_params
+from cleanershard import ShardError, create_shards, run_workers, merge_shards
+from cleanerplanfile import PLAN_CHUNK_SIZE, PLAN_FORMATS, PlanFileError, write_plan_file, apply_plan_file
+from cleanerstats import Stats, count_scan, write_stats, profiled
+from cleanerrename import DEFAULT_WORKERS, RenameExecutor, default_journal_path, resume_executor, undo_executor
+
+def add_option_arguments(parser, many=False):
+    if many:
+        parser.add_argument("directories", nargs="+", help="the directories to clean recursively")
+    else:
+        parser.add_argument("directory", help="the directory to clean recursively")
+    parser.add_argument("--remove", default="", help="the text to remove from every file name")
+    parser.add_argument("--replace", default="", help="the text to put in place of the removed text")
+    parser.add_argument("--regex", action="store_true", help="treat --remove as a regular expression, --replace can use its groups like \\1")
+    parser.add_argument("--smart", action="store_true", help="enable the candle cleaner, overrides --remove")
+    parser.add_argument("--keep-leading-zeros", action="store_true", help="don't strip trailing 0s from the generated prefix")
+    parser.add_argument("--upper-bpm", action="store_true", help="capitalize BPM")
+    parser.add_argument("--capitalize", action="store_true", help="capitalize words")
+    parser.add_argument("--underscores", action="store_true", help="replace underscores with spaces")
+    parser.add_argument("--no-cache", action="store_true", help="list every folder instead of reusing the scan cache")
+    parser.add_argument("--exclude", action="append", default=[], metavar="GLOB",
+                        help="leave out files and folders matching GLOB, a path from the directory when it has a /, can be repeated")
+    parser.add_argument("--extensions", metavar="LIST", help="only take in files with these extensions, like wav,aif,flac")
+    parser.add_argument("--max-depth", type=int, metavar="LEVELS", help="descend at most this many folder levels")
+    parser.add_argument("--include-hidden", action="store_true", help="take in hidden files and folders")
+    parser.add_argument("--ignore-saved-rules", action="store_true", help="don't start from the scan rules saved in the window")
+    if not many:
+        parser.add_argument("--daemon", action="store_true", help="ask the running scan service instead of scanning here")
+
+def add_report_arguments(parser):
+    parser.add_argument("--stats", metavar="FILE", help="write the time and counters of every phase as JSON, - for stderr")
+    parser.add_argument("--profile", metavar="FILE", help="run the command under cProfile and save the profile")
+
+def options_from_args(args):
+    return CleanerOptions(string_to_remove=args.remove, replacement=args.replace, smart_update=args.smart,
+                          leading_zero=not args.keep_leading_zeros, upper_bpm=args.upper_bpm,
+                          capitalize=args.capitalize, underscore=args.underscores, use_regex=args.regex)
+
+def rules_from_args(args):
+    # The rules saved from the window, with the ones given on the command line added
+    rules = ScanRules() if args.ignore_saved_rules else load_rules()
+    return ScanRules(rules.exclude + tuple(args.exclude),
+                     rules.extensions if args.extensions is None else split_list(args.extensions),
+                     rules.max_depth if args.max_depth is None else args.max_depth,
+                     rules.include_hidden or args.include_hidden)
+
+def print_plan(plan, out):
+    for src, dst in plan.renames():
+        out.write(f"{src} -> {os.path.basename(dst)}\n")
+
+def run_executor(executor, stats):
+    with stats.phase("rename"):
+        report = executor.run()
+    stats.count("rename_calls", executor.done)
+    return print_report(report, stats)
+
+def print_report(report, stats):
+    stats.count("renamed", report.renamed)
+    stats.count("failures", len(report.failures))
+    for failure in report.failures:
+        sys.stderr.write(f"Couldn't rename file: {failure.source} ({failure.error})\n")
+    sys.stderr.write(report.summary(len(report.temporary), failures=False) + "\n")
+    if report.journal:
+        sys.stderr.write(f"Journal: {report.journal}\n")
+    return 1 if report.failures else 0
+
+def main(argv=None, out=sys.stdout):
+    parser = argparse.ArgumentParser(prog="candlecleaner", description="Mass file renamer, specifically geared toward audio sample libraries.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    plan_parser = subparsers.add_parser("plan", help="print the files that would be renamed")
+    add_option_arguments(plan_parser)
+    plan_parser.add_argument("--output", metavar="FILE", help="stream the plan to a file instead of printing it, without keeping the tree in memory")
+    plan_parser.add_argument("--format", choices=PLAN_FORMATS, help="the format of --output, from its extension by default")
+    add_report_arguments(plan_parser)
+    apply_parser = subparsers.add_parser("apply", help="rename the files")
+    add_option_arguments(apply_parser)
+    add_report_arguments(apply_parser)
+    apply_parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="number of renames run at once")
+    apply_parser.add_argument("--journal", help="where to write the journal, defaults to ~/.candlecleaner/journals")
+    for command, help_text in (("undo", "undo the renames recorded in a journal"), ("resume", "finish an interrupted rename from its journal")):
+        journal_parser = subparsers.add_parser(command, help=help_text)
+        journal_parser.add_argument("journal", help="the journal file written by apply")
+        journal_parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="number of renames run at once")
+        add_report_arguments(journal_parser)
+    apply_file_parser = subparsers.add_parser("apply-file", help="rename the files listed in a plan written by plan --output")
+    apply_file_parser.add_argument("plan", help="the plan file")
+    apply_file_parser.add_argument("--format", choices=PLAN_FORMATS, help="the format of the plan, from its extension by default")
+    apply_file_parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="number of renames run at once")
+    apply_file_parser.add_argument("--chunk-size", type=int, default=PLAN_CHUNK_SIZE, help="renames read from the plan at a time")
+    apply_file_parser.add_argument("--journal", help="where to write the journal, defaults to ~/.candlecleaner/journals")
+    add_report_arguments(apply_file_parser)
+    batch_parser = subparsers.add_parser("batch", help="plan or rename many directories at once with a process pool")
+    add_option_arguments(batch_parser, many=True)
+    batch_parser.add_argument("--apply", action="store_true", help="rename the files instead of only planning")
+    batch_parser.add_argument("--processes", type=int, help="worker processes, one per core by default")
+    batch_parser.add_argument("--split", action="store_true", help="give every top level folder its own worker, for few large directories")
+    batch_parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="renames run at once in each process")
+    batch_parser.add_argument("--plans", metavar="DIRECTORY", help="write the plan of every directory as JSON lines into this directory")
+    batch_parser.add_argument("--report", metavar="FILE", help="write the merged report as JSON")
+    add_report_arguments(batch_parser)
+    shard_parser = subparsers.add_parser("shard", help="split the plan into shards by folder for workers sharing the storage")
+    add_option_arguments(shard_parser, many=True)
+    shard_parser.add_argument("--output", metavar="DIRECTORY", required=True, help="where to write the shards, on storage every worker can reach")
+    shard_parser.add_argument("--processes", type=int, help="planning processes, one per core by default")
+    add_report_arguments(shard_parser)
+    work_parser = subparsers.add_parser("shard-work", help="claim and apply shards until none are left")
+    work_parser.add_argument("shards", help="the directory written by shard")
+    work_parser.add_argument("--processes", type=int, default=1, help="worker processes on this host")
+    work_parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="renames run at once in each process")
+    add_report_arguments(work_parser)
+    merge_parser = subparsers.add_parser("shard-merge", help="merge the results of every shard into one report")
+    merge_parser.add_argument("shards", help="the directory written by shard")
+    merge_parser.add_argument("--report", metavar="FILE", help="write the merged report as JSON")
+    add_report_arguments(merge_parser)
+    daemon_parser = subparsers.add_parser("daemon", help="run the scan service that keeps libraries scanned for the window and the command line")
+    daemon_parser.add_argument("--memory-limit", type=int, default=1024, metavar="MB", help="memory the kept libraries may take before the least recently used is dropped")
+    daemon_parser.add_argument("--idle-minutes", type=float, default=60, help="drop a library nobody asked about for this long")
+    daemon_parser.add_argument("--status", action="store_true", help="print what the running service keeps")
+    daemon_parser.add_argument("--stop", action="store_true", help="stop the running service")
+    add_report_arguments(daemon_parser)
+    args = parser.parse_args(argv)
+
+    if args.command == "daemon":
+        if args.memory_limit <= 0 or args.idle_minutes <= 0:
+            parser.error("--memory-limit and --idle-minutes must be positive")
+    elif args.command in ("undo", "resume"):
+        if not os.path.isfile(args.journal):
+            parser.error(f"no such journal: {args.journal}")
+    elif args.command == "apply-file":
+        if not os.path.isfile(args.plan):
+            parser.error(f"no such plan: {args.plan}")
+    elif args.command in ("shard-work", "shard-merge"):
+        if not os.path.isdir(args.shards):
+            parser.error(f"not a directory: {args.shards}")
+    elif args.command in ("batch", "shard"):
+        for directory in args.directories:
+            if not os.path.isdir(directory):
+                parser.error(f"not a directory: {directory}")
+        for first, second in overlapping_roots(args.directories):
+            parser.error(f"{second} is inside {first}")
+    elif not os.path.isdir(args.directory):
+        parser.error(f"not a directory: {args.directory}")
+    if getattr(args, "max_depth", None) is not None and args.max_depth < 0:
+        parser.error("--max-depth can't be negative")
+    if getattr(args, "regex", False) and not args.smart:
+        try:
+            compile_pattern(args.remove, args.replace, True)
+        except PatternError as error:
+            parser.error(str(error))
+
+    stats = Stats(args.command)
+    try:
+        with profiled(args.profile):
+            result = run_command(args, out, stats)
+    except (PlanFileError, ShardError, DaemonError) as error:
+        parser.exit(2, f"{parser.prog}: error: {error}\n")
+    if args.stats:
+        write_stats([stats], args.stats)
+    return result
+
+def run_command(args, out, stats):
+    if args.command == "undo":
+        return run_executor(undo_executor(args.journal, args.workers), stats)
+    if args.command == "resume":
+        return run_executor(resume_executor(args.journal, args.workers), stats)
+    if args.command == "apply-file":
+        with stats.phase("rename"):
+            report = apply_plan_file(args.plan, args.workers, max(1, args.chunk_size), args.journal or default_journal_path(), args.format)
+        return print_report(report, stats)
+    if args.command == "shard-work":
+        with stats.phase("rename"):
+            results = run_workers(args.shards, max(1, args.processes), max(1, args.workers))
+        return print_batch(results, None, stats, True)
+    if args.command == "shard-merge":
+        return print_batch(merge_shards(args.shards), args.report, stats, True)
+    if args.command == "daemon":
+        return run_daemon_command(args, out)
+
+    options = options_from_args(args)
+    rules = rules_from_args(args)
+    if args.command == "batch":
+        return run_batch_command(args, options, rules, stats)
+    if args.command == "shard":
+        with stats.phase("plan"):
+            results = create_shards(args.directories, options, args.output, args.processes, rules)
+        return print_batch(results, None, stats, False)
+    if args.command == "plan" and args.output:
+        with stats.phase("export"):
+            stats.count("renames", write_plan_file(iter_plan(args.directory, options, rules=rules), args.output, args.format))
+        return 0
+    if args.daemon:
+        client = connect_daemon()
+        if client is not None:
+            with client:
+                return run_with_daemon(client, args, options, rules, out, stats)
+        sys.stderr.write("The scan service isn't running, scanning here\n")
+    with stats.phase("scan"):
+        cache = ScanCache(args.directory, rules=rules) if args.no_cache else ScanCache.load(args.directory, rules)
+        snapshot = scan_directory(args.directory, cache=cache, rules=rules)
+        # Worked out before saving, so the next run finds them in the cache
+        prefixes = cache.prefixes() if options.smart_update else None
+        cache.save()
+    count_scan(stats, snapshot, cache)
+    regex_index = None
+    if options.smart_update:
+        with stats.phase("regex"):
+            regex_index = build_regex_index(snapshot, options.leading_zero, prefixes)
+    with stats.phase("plan"):
+        plan = build_plan(snapshot, options, regex_index)
+    with stats.phase("print"):
+        print_plan(plan, out)
+    if args.command == "apply":
+        return run_executor(RenameExecutor(plan.renames(), args.workers, journal_path=args.journal or default_journal_path()), stats)
+    return 0
+
+def run_with_daemon(client, args, options, rules, out, stats):
+    params = library_params(os.path.abspath(args.directory), rules, options)
+    # The service only relists what changed, --no-cache has it scan the library again
+    params["rescan"] = args.no_cache
+    if args.command == "plan":
+        with stats.phase("plan"):
+            reply = client.request("plan", **params)
+        stats.count("files", reply["files"])
+        stats.count("renames", len(reply["renames"]))
+        with stats.phase("print"):
+            for src, dst in reply["renames"]:
+                out.write(f"{src} -> {os.path.basename(dst)}\n")
+        return 0
+    with stats.phase("rename"):
+        reply = client.request("apply", workers=args.workers, **params)
+    stats.count("renamed", reply["renamed"])
+    stats.count("failures", len(reply["failures"]))
+    for source, target, message in reply["failures"]:
+        sys.stderr.write(f"Couldn't rename file: {source} ({message})\n")
+    sys.stderr.write(f"{reply['renamed']} files renamed.\n")
+    for path in reply["temporary"]:
+        sys.stderr.write(f"Left under a temporary name: {path}\n")
+    if reply["journal"]:
+        sys.stderr.write(f"Journal: {reply['journal']}\n")
+    return 1 if reply["failures"] else 0
+
+def run_daemon_command(args, out):
+    if args.status or args.stop:
+        client = connect_daemon()
+        if client is None:
+            sys.stderr.write("The scan service isn't running\n")
+            return 1
+        with client:
+            reply = client.request("stop" if args.stop else "status")
+        if args.status:
+            out.write(json.dumps(reply, indent=2) + "\n")
+        return 0
+    server = DaemonServer(service=LibraryService(args.memory_limit * 1024 * 1024, args.idle_minutes * 60))
+    sys.stderr.write(f"Scan service listening on {server.address}\n")
+    server.serve()
+    return 0
+
+def run_batch_command(args, options, rules, stats):
+    start = time.perf_counter()
+    with stats.phase("batch"):
+        results = run_batch(args.directories, options, args.apply, args.processes, args.split, max(1, args.workers), args.plans, rules)
+    return print_batch(results, args.report, stats, args.apply, time.perf_counter() - start)
+
+def print_batch(results, report_path, stats, apply, seconds=None):
+    report = batch_report(results, seconds)
+    for name, value in report["totals"].items():
+        stats.count(name, value)
+    sys.stderr.write(batch_summary(results, apply) + "\n")
+    if report_path:
+        with open(report_path, "w", encoding="utf-8") as file:
+            file.write(json.dumps(report, indent=2) + "\n")
+    return 1 if report["totals"]["failures"] or report["totals"]["errors"] else 0
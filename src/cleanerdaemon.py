@@ -0,0 +1,541 @@
+###################################################################################################
+# cleanerdaemon.py
+#
+# An optional local scan service that keeps the Snapshot and StageCache of every library it was
+# asked about, so the window, the command line and scripts share one scan instead of each walking
+# the disk. Start it with "python -m candlecleaner daemon". It listens on a Unix socket in
+# ~/.candlecleaner, or on localhost where there are no Unix sockets, and speaks JSON lines: one
+# request, or a list of them, per line and one reply, or a list, per line. On localhost the first
+# line of a connection must be {"token": ...} with the token the service wrote to
+# ~/.candlecleaner/daemon.token, which only the user can read. The reply to a scan is
+# {"files": ..., "directories": ..., "rows": true}, after the reply line the rows of every scan
+# follow in order as lists of [path, inode, dirnames, [[name, size, inode], ...], prefixes] rows,
+# each list ending with an empty one.
+#
+#     {"method": "scan", "root": "/Volumes/Drive", "rules": {...}, "verify": false, "rescan": false}
+#     {"method": "plan", "root": ..., "rules": ..., "options": {"smart_update": true, ...}}
+#     {"method": "apply", "root": ..., "rules": ..., "options": ..., "workers": 8}
+#     {"method": "invalidate", "root": ..., "rules": ..., "paths": [...]}
+#     {"method": "status"}, {"method": "stop"}
+#
+# Requests from every connection are queued and answered in batches by one thread: each library is
+# brought up to date once per batch and every distinct plan is built once, however many clients
+# asked for it. Libraries are kept up to date by a DirectoryWatcher, verify also restats every
+# folder, which a client should ask for right after renaming files itself. The least recently used
+# libraries are dropped once the kept snapshots take more than the memory limit, or after they
+# weren't asked about for the idle time.
+#
+###################################################################################################
+
+import hmac
+import json
+import os
+import queue
+import secrets
+import socket
+import socketserver
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from cleanerengine import (data_directory, CleanerOptions, StageCache, scan_directory, refresh_directories, update_regex_index,
+                           build_plan, prefix_clusters)
+from cleanercache import MTIME_SLACK, ScanCache
+from cleanerrules import rules_data, rules_from_data
+from cleanerrename import DEFAULT_WORKERS, RenameExecutor, default_journal_path
+from cleanerwatch import DirectoryWatcher
+
+DAEMON_SOCKET = "daemon.sock"
+# Used instead of a socket file where there are no Unix sockets
+DAEMON_PORT = 47811
+# Holds the token clients connecting on DAEMON_PORT must send
+DAEMON_TOKEN = "daemon.token"
+
+# Files, and one per folder, in each line of rows sent for a scan
+SCAN_CHUNK_FILES = 4096
+
+# Bytes the kept snapshots and names may take before the least recently used library is dropped
+DAEMON_MEMORY_LIMIT = 1024 * 1024 * 1024
+# Seconds a library is kept without being asked about
+DAEMON_IDLE_SECONDS = 3600
+# Seconds to wait for the service to accept a connection, requests themselves can take as long as
+# a scan or a rename does
+CONNECT_TIMEOUT = 1.0
+# Seconds the service waits for the reply to a stop request to be written before it exits
+STOP_REPLY_TIMEOUT = 5.0
+
+class DaemonError(Exception):
+    pass
+
+def daemon_address():
+    if hasattr(socket, "AF_UNIX"):
+        return os.path.join(data_directory(), DAEMON_SOCKET)
+    return ("127.0.0.1", DAEMON_PORT)
+
+def token_path():
+    return os.path.join(data_directory(), DAEMON_TOKEN)
+
+def write_token(path):
+    # A new random token in a file only the user can read
+    token = secrets.token_hex(32)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="ascii") as file:
+        # A file left by an earlier service keeps its mode
+        os.chmod(path, 0o600)
+        file.write(token)
+    return token
+
+def read_token(path):
+    with open(path, encoding="ascii") as file:
+        return file.read().strip()
+
+def directory_state(path):
+    # What verify compares, None when the folder is gone. A folder changed within MTIME_SLACK may
+    # change again in the same mtime tick, so its mtime isn't trusted
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    mtime_ns = stat.st_mtime_ns if time.time() - stat.st_mtime > MTIME_SLACK else None
+    return (mtime_ns, stat.st_nlink, stat.st_ino)
+
+class Library:
+    # A scanned library kept by the service, one per root and ScanRules
+    __slots__ = ('root', 'rules', 'snapshot', 'stages', 'regex_indexes', 'states', 'watcher', 'last_used', 'size')
+
+    def __init__(self, root, rules, rescan=False, watch_interval=None):
+        self.root = root
+        self.rules = rules
+        cache = ScanCache(root, rules=rules) if rescan else ScanCache.load(root, rules)
+        self.snapshot = scan_directory(root, cache=cache, rules=rules)
+        self.stages = StageCache(cache.prefixes())
+        cache.save()
+        # Prefix regexes by the leading zero option
+        self.regex_indexes = {}
+        paths = self.snapshot.paths()
+        self.states = {path: directory_state(path) for path in paths}
+        self.watcher = DirectoryWatcher(paths) if watch_interval is None else DirectoryWatcher(paths, interval=watch_interval)
+        self.watcher.start()
+        self.last_used = time.monotonic()
+        self.size = 0
+
+    def measure(self):
+        self.size = self.snapshot.memory_size() + self.stages.memory_size()
+
+    def changed_paths(self, verify=False):
+        # The folders the watcher reported since the last call, and with verify every folder whose
+        # mtime, link count or inode moved
+        changed = set()
+        while True:
+            try:
+                changed |= self.watcher.changes.get_nowait()
+            except queue.Empty:
+                break
+        if verify:
+            for path, state in self.states.items():
+                if state is None or state[0] is None or directory_state(path) != state:
+                    changed.add(path)
+        return changed
+
+    def refresh(self, dirpaths):
+        # Relist dirpaths like the window does for its watcher, returns whether anything changed
+        if not dirpaths:
+            return False
+        snapshot, changed, removed = refresh_directories(self.snapshot, dirpaths, self.rules)
+        self.snapshot = snapshot
+        self.watcher.unwatch(removed)
+        self.watcher.watch(changed)
+        self.stages.discard(changed | removed)
+        for path in removed:
+            self.states.pop(path, None)
+        for path in changed:
+            self.states[path] = directory_state(path)
+        directories = [snapshot.directory(index, path) for index, path in enumerate(snapshot.paths()) if path in changed]
+        self.regex_indexes = {leading_zero: update_regex_index(regex_index, directories, removed, leading_zero)
+                              for leading_zero, regex_index in self.regex_indexes.items()}
+        return bool(changed or removed)
+
+    def plan(self, options):
+        regex_index = None
+        if options.smart_update:
+            regex_index = self.regex_indexes.get(options.leading_zero)
+            if regex_index is None:
+                regex_index = self.regex_indexes[options.leading_zero] = self.stages.regex_index(self.snapshot, options.leading_zero)
+        return build_plan(self.snapshot, options, regex_index, stages=self.stages)
+
+    def directory_rows(self):
+        # The ScanRows of every folder, only the prefixes are worked out here
+        snapshot = self.snapshot
+        prefixes = self.stages.prefixes
+        paths = snapshot.paths()
+        for index, path in enumerate(paths):
+            if path not in prefixes:
+                prefixes[path] = prefix_clusters(snapshot.file_names(index))
+        return ScanRows(snapshot, paths, [prefixes[path] for path in paths])
+
+    def close(self):
+        self.watcher.stop()
+
+class ScanRows:
+    # Iterates over the rows of a scan reply in lists of about SCAN_CHUNK_FILES files. A refresh
+    # replaces the snapshot of a library instead of changing it, so the rows can be built on the
+    # thread sending them while the service goes on
+    __slots__ = ('snapshot', 'paths', 'prefixes')
+
+    def __init__(self, snapshot, paths, prefixes):
+        self.snapshot = snapshot
+        self.paths = paths
+        self.prefixes = prefixes
+
+    def __iter__(self):
+        chunk = []
+        chunk_files = 0
+        for index, path in enumerate(self.paths):
+            directory = self.snapshot.directory(index, path)
+            chunk.append([path, directory.inode, list(directory.dirnames),
+                          [[file.name, file.size, file.inode] for file in directory.files], self.prefixes[index]])
+            chunk_files += len(directory.files) + 1
+            if chunk_files >= SCAN_CHUNK_FILES:
+                yield chunk
+                chunk = []
+                chunk_files = 0
+        if chunk:
+            yield chunk
+
+class LibraryService:
+    # Answers batches of requests, see the top of the file. Not thread safe, the server calls it
+    # from a single thread
+    def __init__(self, memory_limit=DAEMON_MEMORY_LIMIT, idle_seconds=DAEMON_IDLE_SECONDS, watch_interval=None):
+        self.memory_limit = memory_limit
+        self.idle_seconds = idle_seconds
+        self.watch_interval = watch_interval
+        # By (root, rules), least recently used first
+        self.libraries = OrderedDict()
+        self.stopped = False
+
+    def handle(self, requests):
+        # One reply per request, {"error": message} for the ones that failed
+        fresh = set()
+        plans = {}
+        replies = []
+        for request in requests:
+            try:
+                if not isinstance(request, dict):
+                    raise DaemonError("a request must be an object")
+                replies.append(self.handle_request(request, fresh, plans))
+            except (DaemonError, OSError, ValueError, TypeError, KeyError, AttributeError) as error:
+                replies.append({"error": str(error) or type(error).__name__})
+        for key in fresh:
+            if key in self.libraries:
+                self.libraries[key].measure()
+        self.evict()
+        return replies
+
+    def handle_request(self, request, fresh, plans):
+        method = request.get("method")
+        if method == "status":
+            now = time.monotonic()
+            return {"pid": os.getpid(), "memory_limit": self.memory_limit, "libraries": [
+                {"root": library.root, "rules": rules_data(library.rules), "files": len(library.snapshot),
+                 "directories": len(library.snapshot.directories), "bytes": library.size, "idle": now - library.last_used}
+                for library in self.libraries.values()]}
+        if method == "stop":
+            self.stopped = True
+            return {}
+        if method not in ("scan", "plan", "apply", "invalidate"):
+            raise DaemonError(f"unknown method: {method}")
+        root = request["root"]
+        if not isinstance(root, str) or not os.path.isdir(root):
+            raise DaemonError(f"not a directory: {root}")
+        rules = rules_from_data(request.get("rules") or {})
+        key = (os.path.abspath(root), rules)
+        if method == "invalidate":
+            library = self.libraries.get(key)
+            if library is not None:
+                if request.get("paths") is None:
+                    self.drop(key)
+                elif library.refresh(set(request["paths"])):
+                    forget_plans(plans, key)
+            return {}
+
+        library = self.library(key, request, fresh, plans)
+        if method == "scan":
+            # RequestHandler sends the rows after the reply line
+            return {"files": len(library.snapshot), "directories": len(library.snapshot.directories), "rows": library.directory_rows()}
+        options = CleanerOptions(**request.get("options") or {})
+        plan = plans.get((key, options))
+        if plan is None:
+            plan = plans[(key, options)] = library.plan(options)
+        renames = list(plan.renames())
+        if method == "plan":
+            return {"files": len(library.snapshot), "directories": len(library.snapshot.directories),
+                    "renames": [[src, dst] for src, dst in renames]}
+        report = RenameExecutor(renames, max(1, int(request.get("workers", DEFAULT_WORKERS))), journal_path=default_journal_path()).run()
+        library.refresh({os.path.dirname(src) for src, dst in renames})
+        forget_plans(plans, key)
+        return {"renames": len(renames), "renamed": report.renamed, "journal": report.journal, "cancelled": report.cancelled,
+                "temporary": report.temporary,
+                "failures": [[failure.source, failure.target, failure.error.strerror or str(failure.error)] for failure in report.failures]}
+
+    def library(self, key, request, fresh, plans):
+        # The library for key, scanned when it isn't kept yet, and brought up to date once per batch
+        library = self.libraries.get(key)
+        if key not in fresh:
+            if library is not None and request.get("rescan"):
+                self.drop(key)
+                library = None
+            if library is None:
+                library = self.libraries[key] = Library(key[0], key[1], bool(request.get("rescan")), self.watch_interval)
+            elif library.refresh(library.changed_paths(bool(request.get("verify")))):
+                forget_plans(plans, key)
+            fresh.add(key)
+        library.last_used = time.monotonic()
+        self.libraries.move_to_end(key)
+        return library
+
+    def drop(self, key):
+        library = self.libraries.pop(key, None)
+        if library is not None:
+            library.close()
+
+    def evict(self):
+        # Idle libraries, then the least recently used ones while over the memory limit. The most
+        # recently used one is always kept
+        now = time.monotonic()
+        for key, library in list(self.libraries.items()):
+            if now - library.last_used > self.idle_seconds:
+                self.drop(key)
+        while len(self.libraries) > 1 and sum(library.size for library in self.libraries.values()) > self.memory_limit:
+            self.drop(next(iter(self.libraries)))
+
+    def close(self):
+        for key in list(self.libraries):
+            self.drop(key)
+
+def forget_plans(plans, key):
+    for plan_key in [plan_key for plan_key in plans if plan_key[0] == key]:
+        del plans[plan_key]
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        if self.server.token is not None and not self.authenticate():
+            return
+        for line in self.rfile:
+            streams = []
+            stop_sent = None
+            try:
+                message = json.loads(line)
+            except ValueError:
+                reply = {"error": "not a JSON request"}
+            else:
+                requests = message if isinstance(message, list) else [message]
+                future = Future()
+                self.server.requests.put((requests, future))
+                replies = future.result()
+                if any(request.get("method") == "stop" for request in requests if isinstance(request, dict)):
+                    stop_sent = self.server.stop_sent
+                for scan_reply in replies:
+                    if isinstance(scan_reply.get("rows"), ScanRows):
+                        streams.append(scan_reply["rows"])
+                        scan_reply["rows"] = True
+                reply = replies if isinstance(message, list) else replies[0]
+            try:
+                self.write_line(reply)
+                for rows in streams:
+                    for chunk in rows:
+                        self.write_line(chunk)
+                    self.write_line([])
+            except (BrokenPipeError, ConnectionResetError):
+                # The client went away, like a window cancelling its scan
+                return
+            finally:
+                if stop_sent is not None:
+                    stop_sent.set()
+
+    def write_line(self, data):
+        self.wfile.write(json.dumps(data).encode("ascii") + b"\n")
+        self.wfile.flush()
+
+    def authenticate(self):
+        # Whether the first line holds the token, anything else gets an error and the connection closed
+        try:
+            token = json.loads(self.rfile.readline())["token"]
+            accepted = hmac.compare_digest(token.encode("utf-8"), self.server.token.encode("ascii"))
+        except (ValueError, TypeError, KeyError, AttributeError):
+            accepted = False
+        self.write_line({} if accepted else {"error": "wrong or missing token"})
+        return accepted
+
+if hasattr(socketserver, "ThreadingUnixStreamServer"):
+    class UnixServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+        token = None
+
+class TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    # On Windows SO_REUSEADDR lets another process bind the port the service is listening on
+    allow_reuse_address = os.name != "nt"
+    token = None
+
+class DaemonServer:
+    # Accepts connections on its own threads and answers their requests in batches on the thread
+    # calling serve
+    def __init__(self, address=None, service=None):
+        self.address = address or daemon_address()
+        self.service = service or LibraryService()
+        if isinstance(self.address, str):
+            if os.path.exists(self.address):
+                if connect_daemon(self.address) is not None:
+                    raise DaemonError(f"the scan service is already running on {self.address}")
+                # Left behind by a service that didn't stop cleanly
+                os.remove(self.address)
+            self.server = UnixServer(self.address, RequestHandler)
+            os.chmod(self.address, 0o600)
+        else:
+            self.server = TCPServer(self.address, RequestHandler)
+            # The port the system picked when given 0
+            self.address = self.server.server_address
+            self.server.token = write_token(token_path())
+        self.server.requests = queue.Queue()
+        # Set once the reply to a stop request was written, the process may exit before otherwise
+        self.server.stop_sent = threading.Event()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def serve(self):
+        self.thread.start()
+        requests = self.server.requests
+        try:
+            while not self.service.stopped:
+                try:
+                    batch = [requests.get(timeout=min(60, self.service.idle_seconds))]
+                except queue.Empty:
+                    self.service.evict()
+                    continue
+                # Everything queued while the last batch ran is answered together
+                while True:
+                    try:
+                        batch.append(requests.get_nowait())
+                    except queue.Empty:
+                        break
+                flat = [request for requests_of, future in batch for request in requests_of]
+                try:
+                    replies = self.service.handle(flat)
+                except Exception as error:
+                    # The clients get an answer either way, instead of waiting forever
+                    replies = [{"error": str(error) or type(error).__name__}] * len(flat)
+                for requests_of, future in batch:
+                    future.set_result(replies[:len(requests_of)])
+                    replies = replies[len(requests_of):]
+        finally:
+            self.close()
+
+    def close(self):
+        if self.service.stopped:
+            self.server.stop_sent.wait(STOP_REPLY_TIMEOUT)
+        self.server.shutdown()
+        self.server.server_close()
+        self.service.close()
+        try:
+            os.remove(self.address if isinstance(self.address, str) else token_path())
+        except OSError:
+            pass
+
+class DaemonClient:
+    # One connection to the service, usable as a context manager. On localhost the token is read
+    # from token_path and sent first
+    def __init__(self, address=None, timeout=CONNECT_TIMEOUT):
+        address = address or daemon_address()
+        token = None if isinstance(address, str) else read_token(token_path())
+        self.socket = socket.socket(socket.AF_UNIX if isinstance(address, str) else socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.socket.settimeout(timeout)
+            self.socket.connect(address)
+            self.socket.settimeout(None)
+        except OSError:
+            self.socket.close()
+            raise
+        self.file = self.socket.makefile("rwb")
+        if token is not None:
+            try:
+                self.write_line({"token": token})
+                reply = self.read_line()
+            except (OSError, DaemonError, ValueError):
+                self.close()
+                raise
+            if "error" in reply:
+                self.close()
+                raise DaemonError(reply["error"])
+
+    def write_line(self, data):
+        self.file.write(json.dumps(data).encode("ascii") + b"\n")
+        self.file.flush()
+
+    def read_line(self):
+        line = self.file.readline()
+        if not line:
+            raise DaemonError("the scan service closed the connection")
+        return json.loads(line)
+
+    def rows(self):
+        # The rows sent after a scan reply, a list at a time
+        while True:
+            chunk = self.read_line()
+            if not chunk:
+                return
+            yield from chunk
+
+    def send(self, message):
+        # The reply, or replies, to message, with the rows of scan replies read into lists
+        self.write_line(message)
+        reply = self.read_line()
+        for scan_reply in reply if isinstance(reply, list) else [reply]:
+            if scan_reply.get("rows") is True:
+                scan_reply["rows"] = list(self.rows())
+        return reply
+
+    def scan(self, **params):
+        # The reply of a scan request, with "rows" iterating over its rows as they arrive. They must
+        # be read to the end before the next request
+        self.write_line(dict(params, method="scan"))
+        reply = self.read_line()
+        if "error" in reply:
+            raise DaemonError(reply["error"])
+        reply["rows"] = self.rows()
+        return reply
+
+    def request(self, method, **params):
+        # The reply of one request, raises DaemonError for an error reply
+        reply = self.send(dict(params, method=method))
+        if "error" in reply:
+            raise DaemonError(reply["error"])
+        return reply
+
+    def batch(self, requests):
+        # The replies of several requests answered together, error replies are returned as they are
+        return self.send(list(requests))
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def connect_daemon(address=None):
+    # A DaemonClient, or None when the service isn't running or didn't take the token
+    try:
+        return DaemonClient(address)
+    except (OSError, DaemonError, ValueError):
+        return None
+
+def library_params(root, rules=None, options=None):
+    # The root, rules and options of a request in their JSON form
+    params = {"root": root}
+    if rules is not None:
+        params["rules"] = rules_data(rules)
+    if options is not None:
+        params["options"] = options._asdict()
+    return params
@@ -0,0 +1,174 @@
+import unittest
+import io
+import json
+import os
+import shutil
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest.mock import patch
+from cleanerengine import CleanerOptions, ScanRules, scan_directory, build_plan
+from cleanerdaemon import Library, LibraryService, DaemonServer, DaemonClient, connect_daemon, library_params, token_path
+from cleanercli import main
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.environ = patch.dict(os.environ, {"CANDLECLEANER_HOME": os.path.join(self.directory, "home")})
+        self.environ.start()
+        self.library = os.path.join(self.directory, 'Library')
+        self.make_files('Pack_Kick_01.wav', 'Pack_Kick_02.wav', 'Loops/Pack_Loop_01.wav', 'Loops/Pack_Loop_02.wav')
+        self.service = LibraryService(watch_interval=0.05)
+        self.options = CleanerOptions(smart_update=True)
+
+    def tearDown(self):
+        self.service.close()
+        self.environ.stop()
+        shutil.rmtree(self.directory)
+
+    def make_files(self, *paths):
+        for path in paths:
+            full_path = os.path.join(self.library, path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            open(full_path, 'w').close()
+
+    def plan(self, **params):
+        return self.service.handle([dict(library_params(self.library, ScanRules(), self.options), method="plan", **params)])[0]
+
+    def test_batches_share_scans_and_plans(self):
+        expected = [list(rename) for rename in build_plan(scan_directory(self.library), self.options).renames()]
+        request = dict(library_params(self.library, ScanRules(), self.options), method="plan")
+        with patch.object(Library, 'plan', autospec=True, side_effect=Library.plan) as plan:
+            replies = self.service.handle([request, dict(request, method="scan"), request, {"method": "nothing"},
+                                           dict(request, root=os.path.join(self.library, 'missing'))])
+        self.assertEqual(plan.call_count, 1)
+        self.assertEqual(replies[0]["renames"], expected)
+        self.assertEqual(replies[2], replies[0])
+        self.assertEqual((replies[1]["files"], replies[1]["directories"]), (4, 2))
+        # Rows are sent about SCAN_CHUNK_FILES files at a time
+        with patch('cleanerdaemon.SCAN_CHUNK_FILES', 1):
+            chunks = list(replies[1]["rows"])
+        self.assertEqual(sorted(row[0] for chunk in chunks for row in chunk), [self.library, os.path.join(self.library, 'Loops')])
+        self.assertEqual([len(chunk) for chunk in chunks], [1, 1])
+        self.assertIn("error", replies[3])
+        self.assertIn("error", replies[4])
+
+    def test_snapshots_follow_the_tree(self):
+        self.assertEqual(len(self.plan()["renames"]), 4)
+        # verify restats every folder instead of waiting for the watcher
+        self.make_files('Pack_Kick_03.wav')
+        self.assertEqual(len(self.plan(verify=True)["renames"]), 5)
+        self.make_files('Loops/Pack_Loop_03.wav')
+        deadline = time.monotonic() + 5
+        while len(self.plan()["renames"]) != 6 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(len(self.plan()["renames"]), 6)
+        # invalidate relists just the given folders
+        self.make_files('Loops/Pack_Loop_04.wav')
+        self.service.handle([dict(library_params(self.library, ScanRules()), method="invalidate", paths=[os.path.join(self.library, 'Loops')])])
+        self.assertEqual(len(self.plan()["renames"]), 7)
+        self.assertEqual(self.plan(), self.plan(rescan=True))
+
+    def test_eviction(self):
+        other = os.path.join(self.library, 'Loops')
+        self.service.memory_limit = 1
+        self.plan()
+        self.service.handle([dict(library_params(other), method="scan")])
+        # Over the limit only the most recently used library is kept
+        self.assertEqual([key[0] for key in self.service.libraries], [other])
+        self.service.memory_limit = 1024 * 1024 * 1024
+        self.plan()
+        self.assertEqual(len(self.service.handle([{"method": "status"}])[0]["libraries"]), 2)
+        self.service.idle_seconds = 0
+        self.service.evict()
+        self.assertEqual(len(self.service.libraries), 0)
+
+    def test_server_and_cli(self):
+        server = DaemonServer(service=self.service)
+        thread = threading.Thread(target=server.serve)
+        thread.start()
+        try:
+            with connect_daemon() as client:
+                status, plan, scan = client.batch([{"method": "status"}, dict(library_params(self.library, ScanRules(), self.options), method="plan"),
+                                                   dict(library_params(self.library, ScanRules()), method="scan")])
+                self.assertEqual(len(list(client.scan(**library_params(self.library, ScanRules()))["rows"])), 2)
+                # The connection is ready for the next request once the rows were read
+                self.assertEqual(len(client.request("plan", **library_params(self.library, ScanRules(), self.options))["renames"]), 4)
+            self.assertEqual(status["libraries"], [])
+            self.assertEqual(len(plan["renames"]), 4)
+            self.assertEqual(sorted(row[0] for row in scan["rows"]), [self.library, os.path.join(self.library, 'Loops')])
+
+            out = io.StringIO()
+            self.assertEqual(main(['plan', self.library, '--smart', '--daemon', '--ignore-saved-rules'], out), 0)
+            self.assertEqual(len(out.getvalue().splitlines()), 4)
+            self.assertEqual(main(['apply', self.library, '--smart', '--daemon', '--ignore-saved-rules'], io.StringIO()), 0)
+            self.assertEqual(sorted(os.listdir(os.path.join(self.library, 'Loops'))), ['01.wav', '02.wav'])
+            # The service relisted the folders it renamed in
+            out = io.StringIO()
+            self.assertEqual(main(['plan', self.library, '--smart', '--daemon', '--ignore-saved-rules'], out), 0)
+            self.assertEqual(out.getvalue(), "")
+
+            out = io.StringIO()
+            self.assertEqual(main(['daemon', '--status'], out), 0)
+            self.assertEqual(json.loads(out.getvalue())["libraries"][0]["files"], 4)
+            self.assertEqual(main(['daemon', '--stop'], io.StringIO()), 0)
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        finally:
+            if thread.is_alive():
+                with connect_daemon() as client:
+                    client.request("stop")
+                thread.join(5)
+        self.assertIsNone(connect_daemon())
+        self.assertEqual(main(['daemon', '--status'], io.StringIO()), 1)
+
+    def test_stop_waits_for_its_reply(self):
+        # The service used to exit before the reply was written now and then, a slow write of the
+        # empty stop reply makes that happen every time
+        code = ('import sys, time, cleanerdaemon; from cleanercli import main\n'
+                'write_line = cleanerdaemon.RequestHandler.write_line\n'
+                'cleanerdaemon.RequestHandler.write_line = lambda handler, data: (data == {} and time.sleep(1), write_line(handler, data))\n'
+                'sys.exit(main(sys.argv[1:]))')
+        for attempt in range(3):
+            process = subprocess.Popen([sys.executable, '-c', code, 'daemon'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL)
+            try:
+                deadline = time.monotonic() + 10
+                while (client := connect_daemon()) is None:
+                    self.assertIsNone(process.poll())
+                    self.assertLess(time.monotonic(), deadline)
+                    time.sleep(0.01)
+                client.close()
+                self.assertEqual(main(['daemon', '--stop'], io.StringIO()), 0)
+                self.assertEqual(process.wait(10), 0)
+            finally:
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+
+    def test_tcp_needs_the_token(self):
+        server = DaemonServer(("127.0.0.1", 0), service=self.service)
+        thread = threading.Thread(target=server.serve)
+        thread.start()
+        try:
+            if os.name != "nt":
+                self.assertEqual(stat.S_IMODE(os.stat(token_path()).st_mode), 0o600)
+            with DaemonClient(server.address) as client:
+                self.assertEqual(client.request("status")["libraries"], [])
+            for first_line in (b'{"method": "status"}\n', b'{"token": "guess"}\n'):
+                with socket.create_connection(server.address) as connection:
+                    connection.sendall(first_line + b'{"method": "status"}\n')
+                    self.assertEqual(connection.makefile("rb").read(), b'{"error": "wrong or missing token"}\n')
+        finally:
+            with DaemonClient(server.address) as client:
+                client.request("stop")
+            thread.join(5)
+        self.assertFalse(os.path.exists(token_path()))
+        self.assertIsNone(connect_daemon(server.address))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,1085 @@
+###################################################################################################
+# cleanerengine.py
+#
+# The headless half of candlecleaner. Scans a directory once into an in-memory snapshot, generates
+# the smart cleaning prefix regex for each subdirectory and produces an immutable rename plan
+# (source path -> target path) that the GUI previews and that the command line prints or applies.
+# Nothing in here imports Tk or Pillow.
+#
+###################################################################################################
+
+import array
+import fnmatch
+import functools
+import itertools
+import os
+import re
+import string
+import sys
+from collections import namedtuple
+from types import MappingProxyType
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    # Python 3.10
+    import sre_parse
+
+# Words left in lowercase by capitalize_string
+LOWERCASE_WORDS = {"and", "the", "of", "or", "a", "an", "in", "to", "for", "with", "on", "at", "by", "but", "nor", "from", "bpm"}
+
+# Where journals and caches are kept, CANDLECLEANER_HOME overrides it
+DATA_DIRECTORY = os.path.join(os.path.expanduser("~"), ".candlecleaner")
+
+# Runs of spaces, hyphens and underscores, collapsed to one underscore by normalization
+SEPARATOR_PATTERN = re.compile(r'[ \-_]+')
+
+# Smart cleaning looks for groups of at least MIN_CLUSTER_SIZE names sharing a prefix, lets one
+# name in OUTLIER_RATIO not share it, and falls back to the common prefix of the whole folder when
+# more than MAX_PREFIX_CLUSTERS groups are found
+MIN_CLUSTER_SIZE = 2
+OUTLIER_RATIO = 10
+MAX_PREFIX_CLUSTERS = 16
+
+# What a Snapshot of a generated library should take in memory, the benchmark reports the measured
+# figure next to it
+SNAPSHOT_BYTES_PER_FILE = 64
+
+# Compiled text to replace patterns kept by compile_pattern, the preview recompiles on every pause
+# in typing
+PATTERN_CACHE_SIZE = 128
+
+# Seconds a PatternWorker may take to start, not counted against the budget of its first names
+WORKER_START_TIMEOUT = 30
+
+# Characters tried against the start of every branch of a repeated alternation, along with the
+# characters of the pattern itself, two branches that can start with the same one overlap
+PROBE_CHARACTERS = string.printable + "\u00e9\u00df\u00c6\u00a0\u0661\u4e00"
+
+# Files that are never renamed
+IGNORED_FILES = {".DS_Store", ""}
+
+# Where the platform allows it, folders are opened and their files listed, stat'ed and renamed
+# relative to the open handle. The kernel then resolves a folder's path once instead of once per
+# file, and a folder moved while it is worked on stays the one worked on
+USE_DIR_FD = (os.open in os.supports_dir_fd and os.stat in os.supports_dir_fd and os.rename in os.supports_dir_fd
+              and os.scandir in os.supports_fd)
+DIRECTORY_FLAGS = os.O_RDONLY | getattr(os, "O_DIRECTORY", 0) | getattr(os, "O_CLOEXEC", 0)
+
+# Folder handles DirectoryHandles keeps open at once
+HANDLE_LIMIT = 16
+
+# Every setting that changes how a file is renamed, mirrors the GUI fields and the cleaner menu
+CleanerOptions = namedtuple('CleanerOptions',
+    ['string_to_remove', 'replacement', 'smart_update', 'leading_zero', 'upper_bpm', 'capitalize', 'underscore', 'use_regex'],
+    defaults=['', '', False, True, False, False, False, False])
+
+# Which files and folders a scan takes in, the same for the preview, regex generation and rename.
+# exclude holds globs matched against names, or against paths relative to the scanned directory
+# when they contain a "/". Excluded folders are never descended into. extensions, when not empty,
+# are the only file extensions kept. max_depth is how many folder levels below the scanned
+# directory are descended into, None for all. Hidden files and folders are left out unless
+# include_hidden is set
+ScanRules = namedtuple('ScanRules', ['exclude', 'extensions', 'max_depth', 'include_hidden'],
+    defaults=[(), (), None, False])
+
+# One entry of a directory listing, filled from a single os.scandir pass. is_dir and inode come
+# from the listing itself, size costs one stat per file on POSIX and nothing on Windows
+ScanEntry = namedtuple('ScanEntry', ['name', 'size', 'is_dir', 'inode'])
+
+# A directory found by the scan, its subdirectory names and its files as ScanEntry records
+ScannedDirectory = namedtuple('ScannedDirectory', ['path', 'inode', 'dirnames', 'files'])
+
+# The whole tree under root, directories in the order os.walk visits them. Taken once per
+# directory selection or refresh, every preview and rename afterwards is planned from it.
+# Kept compact so a library of millions of files fits in memory: a table with one row per
+# directory (its interned name, parent index, inode and interned subdirectory names) and the files
+# of every directory back to back, their names in one string and their sizes and inodes in arrays,
+# about SNAPSHOT_BYTES_PER_FILE bytes per file instead of a record and three objects each.
+# directories reads like a sequence of ScannedDirectory, built when one is accessed
+class Snapshot:
+    __slots__ = ('root', 'folder_names', 'parents', 'inodes', 'dirnames', 'file_starts', 'names', 'name_ends',
+                 'sizes', 'file_inodes', 'name_parts', 'open_rows')
+
+    def __init__(self, root, directories=()):
+        self.root = root
+        self.folder_names = []
+        self.parents = array.array('l')
+        self.inodes = array.array('Q')
+        self.dirnames = []
+        self.file_starts = array.array('Q', [0])
+        self.names = ""
+        self.name_ends = array.array('Q')
+        self.sizes = array.array('q')
+        self.file_inodes = array.array('Q')
+        # Names added since the names string was last joined
+        self.name_parts = []
+        # (path, index) of the last directory added and its parents
+        self.open_rows = []
+        for directory in directories:
+            self.add_directory(directory)
+        self.join_names()
+
+    # Only used while the snapshot is being built, in os.walk order
+    def add_row(self, path, inode, dirnames):
+        parent_path = os.path.dirname(path)
+        while self.open_rows and self.open_rows[-1][0] != parent_path:
+            self.open_rows.pop()
+        if self.open_rows:
+            self.parents.append(self.open_rows[-1][1])
+            self.folder_names.append(sys.intern(os.path.basename(path)))
+        else:
+            self.parents.append(-1)
+            self.folder_names.append(path)
+            # A root like /library/ is the dirname of its subdirectories without the separator
+            path = os.path.normpath(path)
+        self.open_rows.append((path, len(self.inodes)))
+        self.inodes.append(inode)
+        self.dirnames.append(tuple(sys.intern(name) for name in dirnames))
+
+    def add_directory(self, directory):
+        self.add_row(directory.path, directory.inode, directory.dirnames)
+        end = self.name_ends[-1] if self.name_ends else 0
+        for file in directory.files:
+            end += len(file.name)
+            self.name_parts.append(file.name)
+            self.name_ends.append(end)
+            self.sizes.append(file.size)
+            self.file_inodes.append(file.inode)
+        self.file_starts.append(len(self.sizes))
+
+    def copy_directory(self, other, index, path):
+        # Add directory index of another snapshot, found at path, without building its records
+        self.add_row(path, other.inodes[index], other.dirnames[index])
+        start, end = other.file_starts[index], other.file_starts[index + 1]
+        if start < end:
+            other.join_names()
+            first = other.name_ends[start - 1] if start else 0
+            offset = (self.name_ends[-1] if self.name_ends else 0) - first
+            self.name_parts.append(other.names[first:other.name_ends[end - 1]])
+            self.name_ends.extend(name_end + offset for name_end in other.name_ends[start:end])
+            self.sizes.extend(other.sizes[start:end])
+            self.file_inodes.extend(other.file_inodes[start:end])
+        self.file_starts.append(len(self.sizes))
+
+    def join_names(self):
+        if self.name_parts:
+            self.names = "".join([self.names] + self.name_parts)
+            self.name_parts = []
+
+    def path(self, index):
+        parts = []
+        while index != -1:
+            parts.append(self.folder_names[index])
+            index = self.parents[index]
+        return os.path.join(*reversed(parts))
+
+    # Every directory path in order, each joined onto its parent's
+    def paths(self):
+        paths = []
+        for name, parent in zip(self.folder_names, self.parents):
+            paths.append(name if parent == -1 else os.path.join(paths[parent], name))
+        return paths
+
+    def file_names(self, index):
+        self.join_names()
+        start, end = self.file_starts[index], self.file_starts[index + 1]
+        ends = self.name_ends[start:end]
+        starts = itertools.chain((self.name_ends[start - 1] if start else 0,), ends)
+        names = self.names
+        return [names[name_start:name_end] for name_start, name_end in zip(starts, ends)]
+
+    def file_sizes(self, index):
+        return self.sizes[self.file_starts[index]:self.file_starts[index + 1]]
+
+    def directory(self, index, path=None):
+        start, end = self.file_starts[index], self.file_starts[index + 1]
+        files = tuple(map(ScanEntry, self.file_names(index), self.sizes[start:end], itertools.repeat(False),
+                          self.file_inodes[start:end]))
+        return ScannedDirectory(path or self.path(index), self.inodes[index], self.dirnames[index], files)
+
+    @property
+    def directories(self):
+        return SnapshotDirectories(self)
+
+    def memory_size(self):
+        # Bytes held by the snapshot itself, interned names counted once
+        self.join_names()
+        size = sum(sys.getsizeof(part) for part in (self.folder_names, self.parents, self.inodes, self.dirnames,
+                                                    self.file_starts, self.names, self.name_ends, self.sizes, self.file_inodes))
+        size += sum(sys.getsizeof(dirnames) for dirnames in self.dirnames)
+        interned = {id(name): name for names in [self.folder_names] + self.dirnames for name in names}
+        return size + sum(sys.getsizeof(name) for name in interned.values())
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __eq__(self, other):
+        if not isinstance(other, Snapshot):
+            return NotImplemented
+        self.join_names()
+        other.join_names()
+        return (self.root, self.folder_names, self.parents, self.inodes, self.dirnames, self.file_starts, self.names,
+                self.name_ends, self.sizes, self.file_inodes) == (other.root, other.folder_names, other.parents, other.inodes,
+                                                                  other.dirnames, other.file_starts, other.names,
+                                                                  other.name_ends, other.sizes, other.file_inodes)
+
+    def __repr__(self):
+        return f"Snapshot({self.root!r}, {len(self.inodes)} directories, {len(self)} files)"
+
+class SnapshotDirectories:
+    # The directories of a Snapshot as a sequence of ScannedDirectory
+    __slots__ = ('snapshot',)
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __len__(self):
+        return len(self.snapshot.inodes)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.snapshot.directory(position) for position in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("directory index out of range")
+        return self.snapshot.directory(index)
+
+    def __iter__(self):
+        for index, path in enumerate(self.snapshot.paths()):
+            yield self.snapshot.directory(index, path)
+
+# A single file in a directory and the name it will be given
+RenameEntry = namedtuple('RenameEntry', ['filename', 'target', 'size'])
+
+# A directory of the plan, its subdirectory names, its prefix regex and its files
+PlannedDirectory = namedtuple('PlannedDirectory', ['path', 'dirnames', 'regex', 'entries'])
+
+class RegexIndex:
+    # The prefix regex of every directory of a snapshot, keyed by full path so folders with the
+    # same name in different packs keep their own prefix. Built from the snapshot alone, so
+    # preview and rename share it
+    __slots__ = ('by_path',)
+
+    def __init__(self, by_path):
+        self.by_path = MappingProxyType(by_path)
+
+    def get(self, path, default=""):
+        return self.by_path.get(path, default)
+
+    def __contains__(self, path):
+        return path in self.by_path
+
+    def __len__(self):
+        return len(self.by_path)
+
+class RenamePlan(namedtuple('RenamePlan', ['root', 'directories', 'regexes'])):
+    __slots__ = ()
+
+    # Yield (source path, target path) for every file whose name changes
+    def renames(self):
+        for directory in self.directories:
+            for entry in directory.entries:
+                if entry.target != entry.filename:
+                    yield os.path.join(directory.path, entry.filename), os.path.join(directory.path, entry.target)
+
+    def __len__(self):
+        return sum(len(directory.entries) for directory in self.directories)
+
+# The text to replace isn't a usable regex, or the preview gave up on it
+class PatternError(ValueError):
+    pass
+
+class PatternTimeout(PatternError):
+    pass
+
+def data_directory(*parts):
+    path = os.path.join(os.environ.get("CANDLECLEANER_HOME", DATA_DIRECTORY), *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def normalize_filename(filename):
+    # All lowercase, with runs of spaces, hyphens and underscores turned into a single underscore
+    name, extension = os.path.splitext(filename)
+    return SEPARATOR_PATTERN.sub('_', name.lower()) + extension
+
+class PrefixNode:
+    # Names starting with prefix: count of them, ends of them equal to it, and the nodes below
+    # by the character that follows prefix
+    __slots__ = ('prefix', 'count', 'ends', 'children')
+
+    def __init__(self, prefix, count, ends):
+        self.prefix = prefix
+        self.count = count
+        self.ends = ends
+        self.children = {}
+
+class PrefixTrie:
+    # A compressed trie of the names, every node below the root parts at least two ways, so a
+    # node's prefix is the common prefix of its names. Adding a name compares each of its
+    # characters at most once, building it takes time linear in the total length of the names.
+    # clusters only visits a few nodes
+    __slots__ = ('root',)
+
+    def __init__(self, names):
+        self.root = PrefixNode("", 0, 0)
+        for name in names:
+            self.add(name)
+
+    def add(self, name):
+        node = self.root
+        node.count += 1
+        while True:
+            depth = len(node.prefix)
+            if len(name) == depth:
+                node.ends += 1
+                return
+            child = node.children.get(name[depth])
+            if child is None:
+                node.children[name[depth]] = PrefixNode(name, 1, 1)
+                return
+            if not name.startswith(child.prefix[depth:], depth):
+                # name leaves the child's prefix part way, a node is put where they part
+                split = depth + 1
+                while split < len(name) and name[split] == child.prefix[split]:
+                    split += 1
+                parent = PrefixNode(name[:split], child.count, 0)
+                parent.children[child.prefix[split]] = child
+                node.children[name[depth]] = child = parent
+            child.count += 1
+            node = child
+
+    def children(self, node):
+        # (count, node) of the groups the names of node part into, in the order of the sorted names.
+        # The names equal to the prefix come first, with no node
+        groups = [(node.ends, None)] if node.ends else []
+        groups.extend((node.children[key].count, node.children[key]) for key in sorted(node.children))
+        return groups
+
+    # Numbers are what is left after the prefix, so names that part on a digit stay together
+    def is_word_branch(self, child, depth):
+        return child is not None and not child.prefix[depth].isdigit()
+
+    def clusters(self, node=None):
+        # The prefixes of the groups of names that dominate the node. Where the common prefix is
+        # empty or ends inside a word, a few outliers like a readme are stepped over instead of
+        # cutting the prefix short, or else the names are split into one cluster per word. Names
+        # parting after a whole word, like Pack_Kick and Pack_Snare, keep the common prefix. Groups
+        # of less than MIN_CLUSTER_SIZE names aren't clusters
+        node = self.root if node is None else node
+        total = node.count
+        if total < MIN_CLUSTER_SIZE:
+            return []
+        allowed = max(1, total // OUTLIER_RATIO)
+        # Only the root can have a single child
+        while not node.ends and len(node.children) == 1:
+            node, = node.children.values()
+        children = self.children(node)
+        while len(children) > 1 and not node.prefix.endswith("_"):
+            count, best = max(children, key=lambda child: child[0])
+            if count < max(MIN_CLUSTER_SIZE, total - allowed) or not self.is_word_branch(best, len(node.prefix)):
+                break
+            node = best
+            children = self.children(node)
+        if not node.prefix.endswith("_"):
+            split = [child for count, child in children if count >= MIN_CLUSTER_SIZE and self.is_word_branch(child, len(node.prefix))]
+            if len(split) > 1:
+                return [cluster for child in split for cluster in self.clusters(child)]
+        return [node.prefix]
+
+def strip_longest_prefix(stem, prefixes):
+    for prefix in prefixes:
+        if stem.startswith(prefix):
+            return stem[len(prefix):]
+    return stem
+
+def prefix_clusters(filenames):
+    # Filter out any filenames that are hidden
+    filenames = [f for f in filenames if not f.startswith(".")]
+    if not filenames:
+        # If all filenames were hidden, there is nothing to remove
+        return None
+
+    # Normalize the filenames by replacing spaces, underscores, and hyphens with a common separator,
+    # and removing the file extension from each filename
+    split_filenames = [os.path.splitext(f) for f in filenames]
+    normalized_filenames = [SEPARATOR_PATTERN.sub('_', name.lower()) for name, extension in split_filenames]
+    common_prefix = os.path.commonprefix(normalized_filenames)
+    if common_prefix.endswith("_"):
+        # Names parting after a whole word keep the common prefix, PrefixTrie isn't needed
+        return [common_prefix]
+    clusters = PrefixTrie(normalized_filenames).clusters()
+    if not clusters or clusters == [common_prefix] or len(clusters) > MAX_PREFIX_CLUSTERS:
+        return [common_prefix]
+
+    # Clusters are only used when no two files end up with the same name, first as found and then
+    # cut back to the first whole word past the common prefix, like PackA_ and PackB_. The common
+    # prefix never makes names collide
+    extensions = [extension.lower() for name, extension in split_filenames]
+    words = [cluster[:cluster.find("_", len(common_prefix)) + 1] for cluster in clusters]
+    for candidates in (clusters, words):
+        candidates = sorted(set(filter(None, candidates)), key=lambda prefix: (-len(prefix), prefix))
+        cleaned = {(strip_longest_prefix(name, candidates), extension)
+                   for name, extension in zip(normalized_filenames, extensions)}
+        if candidates and len(cleaned) == len(filenames):
+            return candidates
+    return [common_prefix]
+
+def prefix_regex(prefixes, leading_zero=True):
+    # The regex for the prefixes from prefix_clusters, empty when there are none. Several prefixes
+    # are tried longest first, so every name loses the longest cluster prefix it starts with
+    if prefixes is None:
+        return ""
+    regexes = []
+    for prefix in prefixes:
+        if not prefix:
+            prefix = "*"
+        else:
+            if leading_zero:
+                prefix = prefix.removesuffix('0')
+        regex = re.escape(prefix).replace('\\_', '[ _-]')
+        regexes.append(regex.replace('\\-', '-'))
+    if len(regexes) == 1:
+        return regexes[0]
+    return "(?:" + "|".join(sorted(regexes, key=lambda regex: (-len(regex), regex))) + ")"
+
+def generate_regex(filenames, leading_zero=True):
+    return prefix_regex(prefix_clusters(filenames), leading_zero)
+
+def capitalize_string(filename):
+    words = filename.split("_")
+    capitalized_words = []
+    if words[0].lower() == "the":
+        words[0] = words[0].capitalize()
+    for word in words:
+        if not (word.lower() in LOWERCASE_WORDS):
+            word = word.capitalize()
+        capitalized_words.append(word)
+    output_string = "_".join(capitalized_words)
+    return output_string
+
+def replace_underscore(filename):
+    words = filename.split("_")
+    words = " ".join(words)
+    return words
+
+def upper_bpm(filename):
+    return filename.replace('bpm', 'BPM')
+
+# Repeats that try again with one occurrence less when the rest of the pattern fails to match.
+# Possessive repeats and atomic groups never do, so they aren't looked into
+BACKTRACKING_REPEATS = {sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT}
+
+NESTED_REPEAT = "Pattern rejected: a repeat inside a repeat, like (a+)+, can take forever on some names"
+OVERLAPPING_BRANCHES = "Pattern rejected: a repeated choice whose options match the same text, like (a|a)* or (.|\\w)*, can take forever on some names"
+
+CATEGORY_TESTS = {
+    sre_parse.CATEGORY_DIGIT: str.isdecimal,
+    sre_parse.CATEGORY_NOT_DIGIT: lambda char: not char.isdecimal(),
+    sre_parse.CATEGORY_SPACE: str.isspace,
+    sre_parse.CATEGORY_NOT_SPACE: lambda char: not char.isspace(),
+    sre_parse.CATEGORY_WORD: lambda char: char.isalnum() or char == "_",
+    sre_parse.CATEGORY_NOT_WORD: lambda char: not (char.isalnum() or char == "_"),
+}
+
+def same_letter(char, code):
+    # Patterns are matched ignoring case
+    return char.lower() == chr(code).lower()
+
+def in_class(items, char):
+    # Whether char is in the [...] class of a parsed IN item
+    negate = False
+    matched = False
+    for op, value in items:
+        if op is sre_parse.NEGATE:
+            negate = True
+        elif op is sre_parse.LITERAL:
+            matched = matched or same_letter(char, value)
+        elif op is sre_parse.RANGE:
+            low, high = value
+            matched = matched or any(len(case) == 1 and low <= ord(case) <= high for case in (char, char.lower(), char.upper()))
+        elif op is sre_parse.CATEGORY:
+            matched = matched or CATEGORY_TESTS.get(value, lambda char: True)(char)
+    return matched != negate
+
+def first_characters(items, probes):
+    # (the probes items can start with, whether they can match nothing). Anything not understood
+    # counts as starting with every probe
+    first = set()
+    for op, value in items:
+        nullable = False
+        if op is sre_parse.LITERAL:
+            chars = {char for char in probes if same_letter(char, value)}
+        elif op is sre_parse.NOT_LITERAL:
+            chars = {char for char in probes if not same_letter(char, value)}
+        elif op is sre_parse.IN:
+            chars = {char for char in probes if in_class(value, char)}
+        elif op is sre_parse.SUBPATTERN:
+            chars, nullable = first_characters(value[-1], probes)
+        elif op is sre_parse.BRANCH:
+            branches = [first_characters(branch, probes) for branch in value[1]]
+            chars = set().union(*(branch_chars for branch_chars, branch_nullable in branches))
+            nullable = any(branch_nullable for branch_chars, branch_nullable in branches)
+        elif op in BACKTRACKING_REPEATS:
+            chars, nullable = first_characters(value[2], probes)
+            nullable = nullable or value[0] == 0
+        elif op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            # Anchors and lookarounds don't take up a character
+            continue
+        else:
+            chars, nullable = set(probes), True
+        first |= chars
+        if not nullable:
+            return first, False
+    return first, True
+
+def overlapping_branches(branches, probes):
+    # Whether two branches can start with the same character or both match nothing, so a repeat of
+    # them can split a name between them in exponentially many ways
+    starts = [first_characters(branch, probes) for branch in branches]
+    for index, (chars, nullable) in enumerate(starts):
+        for other_chars, other_nullable in starts[index + 1:]:
+            if chars & other_chars or (nullable and other_nullable):
+                return True
+    return False
+
+def backtracking_risk(items, probes, in_repeat=False):
+    # Why the pattern could backtrack for minutes on a single name, None when it can't tell. A
+    # repeat of more than one occurrence that holds another one, like (a+)+ or (\w+_?)*, or a
+    # choice between overlapping branches, like (a|a)*, lets the occurrences be split in
+    # exponentially many ways, each tried before a name that almost matches is given up on
+    for op, value in items:
+        risk = None
+        if op in BACKTRACKING_REPEATS:
+            low, high, body = value
+            if high > 1 and in_repeat:
+                return NESTED_REPEAT
+            risk = backtracking_risk(body, probes, in_repeat or high > 1)
+        elif op is sre_parse.SUBPATTERN:
+            risk = backtracking_risk(value[-1], probes, in_repeat)
+        elif op is sre_parse.BRANCH:
+            if in_repeat and overlapping_branches(value[1], probes):
+                return OVERLAPPING_BRANCHES
+            risk = next(filter(None, (backtracking_risk(branch, probes, in_repeat) for branch in value[1])), None)
+        elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            risk = backtracking_risk(value[1], probes, in_repeat)
+        elif op is sre_parse.GROUPREF_EXISTS:
+            risk = next(filter(None, (backtracking_risk(branch, probes, in_repeat) for branch in value[1:] if branch is not None)), None)
+        if risk:
+            return risk
+    return None
+
+@functools.lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def compile_pattern(text, replacement="", use_regex=False):
+    # The pattern of the text to replace, checked before any name is matched against it. Without
+    # use_regex the text is matched literally. Raises PatternError for a regex or replacement that
+    # doesn't compile and for a regex that could backtrack for minutes on a single name. The check
+    # can't catch every slow pattern, the window also matches under a time budget in a PatternWorker
+    if not use_regex:
+        return re.compile(re.escape(text), re.IGNORECASE)
+    try:
+        pattern = re.compile(text, re.IGNORECASE)
+        # Substituting into an empty string checks the group references of the replacement
+        pattern.sub(replacement, "")
+    except re.error as error:
+        raise PatternError("Invalid pattern: " + str(error)) from None
+    risk = backtracking_risk(sre_parse.parse(text, re.IGNORECASE), set(PROBE_CHARACTERS + text))
+    if risk:
+        raise PatternError(risk)
+    return pattern
+
+@functools.lru_cache(maxsize=4096)
+def compile_transform(regex, options):
+    # Build the whole rename chain for a directory's prefix regex and the options once, the
+    # returned callable is then applied to every file of the directory
+    if options.smart_update:
+        # Smart cleaning strips the directory's prefix regex from the normalized name
+        if not regex:
+            return str
+        pattern = re.compile(regex, re.IGNORECASE)
+        steps = [normalize_filename, functools.partial(pattern.sub, "")]
+    else:
+        if not options.string_to_remove:
+            return str
+        pattern = compile_pattern(options.string_to_remove, options.replacement, options.use_regex)
+        replacement = options.replacement
+        if not options.use_regex:
+            # Backslashes are escaped so the replacement is inserted literally
+            replacement = replacement.replace('\\', '\\\\')
+        steps = [functools.partial(pattern.sub, replacement)]
+    return chain_steps(steps + finishing_steps(options))
+
+def finishing_steps(options):
+    # The casing and underscore steps, run on a name once the prefix or text is removed
+    steps = []
+    if options.upper_bpm: steps.append(upper_bpm)
+    if options.capitalize: steps.append(capitalize_string)
+    if options.underscore: steps.append(replace_underscore)
+    return steps
+
+def chain_steps(steps):
+    if not steps:
+        return str
+    if len(steps) == 1:
+        return steps[0]
+
+    def transform(filename):
+        for step in steps:
+            filename = step(filename)
+        return filename
+    return transform
+
+def clean_filename(filename, regex, options):
+    return compile_transform(regex, options)(filename)
+
+def glob_matcher(globs):
+    # One match function for a list of globs, None for no globs
+    if not globs:
+        return None
+    return re.compile("|".join(fnmatch.translate(os.path.normcase(glob)) for glob in globs)).match
+
+class ScanFilter:
+    # ScanRules compiled once per scan and checked for every entry before it is stat'ed
+    __slots__ = ('name_match', 'path_match', 'extensions', 'max_depth', 'include_hidden')
+
+    def __init__(self, rules):
+        self.name_match = glob_matcher([glob for glob in rules.exclude if "/" not in glob])
+        self.path_match = glob_matcher([glob.strip("/") for glob in rules.exclude if "/" in glob])
+        self.extensions = frozenset("." + extension.lower().lstrip(".") for extension in rules.extensions) or None
+        self.max_depth = rules.max_depth
+        self.include_hidden = rules.include_hidden
+
+    # relative is the path of the entry's folder from the scanned directory, "" or ending in "/"
+    def excluded(self, name, relative):
+        if not self.include_hidden and name.startswith("."):
+            return True
+        if self.name_match is not None and self.name_match(os.path.normcase(name)):
+            return True
+        return self.path_match is not None and self.path_match(os.path.normcase(relative + name)) is not None
+
+    def keep_file(self, name, relative):
+        if self.extensions is not None and os.path.splitext(name)[1].lower() not in self.extensions:
+            return False
+        return not self.excluded(name, relative)
+
+    # depth is the number of folder levels the subdirectory is below the scanned directory
+    def keep_directory(self, name, relative, depth):
+        if self.max_depth is not None and depth > self.max_depth:
+            return False
+        return not self.excluded(name, relative)
+
+def relative_path(root, path):
+    # The path of a folder from root for ScanFilter, "" for root itself
+    if path == root:
+        return ""
+    return os.path.relpath(path, root).replace(os.sep, "/") + "/"
+
+def scan_entries(dirpath, fd=None, scan_filter=None, relative=""):
+    # List a single directory, returning (subdirectory entries, file entries). Unreadable
+    # directories are skipped like os.walk does. Given the directory's open fd, it is listed and its
+    # files stat'ed relative to it. Entries the scan_filter leaves out are never stat'ed
+    dirs = []
+    files = []
+    depth = relative.count("/") + 1
+    try:
+        with os.scandir(dirpath if fd is None else fd) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir():
+                        if scan_filter is not None and not scan_filter.keep_directory(entry.name, relative, depth):
+                            continue
+                        # Symlinked folders are listed but not descended into, like os.walk
+                        dirs.append((ScanEntry(entry.name, 0, True, entry.inode()), entry.is_symlink()))
+                    elif entry.name not in IGNORED_FILES and (scan_filter is None or scan_filter.keep_file(entry.name, relative)):
+                        files.append(ScanEntry(entry.name, entry.stat().st_size, False, entry.inode()))
+                except OSError:
+                    # The entry was removed after the directory was listed
+                    continue
+    except OSError:
+        return None
+    return dirs, files
+
+def list_directory(dirpath, inode, fd=None, scan_filter=None, relative=""):
+    # Scan a single directory, returning (ScannedDirectory, [(name, inode) of the subdirectories to
+    # descend into]) or None when it can't be read
+    listing = scan_entries(dirpath, fd, scan_filter, relative)
+    if listing is None:
+        return None
+    dirs, files = listing
+    directory = ScannedDirectory(dirpath, inode, tuple(entry.name for entry, is_symlink in dirs), tuple(files))
+    return directory, tuple((entry.name, entry.inode) for entry, is_symlink in dirs if not is_symlink)
+
+class ParentHandle:
+    # An open directory of iter_scan and how many of its subdirectories are still to be opened
+    # relative to it, it is closed after the last one
+    __slots__ = ('fd', 'pending')
+
+    def __init__(self, fd, pending):
+        self.fd = fd
+        self.pending = pending
+
+def open_subdirectory(dirpath, name, parent):
+    # Open a directory found by the scan relative to its parent's handle, without following a
+    # symlink that replaced it since it was listed. Returns None when it can't be opened
+    try:
+        if parent is None:
+            return os.open(dirpath, DIRECTORY_FLAGS)
+        return os.open(name, DIRECTORY_FLAGS | getattr(os, "O_NOFOLLOW", 0), dir_fd=parent.fd)
+    except OSError:
+        return None
+    finally:
+        if parent is not None:
+            parent.pending -= 1
+            if parent.pending == 0:
+                os.close(parent.fd)
+
+def iter_scan(directory_path, cancel=None, cache=None, rules=None, relative=""):
+    # Walk top down in os.walk order, yielding one ScannedDirectory at a time so callers can stream
+    # results, stopping early once the cancel event is set. A cache with a list_directory method
+    # can stand in for listing directories that haven't changed. With USE_DIR_FD, each directory is
+    # opened relative to its parent, which stays open until its last subdirectory is, so at most
+    # one handle per level of the tree is open. Only what the ScanRules (the defaults without
+    # rules) take in is listed, relative is the path of directory_path within the library when
+    # only part of it is scanned. The paths walked never end in a separator, even when
+    # directory_path does
+    directory_path = os.path.normpath(directory_path)
+    try:
+        root_inode = os.stat(directory_path).st_ino
+    except OSError:
+        return
+    lister = list_directory if cache is None else cache.list_directory
+    scan_filter = ScanFilter(rules or ScanRules())
+    use_dir_fd = USE_DIR_FD
+    stack = [(directory_path, None, root_inode, None, relative)]
+    try:
+        while stack:
+            if cancel is not None and cancel.is_set():
+                return
+            dirpath, name, inode, parent, relative = stack.pop()
+            fd = None
+            if use_dir_fd:
+                fd = open_subdirectory(dirpath, name, parent)
+                if fd is None:
+                    continue
+            listed = lister(dirpath, inode, fd, scan_filter, relative)
+            handle = None
+            if listed is not None and listed[1] and fd is not None:
+                handle = ParentHandle(fd, len(listed[1]))
+            elif fd is not None:
+                os.close(fd)
+            if listed is None:
+                continue
+            directory, subdirectories = listed
+            # Pushed before yielding, so a handle is never open without its subdirectories on the stack
+            for name, child_inode in reversed(subdirectories):
+                stack.append((os.path.join(dirpath, name), name, child_inode, handle, relative + name + "/"))
+            yield directory
+    finally:
+        # Handles of the directories left unopened when the scan stops early
+        for dirpath, name, inode, parent, relative in stack:
+            if parent is not None and parent.pending:
+                parent.pending = 0
+                os.close(parent.fd)
+
+def scan_directory(directory_path, cancel=None, cache=None, rules=None):
+    return Snapshot(os.path.normpath(directory_path), tuple(iter_scan(directory_path, cancel, cache, rules)))
+
+class DirectoryHandles:
+    # Stats and renames files relative to open handles of their folders, keeping the HANDLE_LIMIT
+    # most recently used folders open, so a run of files in one folder resolves its path once instead of
+    # on every call. Without USE_DIR_FD, or when a folder can't be opened, full paths are used. Not
+    # shared between threads
+    def __init__(self, limit=HANDLE_LIMIT):
+        self.limit = limit
+        self.handles = {}
+        self.enabled = USE_DIR_FD
+
+    def split(self, path, keep=None):
+        # (folder handle, name) of path, or (None, path). The handle of the folder keep, which the
+        # caller still uses, is never closed to make room
+        if not self.enabled:
+            return None, path
+        folder, name = os.path.split(path)
+        fd = self.handles.pop(folder, None)
+        if fd is None:
+            try:
+                fd = os.open(folder or os.curdir, DIRECTORY_FLAGS)
+            except OSError:
+                return None, path
+            # The least recently used come first
+            evicted = [other for other in self.handles if other != keep][:max(0, len(self.handles) + 1 - self.limit)]
+            for other in evicted:
+                os.close(self.handles.pop(other))
+        self.handles[folder] = fd
+        return fd, name
+
+    def stat(self, path, follow_symlinks=True):
+        fd, name = self.split(path)
+        return os.stat(name, dir_fd=fd, follow_symlinks=follow_symlinks)
+
+    def lexists(self, path):
+        try:
+            self.stat(path, follow_symlinks=False)
+        except OSError:
+            return False
+        return True
+
+    def rename(self, src, dst):
+        src_fd, src_name = self.split(src)
+        dst_fd, dst_name = self.split(dst, keep=os.path.dirname(src))
+        os.rename(src_name, dst_name, src_dir_fd=src_fd, dst_dir_fd=dst_fd)
+
+    def close(self):
+        for fd in self.handles.values():
+            os.close(fd)
+        self.handles = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def is_within(path, directory_path):
+    return path == directory_path or path.startswith(os.path.join(directory_path, ""))
+
+def refresh_directories(snapshot, dirpaths, rules=None):
+    # Relist the given directories of a snapshot, scanning subdirectories that appeared and dropping
+    # the ones that went away. Returns (new snapshot, paths relisted or added, paths removed).
+    # Directories that didn't change are copied over from the old snapshot as they are. rules must
+    # be the ScanRules the snapshot was scanned with
+    scan_filter = ScanFilter(rules or ScanRules())
+    directories = {path: index for index, path in enumerate(snapshot.paths())}
+    changed = set()
+    removed = set()
+
+    def inode_of(path):
+        value = directories[path]
+        return value.inode if isinstance(value, ScannedDirectory) else snapshot.inodes[value]
+
+    def drop(path):
+        for other in [other for other in directories if is_within(other, path)]:
+            del directories[other]
+            changed.discard(other)
+            removed.add(other)
+
+    for dirpath in sorted(dirpaths, key=len):
+        if dirpath not in directories:
+            # Unknown, or already dropped with a parent
+            continue
+        value = directories[dirpath]
+        old_dirnames = value.dirnames if isinstance(value, ScannedDirectory) else snapshot.dirnames[value]
+        relative = relative_path(snapshot.root, dirpath)
+        listed = list_directory(dirpath, inode_of(dirpath), None, scan_filter, relative)
+        if listed is None:
+            drop(dirpath)
+            continue
+        directory, subdirectories = listed
+        directories[dirpath] = directory
+        changed.add(dirpath)
+        for name in set(old_dirnames) - set(directory.dirnames):
+            drop(os.path.join(dirpath, name))
+        for name, inode in subdirectories:
+            path = os.path.join(dirpath, name)
+            if path in directories and inode_of(path) != inode:
+                # Replaced by another folder with the same name
+                drop(path)
+            if path not in directories:
+                for added in iter_scan(path, rules=rules, relative=relative + name + "/"):
+                    directories[added.path] = added
+                    changed.add(added.path)
+                    removed.discard(added.path)
+
+    # Put the directories back in os.walk order
+    refreshed = Snapshot(snapshot.root)
+    stack = [snapshot.root]
+    while stack:
+        path = stack.pop()
+        value = directories.get(path)
+        if value is None:
+            continue
+        if isinstance(value, ScannedDirectory):
+            refreshed.add_directory(value)
+            dirnames = value.dirnames
+        else:
+            refreshed.copy_directory(snapshot, value, path)
+            dirnames = snapshot.dirnames[value]
+        stack.extend(os.path.join(path, name) for name in reversed(dirnames))
+    refreshed.join_names()
+    return refreshed, changed, removed
+
+def build_regex_index(snapshot, leading_zero=True, prefixes=None):
+    # prefixes can map directory paths to their prefix_clusters, computed by an earlier scan
+    by_path = {}
+    for index, path in enumerate(snapshot.paths()):
+        if prefixes is not None and path in prefixes:
+            regex = prefix_regex(prefixes[path], leading_zero)
+        else:
+            regex = generate_regex(snapshot.file_names(index), leading_zero)
+        if regex:
+            by_path[path] = regex
+    return RegexIndex(by_path)
+
+def update_regex_index(regex_index, directories, removed, leading_zero=True):
+    # A copy of regex_index with the regexes of the given directories regenerated and the removed
+    # paths dropped, the other directories keep theirs
+    by_path = dict(regex_index.by_path)
+    for path in removed:
+        by_path.pop(path, None)
+    for directory in directories:
+        regex = generate_regex([file.name for file in directory.files], leading_zero)
+        if regex:
+            by_path[directory.path] = regex
+        else:
+            by_path.pop(directory.path, None)
+    return RegexIndex(by_path)
+
+class StageCache:
+    # The intermediate names of smart cleaning for every directory path, so toggling an option
+    # only redoes the steps after it: the prefix_clusters (the leading zero option only changes
+    # how they become a regex), the normalized names and the names with the last prefix regex
+    # stripped (the casing and underscore options only run on those). Entries are kept until
+    # discard, so directories that are relisted must be discarded
+    __slots__ = ('prefixes', 'normalized', 'stripped')
+
+    def __init__(self, prefixes=None):
+        self.prefixes = dict(prefixes or {})
+        self.normalized = {}
+        self.stripped = {}
+
+    def regex_index(self, snapshot, leading_zero=True):
+        prefixes = self.prefixes
+        for index, path in enumerate(snapshot.paths()):
+            if path not in prefixes:
+                prefixes[path] = prefix_clusters(snapshot.file_names(index))
+        return build_regex_index(snapshot, leading_zero, prefixes)
+
+    def strip(self, path, names, regex):
+        # names normalized and without regex, as a tuple
+        stripped = self.stripped.get(path)
+        if stripped is not None and stripped[0] == regex:
+            return stripped[1]
+        normalized = self.normalized.get(path)
+        if normalized is None:
+            normalized = self.normalized[path] = tuple(map(normalize_filename, names))
+        names = tuple(map(functools.partial(re.compile(regex, re.IGNORECASE).sub, ""), normalized))
+        self.stripped[path] = (regex, names)
+        return names
+
+    def memory_size(self):
+        # Bytes held by the kept names, prefixes not counted
+        size = 0
+        for names in list(self.normalized.values()) + [stripped[1] for stripped in self.stripped.values()]:
+            size += sys.getsizeof(names) + sum(sys.getsizeof(name) for name in names)
+        return size
+
+    def discard(self, paths):
+        for path in paths:
+            self.prefixes.pop(path, None)
+            self.normalized.pop(path, None)
+            self.stripped.pop(path, None)
+
+def pattern_worker_main(connection):
+    # The child process of a PatternWorker, it says it is ready and then answers (options, names)
+    # with (True, new names) or (False, error message)
+    connection.send(None)
+    while True:
+        try:
+            options, names = connection.recv()
+        except EOFError:
+            return
+        try:
+            transform = compile_transform("", options)
+            connection.send((True, [transform(name) for name in names]))
+        except Exception as error:
+            connection.send((False, str(error)))
+
+class PatternWorker:
+    # Runs the regex of the text to replace over names in a child process. Python's re can't be
+    # interrupted while it backtracks on a name, so a pattern that runs out of its budget is stopped
+    # by killing the process, and the next pattern starts a new one
+    __slots__ = ('process', 'connection')
+
+    def __init__(self):
+        self.process = None
+        self.connection = None
+
+    def start(self):
+        import multiprocessing
+        # spawn works the same everywhere and doesn't fork the window's threads
+        context = multiprocessing.get_context("spawn")
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=pattern_worker_main, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+        if not self.connection.poll(WORKER_START_TIMEOUT):
+            self.stop()
+            raise PatternError("The pattern worker didn't start")
+        self.connection.recv()
+
+    def targets(self, options, names, budget):
+        # {name: new name} for names, raises PatternTimeout once budget seconds passed
+        if self.process is None or not self.process.is_alive():
+            self.start()
+        names = list(dict.fromkeys(names))
+        try:
+            self.connection.send((options, names))
+            if not self.connection.poll(max(budget, 0)):
+                self.stop()
+                raise PatternTimeout("Pattern too slow, the preview was stopped")
+            succeeded, value = self.connection.recv()
+        except (EOFError, OSError):
+            self.stop()
+            raise PatternError("The pattern worker stopped unexpectedly") from None
+        if not succeeded:
+            raise PatternError(value)
+        return dict(zip(names, value))
+
+    def stop(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.join()
+            self.connection.close()
+        self.process = None
+        self.connection = None
+
+def plan_files(path, dirnames, names, sizes, options, regex_index=None, known_targets=None, stages=None):
+    # Only names are computed here, the filesystem is not touched. known_targets maps names to new
+    # names already worked out for the text to replace, by a PatternWorker. With a StageCache,
+    # smart cleaning starts from its stripped names
+    if not options.smart_update:
+        regex = ""
+    elif regex_index is not None:
+        regex = regex_index.get(path)
+    else:
+        regex = generate_regex(names, options.leading_zero)
+    if options.smart_update and regex and stages is not None:
+        targets = map(chain_steps(finishing_steps(options)), stages.strip(path, names, regex))
+    else:
+        transform = compile_transform(regex, options)
+        targets = map(transform if known_targets is None else known_targets.__getitem__, names)
+    entries = tuple(map(RenameEntry, names, targets, sizes))
+    return PlannedDirectory(path, dirnames, regex, entries)
+
+def plan_directory(directory, options, regex_index=None, known_targets=None, stages=None):
+    return plan_files(directory.path, directory.dirnames, [file.name for file in directory.files],
+                      [file.size for file in directory.files], options, regex_index, known_targets, stages)
+
+def iter_plan(directory_path, options, cancel=None, rules=None):
+    # Scan and plan one directory at a time without keeping the tree, each directory's regex is
+    # generated from its own files exactly like build_regex_index does
+    for directory in iter_scan(directory_path, cancel, rules=rules):
+        yield plan_directory(directory, options)
+
+def make_plan(root, planned_directories):
+    planned_directories = tuple(planned_directories)
+    regexes = {directory.path: directory.regex for directory in planned_directories if directory.regex}
+    return RenamePlan(root, planned_directories, MappingProxyType(regexes))
+
+def build_plan(snapshot, options, regex_index=None, known_targets=None, stages=None):
+    if options.smart_update and regex_index is None:
+        regex_index = build_regex_index(snapshot, options.leading_zero) if stages is None else stages.regex_index(snapshot, options.leading_zero)
+    # Planned straight from the snapshot's arrays, without building its ScanEntry records
+    return make_plan(snapshot.root, (plan_files(path, snapshot.dirnames[index], snapshot.file_names(index), snapshot.file_sizes(index),
+                                                options, regex_index, known_targets, stages)
+                                     for index, path in enumerate(snapshot.paths())))
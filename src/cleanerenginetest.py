@@ -0,0 +1,297 @@
+import unittest
+import cleanerengine
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from unittest.mock import patch
+from cleanerengine import CleanerOptions, ScanRules, Snapshot, iter_scan, list_directory, scan_directory, refresh_directories, build_regex_index, update_regex_index, build_plan, StageCache, generate_regex, prefix_clusters, PrefixTrie, clean_filename, capitalize_string, compile_transform, compile_pattern, PatternError, PatternTimeout, PatternWorker
+from cleanercli import main
+
+class TestCleanerEngine(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        # Journals go to a throwaway home instead of ~/.candlecleaner
+        self.home = tempfile.mkdtemp()
+        environment = patch.dict(os.environ, {'CANDLECLEANER_HOME': self.home})
+        environment.start()
+        self.addCleanup(environment.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        shutil.rmtree(self.home)
+
+    def make_files(self, *paths):
+        for path in paths:
+            path = os.path.join(self.directory, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').close()
+
+    def test_generate_regex(self):
+        self.assertEqual(generate_regex(['Pack_Kick_01.wav', 'pack kick-02.wav', '.DS_Store']), 'pack_kick_')
+        self.assertEqual(generate_regex(['Pack_Kick_01.wav', 'Pack_Kick_02.wav'], leading_zero=False), 'pack_kick_0')
+        self.assertEqual(generate_regex(['kick.wav', 'snare.wav']), '\\*')
+        self.assertEqual(generate_regex(['.DS_Store']), '')
+
+    def test_prefix_clusters(self):
+        # An outlier doesn't cut the prefix short
+        kicks = ['Pack_Kick_01.wav', 'Pack_Kick_02.wav', 'Pack_Kick_03.wav']
+        self.assertEqual(prefix_clusters(kicks + ['readme.txt']), ['pack_kick_0'])
+        self.assertEqual(clean_filename('readme.txt', generate_regex(kicks + ['readme.txt']), CleanerOptions(smart_update=True)), 'readme.txt')
+        # Names parting after a whole word or on a number keep the common prefix
+        self.assertEqual(prefix_clusters(['Pack_Kick_01.wav', 'Pack_Kick_02.wav', 'Pack_Snare_03.wav']), ['pack_'])
+        self.assertEqual(prefix_clusters(['kick_%03d.wav' % number for number in range(1, 101)]), ['kick_'])
+        # Two packs in one folder each lose their own prefix, the longest matching one
+        packs = ['PackA_Kick_01.wav', 'PackA_Kick_02.wav', 'Other_Snare_11.wav', 'Other_Snare_12.wav']
+        regex = generate_regex(packs)
+        self.assertEqual(regex, '(?:other_|packa_)')
+        options = CleanerOptions(smart_update=True)
+        self.assertEqual([clean_filename(name, regex, options) for name in packs], ['kick_01.wav', 'kick_02.wav', 'snare_11.wav', 'snare_12.wav'])
+        # Clusters that would give two files the same name fall back to the common prefix
+        self.assertEqual(prefix_clusters(['Kick_01.wav', 'Kick_02.wav', 'Snare_01.wav', 'Snare_02.wav']), [''])
+        self.assertIsNone(prefix_clusters(['.DS_Store']))
+
+    def test_prefix_trie(self):
+        trie = PrefixTrie(['pack_kick_01', 'pack_kick_02', 'pack_snare_01', 'readme'])
+        self.assertEqual(trie.root.count, 4)
+        (pack_count, pack), (readme_count, readme) = trie.children(trie.root)
+        self.assertEqual((pack.prefix, pack_count, readme.prefix, readme_count), ('pack_', 3, 'readme', 1))
+        self.assertEqual([(count, child.prefix) for count, child in trie.children(pack)], [(2, 'pack_kick_0'), (1, 'pack_snare_01')])
+        # A name that is the prefix of others is a group of its own, listed first
+        trie = PrefixTrie(['pack_kick', 'pack', 'pack'])
+        self.assertEqual([(count, child and child.prefix) for count, child in trie.children(trie.root.children['p'])], [(2, None), (1, 'pack_kick')])
+        # A big folder with an outlier is one pass over the names and a few nodes
+        names = ['candle_dusk_kick_%05d' % number for number in range(50000)] + ['readme']
+        self.assertEqual(PrefixTrie(names).clusters(), ['candle_dusk_kick_'])
+
+    def test_clean_filename(self):
+        options = CleanerOptions(smart_update=True, upper_bpm=True, underscore=True)
+        self.assertEqual(clean_filename('Pack Kick-01 120bpm.wav', 'pack_kick_', options), '01 120BPM.wav')
+        options = CleanerOptions(smart_update=True, capitalize=True, underscore=True)
+        self.assertEqual(clean_filename('the_end_of_it.wav', '\\*', options), 'The End of It.wav')
+        options = CleanerOptions(string_to_remove='TEST_', replacement='\\1')
+        self.assertEqual(clean_filename('test_file1.txt', '', options), '\\1file1.txt')
+        self.assertEqual(capitalize_string('the_kick_and_snare'), 'The_Kick_and_Snare')
+
+    def test_compile_transform_is_cached(self):
+        options = CleanerOptions(smart_update=True, underscore=True)
+        transform = compile_transform('pack_', options)
+        self.assertIs(compile_transform('pack_', options), transform)
+        self.assertIsNot(compile_transform('pack_', options._replace(underscore=False)), transform)
+        self.assertEqual(transform('Pack-Kick_01.wav'), 'kick 01.wav')
+
+    def test_regex_mode(self):
+        options = CleanerOptions(string_to_remove='_(\\d+)bpm', replacement=' \\1 BPM', use_regex=True)
+        self.assertEqual(clean_filename('Loop_120bpm.wav', '', options), 'Loop 120 BPM.wav')
+        self.assertEqual(clean_filename('Loop_120bpm.wav', '', options._replace(use_regex=False)), 'Loop_120bpm.wav')
+        self.assertIs(compile_pattern('_(\\d+)bpm', ' \\1 BPM', True), compile_pattern('_(\\d+)bpm', ' \\1 BPM', True))
+        for text, replacement in [('[', ''), ('kick', '\\1'), ('(a+)+$', ''), ('(\\w+_?)*x', ''), ('(a|a)*b', ''),
+                                  ('(.|\\w)*_bpm', ''), ('(kick|KICK_)+x', ''), ('(x?|y?)*z', '')]:
+            with self.assertRaises(PatternError):
+                compile_pattern(text, replacement, True)
+        # Possessive repeats and atomic groups don't backtrack, and neither do choices that can't
+        # start the same way
+        compile_pattern('(?>\\w+_?)*x', '', True)
+        compile_pattern('(kick|snare|\\d)+_', '', True)
+        compile_pattern('[', '', False)
+
+        self.make_files('Pack_Kick_01.wav', 'Pack_Kick_02.wav')
+        snapshot = scan_directory(self.directory)
+        names = snapshot.file_names(0)
+        worker = PatternWorker()
+        try:
+            # Not caught by the check, but takes far longer than the budget on a long name
+            slow = options._replace(string_to_remove='.*.*.*.*.*.*.*=', replacement='')
+            started = time.perf_counter()
+            with self.assertRaises(PatternTimeout):
+                worker.targets(slow, names + ['a' * 500], 0.2)
+            self.assertLess(time.perf_counter() - started, 5)
+            self.assertIsNone(worker.process)
+            # The next pattern gets a new worker
+            good = options._replace(string_to_remove='^pack_(\\w+)_(\\d+)', replacement='\\2_\\1')
+            plan = build_plan(snapshot, good, known_targets=worker.targets(good, names, 30))
+            self.assertEqual(sorted(os.path.basename(dst) for src, dst in plan.renames()), ['01_Kick.wav', '02_Kick.wav'])
+        finally:
+            worker.stop()
+
+    def test_build_plan(self):
+        self.make_files('Pack_Kick_01.wav', 'Pack_Kick_02.wav', '.DS_Store', 'loops/Pack_Loop_A.wav', 'loops/Pack_Loop_B.wav')
+        plan = build_plan(scan_directory(self.directory), CleanerOptions(smart_update=True))
+        self.assertEqual(len(plan), 4)
+        self.assertEqual(plan.regexes[self.directory], 'pack_kick_')
+        self.assertEqual(plan.regexes[os.path.join(self.directory, 'loops')], 'pack_loop_')
+        self.assertEqual(sorted(os.path.basename(dst) for src, dst in plan.renames()), ['01.wav', '02.wav', 'a.wav', 'b.wav'])
+        with self.assertRaises(TypeError):
+            plan.regexes[self.directory] = ''
+
+    def test_scan_matches_os_walk(self):
+        self.make_files('b/x.wav', 'b/c/y.wav', 'a/z.wav', 'top.wav', '.DS_Store')
+        with open(os.path.join(self.directory, 'top.wav'), 'w') as f:
+            f.write('1234')
+        scanned = list(iter_scan(self.directory))
+        walked = list(os.walk(self.directory))
+        self.assertEqual([directory.path for directory in scanned], [dirpath for dirpath, dirnames, filenames in walked])
+        for directory, (dirpath, dirnames, filenames) in zip(scanned, walked):
+            self.assertEqual(sorted(directory.dirnames), sorted(dirnames))
+            self.assertEqual(sorted(file.name for file in directory.files), sorted(set(filenames) - {'.DS_Store'}))
+            self.assertEqual(directory.inode, os.stat(dirpath).st_ino)
+        top = next(file for file in scanned[0].files if file.name == 'top.wav')
+        self.assertEqual((top.size, top.is_dir, top.inode), (4, False, os.stat(os.path.join(self.directory, 'top.wav')).st_ino))
+
+    @unittest.skipUnless(cleanerengine.USE_DIR_FD, 'directory handles are not supported here')
+    def test_scan_with_directory_handles(self):
+        self.make_files('b/x.wav', 'b/c/d/y.wav', 'a/z.wav', 'top.wav')
+        os.symlink(os.path.join(self.directory, 'b'), os.path.join(self.directory, 'link'))
+        with patch.object(cleanerengine, 'USE_DIR_FD', False):
+            by_path = scan_directory(self.directory)
+        self.assertEqual(scan_directory(self.directory), by_path)
+        # A scan stopped early closes the handles it kept open
+        open_handles = len(os.listdir('/proc/self/fd')) if os.path.isdir('/proc/self/fd') else None
+        scan = iter_scan(self.directory)
+        next(scan)
+        next(scan)
+        scan.close()
+        if open_handles is not None:
+            self.assertEqual(len(os.listdir('/proc/self/fd')), open_handles)
+
+    def test_scan_rules(self):
+        self.make_files('Kicks/Kick_01.wav', 'Kicks/.Kick_02.wav', 'Kicks/Layers/Kick_03.wav', 'readme.txt',
+                        '.git/objects/ab', 'Renders/Mix.mov', 'Renders/Mix.WAV', 'Projects/Song/Bounce.wav')
+        def listed(snapshot):
+            return sorted(os.path.relpath(os.path.join(path, name), self.directory)
+                          for index, path in enumerate(snapshot.paths()) for name in snapshot.file_names(index))
+        # Hidden files and folders are left out by default
+        self.assertEqual(listed(scan_directory(self.directory)), ['Kicks/Kick_01.wav', 'Kicks/Layers/Kick_03.wav', 'Projects/Song/Bounce.wav',
+                                                                  'Renders/Mix.WAV', 'Renders/Mix.mov', 'readme.txt'])
+        self.assertEqual(len(scan_directory(self.directory, rules=ScanRules(include_hidden=True))), 8)
+
+        rules = ScanRules(exclude=('/Projects/', 'Layers'), extensions=('wav', '.aif'))
+        listed_paths = []
+        with patch.object(cleanerengine, 'list_directory', side_effect=lambda path, *args: listed_paths.append(path) or list_directory(path, *args)):
+            snapshot = scan_directory(self.directory, rules=rules)
+        self.assertEqual(listed(snapshot), ['Kicks/Kick_01.wav', 'Renders/Mix.WAV'])
+        # Excluded folders are pruned before they are listed
+        self.assertEqual(sorted(os.path.relpath(path, self.directory) for path in listed_paths), ['.', 'Kicks', 'Renders'])
+        self.assertEqual(listed(scan_directory(self.directory, rules=ScanRules(max_depth=0))), ['readme.txt'])
+        self.assertEqual(listed(scan_directory(self.directory, rules=ScanRules(max_depth=1))), ['Kicks/Kick_01.wav', 'Renders/Mix.WAV',
+                                                                                                 'Renders/Mix.mov', 'readme.txt'])
+        # Folders appearing later get the same rules
+        self.make_files('Projects/Other/Bounce.wav', 'Hats/Hat_01.wav', 'Hats/Layers/Hat_02.wav')
+        snapshot, changed, removed = refresh_directories(snapshot, [self.directory], rules)
+        self.assertEqual(listed(snapshot), ['Hats/Hat_01.wav', 'Kicks/Kick_01.wav', 'Renders/Mix.WAV'])
+
+    def test_snapshot_replanning(self):
+        self.make_files('test_file1.txt', 'subdir1/test_file2.txt')
+        snapshot = scan_directory(self.directory)
+        self.assertEqual(len(snapshot), 2)
+        # Files added after the scan are not seen until the next scan
+        self.make_files('test_file3.txt')
+        first = build_plan(snapshot, CleanerOptions(string_to_remove='test_'))
+        second = build_plan(snapshot, CleanerOptions(string_to_remove='file'))
+        self.assertEqual(len(first), 2)
+        self.assertEqual([entry.target for entry in second.directories[0].entries], ['test_1.txt'])
+
+    def test_snapshot_store(self):
+        self.make_files('Pack A/Kicks/kick.wav', 'Pack A/snare.wav', 'Pack B/Kicks/kick.wav', 'top.wav')
+        scanned = list(iter_scan(self.directory))
+        snapshot = scan_directory(self.directory)
+        self.assertEqual(list(snapshot.directories), scanned)
+        self.assertEqual(snapshot.directories[-1], scanned[-1])
+        self.assertEqual(snapshot.paths(), [directory.path for directory in scanned])
+        self.assertEqual([snapshot.path(index) for index in range(len(scanned))], snapshot.paths())
+        self.assertEqual(snapshot.parents[snapshot.paths().index(os.path.join(self.directory, 'Pack B', 'Kicks'))],
+                         snapshot.paths().index(os.path.join(self.directory, 'Pack B')))
+        # Folder names are interned, both Kicks folders share one string
+        first, second = [name for name in snapshot.folder_names if name == 'Kicks']
+        self.assertIs(first, second)
+        with self.assertRaises(IndexError):
+            snapshot.directories[len(scanned)]
+
+        # A root given with a trailing separator, like os.walk walks it, keeps its subfolders
+        self.assertEqual(scan_directory(self.directory + os.sep), snapshot)
+        walked = [directory._replace(path=self.directory + os.sep) if directory.path == self.directory else directory for directory in scanned]
+        self.assertEqual(list(Snapshot(self.directory + os.sep, walked).parents), list(snapshot.parents))
+        self.assertEqual(list(snapshot.parents), [-1, 0, 1, 0, 3])
+
+    def test_regex_index_keeps_same_named_folders_apart(self):
+        self.make_files('Pack A/Kicks/PackA_Kick_1.wav', 'Pack A/Kicks/PackA_Kick_2.wav',
+                        'Pack B/Kicks/PackB_Kick_1.wav', 'Pack B/Kicks/PackB_Kick_2.wav')
+        snapshot = scan_directory(self.directory)
+        index = build_regex_index(snapshot)
+        kicks_b = os.path.join(self.directory, 'Pack B', 'Kicks')
+        self.assertEqual(index.get(os.path.join(self.directory, 'Pack A', 'Kicks')), 'packa_kick_')
+        self.assertEqual(index.get(kicks_b), 'packb_kick_')
+        plan = build_plan(snapshot, CleanerOptions(smart_update=True), index)
+        self.assertEqual(sorted(os.path.basename(dst) for src, dst in plan.renames()), ['1.wav', '1.wav', '2.wav', '2.wav'])
+
+    def test_refresh_directories(self):
+        self.make_files('Pack A/PackA_Kick_1.wav', 'Pack A/PackA_Kick_2.wav', 'Pack B/PackB_Snare_1.wav', 'Pack B/Hats/hat.wav')
+        snapshot = scan_directory(self.directory)
+        index = build_regex_index(snapshot)
+        pack_a = os.path.join(self.directory, 'Pack A')
+        self.make_files('Pack A/Other_Kick_3.wav', 'Pack C/Loops/loop.wav')
+        shutil.rmtree(os.path.join(self.directory, 'Pack B'))
+        snapshot, changed, removed = refresh_directories(snapshot, {self.directory, pack_a})
+        self.assertEqual(snapshot, scan_directory(self.directory))
+        self.assertEqual(changed, {self.directory, pack_a, os.path.join(self.directory, 'Pack C'), os.path.join(self.directory, 'Pack C', 'Loops')})
+        self.assertEqual(removed, {os.path.join(self.directory, 'Pack B'), os.path.join(self.directory, 'Pack B', 'Hats')})
+
+        index = update_regex_index(index, [directory for directory in snapshot.directories if directory.path in changed], removed)
+        self.assertEqual(dict(index.by_path), dict(build_regex_index(snapshot).by_path))
+
+    def test_stage_cache(self):
+        self.make_files('Pack A/Pack_A_Kick_100bpm_01.wav', 'Pack A/Pack_A_Snare_120bpm_02.wav', 'Pack A/readme.txt',
+                        'Pack B/the-pack b 01.wav', 'Pack B/the-pack b 02.wav', 'Pack B/Loops/loop of the day.wav')
+        snapshot = scan_directory(self.directory)
+        stages = StageCache()
+        options = CleanerOptions(smart_update=True)
+        # Every toggle gives the same plan as planning from scratch
+        for change in [{}, {'leading_zero': False}, {'capitalize': True}, {'upper_bpm': True}, {'underscore': True},
+                       {'leading_zero': True}, {'capitalize': False}]:
+            options = options._replace(**change)
+            plan = build_plan(snapshot, options, stages.regex_index(snapshot, options.leading_zero), stages=stages)
+            self.assertEqual(plan, build_plan(snapshot, options))
+        # Casing and underscores reuse the stripped names, the leading zero option only restrips
+        pack_b = os.path.join(self.directory, 'Pack B')
+        normalized, stripped = stages.normalized[pack_b], stages.stripped[pack_b]
+        build_plan(snapshot, options._replace(underscore=False), stages=stages)
+        self.assertIs(stages.stripped[pack_b], stripped)
+        build_plan(snapshot, options._replace(leading_zero=False), stages=stages)
+        self.assertIs(stages.normalized[pack_b], normalized)
+        self.assertIsNot(stages.stripped[pack_b], stripped)
+
+        pack_a = os.path.join(self.directory, 'Pack A')
+
+        self.make_files('Pack A/Other_Kick_03.wav')
+        snapshot, changed, removed = refresh_directories(snapshot, {pack_a})
+        stages.discard(changed | removed)
+        self.assertEqual(build_plan(snapshot, options, stages=stages), build_plan(snapshot, options))
+
+    def test_headless_imports(self):
+        # The cleaning functions and the command line don't need Tk or Pillow
+        code = "import sys, cleanercli, cleanerbatch; print('tkinter' in sys.modules, 'PIL' in sys.modules)"
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.split(), ['False', 'False'])
+
+    def test_cli(self):
+        self.make_files('test_file1.txt', 'test_file2.txt')
+        out = io.StringIO()
+        self.assertEqual(main(['plan', self.directory, '--remove', 'test_'], out), 0)
+        self.assertIn('-> file1.txt', out.getvalue())
+        self.assertTrue(os.path.exists(os.path.join(self.directory, 'test_file1.txt')))
+        journal = os.path.join(self.directory, 'journal.jsonl')
+        self.assertEqual(main(['apply', self.directory, '--remove', 'test_', '--journal', journal], io.StringIO()), 0)
+        self.assertTrue(os.path.exists(os.path.join(self.directory, 'file1.txt')))
+        self.assertEqual(main(['undo', journal, '--workers', '1'], io.StringIO()), 0)
+        self.assertTrue(os.path.exists(os.path.join(self.directory, 'test_file1.txt')))
+        out = io.StringIO()
+        self.assertEqual(main(['plan', self.directory, '--regex', '--remove', '^test_(file)(\\d)', '--replace', '\\2_\\1'], out), 0)
+        self.assertIn('-> 1_file.txt', out.getvalue())
+        with patch('sys.stderr', io.StringIO()), self.assertRaises(SystemExit):
+            main(['plan', self.directory, '--regex', '--remove', '(a+)+'], io.StringIO())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+###################################################################################################
+# cleanerplanfile.py
+#
+# Writes rename plans to JSONL or CSV files (old path, new path, directory regex) so they can be
+# reviewed, diffed and versioned outside the window, and applies such files later. Plans are
+# written directory by directory as they are produced and read back in chunks, so memory stays
+# flat however large the library is.
+#
+###################################################################################################
+
+import csv
+import json
+import os
+from collections import namedtuple
+from cleanerrename import DEFAULT_WORKERS, RenameExecutor, RenameReport
+
+PLAN_FIELDS = ["src", "dst", "regex"]
+PLAN_FORMATS = ["jsonl", "csv"]
+
+# Renames handed to one RenameExecutor when a plan file is applied
+PLAN_CHUNK_SIZE = 10000
+
+PlanRow = namedtuple('PlanRow', PLAN_FIELDS)
+
+class PlanFileError(ValueError):
+    pass
+
+def plan_format(path, format=None):
+    # The format passed, or the one matching the file extension, JSONL by default
+    if format:
+        return format
+    return "csv" if path.lower().endswith(".csv") else "jsonl"
+
+def plan_rows(planned_directories):
+    for directory in planned_directories:
+        for entry in directory.entries:
+            if entry.target != entry.filename:
+                yield PlanRow(os.path.join(directory.path, entry.filename), os.path.join(directory.path, entry.target), directory.regex)
+
+def write_plan_file(planned_directories, path, format=None):
+    # Streams the renames of planned_directories, an iterable that can be produced lazily, to path.
+    # Returns the number of renames written
+    format = plan_format(path, format)
+    written = 0
+    # surrogateescape keeps file names that aren't valid UTF-8 intact
+    with open(path, "w", encoding="utf-8", errors="surrogateescape", newline="") as file:
+        if format == "csv":
+            writer = csv.writer(file)
+            writer.writerow(PLAN_FIELDS)
+            for row in plan_rows(planned_directories):
+                writer.writerow(row)
+                written += 1
+        else:
+            for row in plan_rows(planned_directories):
+                file.write(json.dumps(row._asdict()) + "\n")
+                written += 1
+    return written
+
+def read_plan_file(path, format=None):
+    # Yields the PlanRows of a plan file one at a time
+    format = plan_format(path, format)
+    with open(path, encoding="utf-8", errors="surrogateescape", newline="") as file:
+        if format == "csv":
+            reader = csv.reader(file)
+            header = next(reader, None)
+            if header != PLAN_FIELDS:
+                raise PlanFileError(f"{path}: expected the columns {','.join(PLAN_FIELDS)}")
+            for row in reader:
+                if len(row) != len(PLAN_FIELDS) or not row[0] or not row[1]:
+                    raise PlanFileError(f"{path}:{reader.line_num}: expected a source, a target and a regex")
+                yield PlanRow(*row)
+        else:
+            for line_number, line in enumerate(file, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    row = PlanRow(record["src"], record["dst"], record.get("regex", ""))
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    raise PlanFileError(f"{path}:{line_number}: not a rename record")
+                if not row.src or not row.dst:
+                    raise PlanFileError(f"{path}:{line_number}: expected a source and a target")
+                yield row
+
+def plan_chunks(rows, chunk_size=PLAN_CHUNK_SIZE):
+    # Groups (src, dst) pairs into chunks of about chunk_size, only cut between directories so
+    # swaps and chains within a directory are checked and run together
+    chunk = []
+    for row in rows:
+        if len(chunk) >= chunk_size and os.path.dirname(row.src) != os.path.dirname(chunk[-1][0]):
+            yield chunk
+            chunk = []
+        chunk.append((row.src, row.dst))
+    if chunk:
+        yield chunk
+
+def apply_plan_file(path, workers=DEFAULT_WORKERS, chunk_size=PLAN_CHUNK_SIZE, journal_path=None, format=None, cancel=None):
+    # Runs the renames of a plan file a chunk at a time, every chunk appending to the same journal,
+    # and returns one RenameReport for the whole file. The file is read through once beforehand,
+    # so a damaged line is reported before anything is renamed
+    for row in read_plan_file(path, format):
+        pass
+    renamed = 0
+    failures = []
+    temporary = []
+    cancelled = False
+    for chunk in plan_chunks(read_plan_file(path, format), chunk_size):
+        if cancel is not None and cancel.is_set():
+            cancelled = True
+            break
+        executor = RenameExecutor(chunk, workers, journal_path=journal_path)
+        if cancel is not None:
+            executor.cancel = cancel
+        report = executor.run()
+        renamed += report.renamed
+        failures.extend(report.failures)
+        temporary.extend(report.temporary)
+        if report.cancelled:
+            cancelled = True
+            break
+    return RenameReport(renamed, failures, cancelled, journal_path, temporary)
@@ -0,0 +1,81 @@
+import unittest
+import io
+import os
+import shutil
+import tempfile
+from unittest.mock import patch
+from cleanerengine import CleanerOptions, iter_plan, scan_directory, build_plan
+from cleanerplanfile import PlanFileError, PlanRow, write_plan_file, read_plan_file, plan_chunks, apply_plan_file
+from cleanercli import main
+
+class TestPlanFile(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.home = tempfile.mkdtemp()
+        self.environ = patch.dict(os.environ, {"CANDLECLEANER_HOME": self.home})
+        self.environ.start()
+
+    def tearDown(self):
+        self.environ.stop()
+        shutil.rmtree(self.directory)
+        shutil.rmtree(self.home)
+
+    def make_files(self, *paths):
+        for path in paths:
+            full_path = os.path.join(self.directory, path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            with open(full_path, 'w') as f:
+                f.write(path)
+
+    def files(self):
+        return sorted(os.path.relpath(os.path.join(dirpath, name), self.directory)
+                      for dirpath, dirnames, filenames in os.walk(self.directory) for name in filenames)
+
+    def test_streamed_plan_matches_built_plan(self):
+        self.make_files('Pack_Kick_01.wav', 'Pack_Kick_02.wav', 'snares/Pack_Snare_01.wav', 'snares/Pack_Snare_02.wav')
+        options = CleanerOptions(smart_update=True)
+        for extension in ('jsonl', 'csv'):
+            path = os.path.join(self.home, 'plan.' + extension)
+            self.assertEqual(write_plan_file(iter_plan(self.directory, options), path), 4)
+            plan = build_plan(scan_directory(self.directory), options)
+            self.assertEqual([(row.src, row.dst) for row in read_plan_file(path)], list(plan.renames()))
+            self.assertEqual({row.regex for row in read_plan_file(path)}, {'pack_kick_', 'pack_snare_'})
+
+    def test_chunks_are_cut_between_directories(self):
+        rows = [PlanRow(os.path.join(folder, name), os.path.join(folder, 'x' + name), '') for folder in ('a', 'b') for name in ('1', '2', '3')]
+        self.assertEqual([len(chunk) for chunk in plan_chunks(rows, 2)], [3, 3])
+
+    def test_apply_plan_file(self):
+        self.make_files('a.wav', 'b.wav', 'sub/test_c.wav')
+        path = os.path.join(self.home, 'plan.csv')
+        with open(path, 'w') as f:
+            f.write('src,dst,regex\n')
+            # A swap only works when both renames are checked together
+            f.write(f'{self.directory}/a.wav,{self.directory}/b.wav,\n{self.directory}/b.wav,{self.directory}/a.wav,\n')
+            f.write(f'{self.directory}/sub/test_c.wav,{self.directory}/sub/c.wav,\n')
+        journal = os.path.join(self.home, 'journal.jsonl')
+        report = apply_plan_file(path, chunk_size=1, journal_path=journal)
+        self.assertEqual((report.renamed, report.failures), (3, []))
+        with open(os.path.join(self.directory, 'a.wav')) as f:
+            self.assertEqual(f.read(), 'b.wav')
+        self.assertEqual(self.files(), ['a.wav', 'b.wav', 'sub/c.wav'])
+
+    def test_damaged_plan_renames_nothing(self):
+        self.make_files('test_a.wav')
+        path = os.path.join(self.home, 'plan.jsonl')
+        with open(path, 'w') as f:
+            f.write('{"src": "%s/test_a.wav", "dst": "%s/a.wav", "regex": ""}\n{"src": ' % (self.directory, self.directory))
+        with self.assertRaises(PlanFileError):
+            apply_plan_file(path)
+        self.assertEqual(self.files(), ['test_a.wav'])
+
+    def test_cli_export_and_apply(self):
+        self.make_files('test_file1.txt', 'subdir1/test_file2.txt')
+        path = os.path.join(self.home, 'plan.jsonl')
+        self.assertEqual(main(['plan', self.directory, '--remove', 'test_', '--output', path], io.StringIO()), 0)
+        self.assertEqual(self.files(), ['subdir1/test_file2.txt', 'test_file1.txt'])
+        self.assertEqual(main(['apply-file', path, '--chunk-size', '1'], io.StringIO()), 0)
+        self.assertEqual(self.files(), ['file1.txt', 'subdir1/file2.txt'])
+
+if __name__ == '__main__':
+    unittest.main()
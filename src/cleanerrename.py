@@ -0,0 +1,335 @@
+###################################################################################################
+# cleanerrename.py
+#
+# Executes the renames of a plan on a thread pool. Before anything is renamed the plan is checked
+# for files that would end up with the same name or overwrite a file that stays, and renames onto
+# a name another file is leaving (chains and cycles) are done in two phases through a temporary
+# name. Every step is written to an append-only journal, so a run can be undone or resumed after a
+# crash without rescanning the tree. Failures are collected into a single report.
+#
+###################################################################################################
+
+import errno
+import json
+import os
+import threading
+import time
+import uuid
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from cleanerengine import data_directory, DirectoryHandles
+
+# Renames mostly wait on the filesystem, so more threads than cores pays off on network storage
+DEFAULT_WORKERS = 8
+
+# Renames each pool task performs before the progress count is updated and the journal synced
+CHUNK_SIZE = 64
+
+# Failures listed by RenameReport.summary before the rest are only counted
+SUMMARY_LIMIT = 20
+
+# Marks the temporary names used by two-phase renames
+TEMP_MARKER = ".candlecleaner-"
+
+RenameFailure = namedtuple('RenameFailure', ['source', 'target', 'error'])
+
+# temporary lists the files still left under a temporary name, see RenameExecutor.run
+class RenameReport(namedtuple('RenameReport', ['renamed', 'failures', 'cancelled', 'journal', 'temporary'], defaults=((),))):
+    __slots__ = ()
+
+    def summary(self, limit=SUMMARY_LIMIT, failures=True):
+        # Without failures, for callers that listed them already
+        lines = [str(self.renamed) + " files renamed."]
+        if self.cancelled:
+            lines.append("The rename was cancelled before every file was renamed.")
+        if self.failures and failures:
+            lines.append(str(len(self.failures)) + " files couldn't be renamed:")
+            for failure in self.failures[:limit]:
+                lines.append(os.path.basename(failure.source) + ": " + (failure.error.strerror or str(failure.error)))
+            if len(self.failures) > limit:
+                lines.append("... and " + str(len(self.failures) - limit) + " more")
+        if self.temporary:
+            lines.append(str(len(self.temporary)) + " files were left under a temporary name, resume the journal to finish them:")
+            lines.extend(self.temporary[:limit])
+            if len(self.temporary) > limit:
+                lines.append("... and " + str(len(self.temporary) - limit) + " more")
+        return "\n".join(lines)
+
+def default_journal_path():
+    name = "rename-" + time.strftime("%Y%m%d-%H%M%S") + "-" + uuid.uuid4().hex[:6] + ".jsonl"
+    return os.path.join(data_directory("journals"), name)
+
+def temp_path(path, token):
+    directory, name = os.path.split(path)
+    return os.path.join(directory, "." + name + TEMP_MARKER + token)
+
+def is_temp_path(path):
+    return TEMP_MARKER in os.path.basename(path)
+
+def same_file(first, second, handles):
+    try:
+        first_stat = handles.stat(first)
+        second_stat = handles.stat(second)
+    except OSError:
+        return False
+    return os.path.samestat(first_stat, second_stat)
+
+def conflict(src, dst, reason):
+    return RenameFailure(src, dst, FileExistsError(errno.EEXIST, reason, dst))
+
+def drop_blocked(steps, staying):
+    # A step onto the name of a file that stays where it is would overwrite it, so it is dropped and
+    # its own source stays too, following the chain. Returns (kept steps, dropped steps)
+    owner = {os.path.normcase(dst): index for index, (src, dst) in enumerate(steps)}
+    dropped = set()
+    pending = [os.path.normcase(path) for path in staying]
+    while pending:
+        index = owner.get(pending.pop())
+        if index is not None and index not in dropped:
+            dropped.add(index)
+            pending.append(os.path.normcase(steps[index][0]))
+    return [step for index, step in enumerate(steps) if index not in dropped], [steps[index] for index in sorted(dropped)]
+
+def refuse_collisions(steps):
+    # Targets shared by several steps, or held by a file that isn't renamed, returning (indexes of
+    # the refused steps, failures)
+    target_counts = Counter(os.path.normcase(dst) for src, dst in steps)
+    sources = {os.path.normcase(src) for src, dst in steps}
+    refused = set()
+    failures = []
+    with DirectoryHandles() as handles:
+        for index, (src, dst) in enumerate(steps):
+            target = os.path.normcase(dst)
+            if target_counts[target] > 1:
+                failures.append(conflict(src, dst, "Another file would be renamed to the same name"))
+            elif target not in sources and handles.lexists(dst) and not same_file(src, dst, handles):
+                # same_file lets case-only renames through on case-insensitive filesystems
+                failures.append(conflict(src, dst, "A file with that name already exists"))
+            else:
+                continue
+            refused.add(index)
+    return refused, failures
+
+def prepare_renames(renames, token):
+    # Split the renames into phases that can each run in parallel, returning (phases, failures).
+    # Targets shared by several files, or held by a file that isn't renamed, are refused up front
+    steps = [(src, dst) for src, dst in renames if src != dst]
+    refused, failures = refuse_collisions(steps)
+    accepted = [step for index, step in enumerate(steps) if index not in refused]
+    accepted, blocked = drop_blocked(accepted, [failure.source for failure in failures])
+    failures.extend(conflict(src, dst, "Its new name belongs to a file that isn't renamed") for src, dst in blocked)
+
+    # A file whose name another file takes over is first moved out of the way
+    accepted_sources = {os.path.normcase(src) for src, dst in accepted}
+    blockers = {os.path.normcase(dst) for src, dst in accepted
+                if os.path.normcase(dst) in accepted_sources and os.path.normcase(dst) != os.path.normcase(src)}
+    first_phase = []
+    second_phase = []
+    for src, dst in accepted:
+        if os.path.normcase(src) in blockers:
+            temp = temp_path(src, token)
+            first_phase.append((src, temp))
+            second_phase.append((temp, dst))
+        else:
+            second_phase.append((src, dst))
+    phases = [first_phase, second_phase] if first_phase else [second_phase]
+    return phases, failures
+
+def check_phases(phases):
+    # The check of prepare_renames for phases that are already split, like the steps of a journal
+    # replayed by undo or resume, whose files may have changed since. Returns (phases, failures)
+    steps = [(phase, src, dst) for phase, phase_steps in enumerate(phases) for src, dst in phase_steps if src != dst]
+    refused, failures = refuse_collisions([(src, dst) for phase, src, dst in steps])
+    kept = [step for index, step in enumerate(steps) if index not in refused]
+    accepted, blocked = drop_blocked([(src, dst) for phase, src, dst in kept], [failure.source for failure in failures])
+    failures.extend(conflict(src, dst, "Its new name belongs to a file that isn't renamed") for src, dst in blocked)
+    # A step out of a name an earlier phase no longer moves a file to has nothing to move
+    accepted = set(accepted)
+    missing = {os.path.normcase(dst) for src, dst in blocked} | {os.path.normcase(failure.target) for failure in failures}
+    checked = [[] for phase in phases]
+    for phase, src, dst in kept:
+        if (src, dst) not in accepted:
+            continue
+        if os.path.normcase(src) in missing:
+            missing.add(os.path.normcase(dst))
+            failures.append(conflict(src, dst, "The rename before it was refused"))
+        else:
+            checked[phase].append((src, dst))
+    return checked, failures
+
+class RenameJournal:
+    # One JSON record per line: begin, a plan record per step, a done record per finished step and
+    # end. Done records are synced to disk after every chunk
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, "a", encoding="utf-8")
+        if self.file.tell() > 0:
+            # Keep a half written last line from a crash on a line of its own
+            self.file.write("\n")
+
+    def write(self, *records):
+        with self.lock:
+            for record in records:
+                self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+def read_journal(path):
+    # Returns (planned steps, done steps) as lists of (phase, src, dst)
+    planned = []
+    done = []
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A half written line from a crash
+                continue
+            if record.get("op") == "plan":
+                planned.append((record["phase"], record["src"], record["dst"]))
+            elif record.get("op") == "done":
+                done.append((record["phase"], record["src"], record["dst"]))
+    return planned, done
+
+def group_phases(steps):
+    # Phase numbers are kept as list indexes, so done records of a resumed run still line up
+    phases = {}
+    for phase, src, dst in steps:
+        phases.setdefault(phase, []).append((src, dst))
+    return [phases.get(phase, []) for phase in range(max(phases, default=-1) + 1)]
+
+class RenameExecutor:
+    # Either renames, which are checked and split into phases when run, or ready made phases from a
+    # journal, which are checked again with check_phases. With a journal_path every step is journaled
+    def __init__(self, renames=(), workers=DEFAULT_WORKERS, chunk_size=CHUNK_SIZE, journal_path=None, phases=None, write_plan=True):
+        self.renames = list(renames)
+        self.phases = phases
+        self.workers = max(1, workers)
+        self.chunk_size = chunk_size
+        self.journal_path = journal_path
+        self.write_plan = write_plan
+        self.cancel = threading.Event()
+        self.total = len(self.renames) if phases is None else sum(len(steps) for steps in phases)
+        self.done = 0
+        self.report = None
+
+    # Files of one folder are renamed relative to an open handle of it, see DirectoryHandles. Once
+    # cancelled, only files already moved to a temporary name are still moved on, the others are
+    # returned as skipped
+    def rename_chunk(self, phase, chunk, journal):
+        finished = []
+        failures = []
+        skipped = []
+        with DirectoryHandles() as handles:
+            for src, dst in chunk:
+                if self.cancel.is_set() and not is_temp_path(src):
+                    skipped.append((src, dst))
+                    continue
+                try:
+                    handles.rename(src, dst)
+                    finished.append((src, dst))
+                except OSError as error:
+                    failures.append(RenameFailure(src, dst, error))
+        if journal is not None and finished:
+            journal.write(*({"op": "done", "phase": phase, "src": src, "dst": dst} for src, dst in finished))
+        return finished, failures, skipped
+
+    def run_phase(self, pool, phase, steps, journal):
+        finished = []
+        failures = []
+        skipped = []
+        futures = [pool.submit(self.rename_chunk, phase, steps[start:start + self.chunk_size], journal)
+                   for start in range(0, len(steps), self.chunk_size)]
+        for future in as_completed(futures):
+            chunk_finished, chunk_failures, chunk_skipped = future.result()
+            self.done += len(chunk_finished) + len(chunk_failures)
+            finished.extend(chunk_finished)
+            failures.extend(chunk_failures)
+            skipped.extend(chunk_skipped)
+        return finished, failures, skipped
+
+    # Moves files left under a temporary name back to the name they had before this run, when
+    # nothing took it since. temporary maps each temporary name to that name, None when it was
+    # given by an earlier run. Returns the temporary names that are left
+    def restore_temporary(self, temporary, journal):
+        restored = []
+        left = []
+        with DirectoryHandles() as handles:
+            for temp, original in temporary.items():
+                try:
+                    if original is None or handles.lexists(original):
+                        left.append(temp)
+                        continue
+                    handles.rename(temp, original)
+                    restored.append((temp, original))
+                except OSError:
+                    left.append(temp)
+        if journal is not None and restored:
+            # A phase of its own after the planned ones, so undo replays it first
+            journal.write(*({"op": "done", "phase": len(self.phases), "src": src, "dst": dst} for src, dst in restored))
+        return sorted(left)
+
+    # Blocks until every rename ran or the run was cancelled, safe to call from a worker thread. A
+    # file moved to a temporary name is always moved on to its new name, and one that couldn't be
+    # is moved back, so the report only lists temporary names nothing could be done about
+    def run(self):
+        if self.phases is None:
+            self.phases, failures = prepare_renames(self.renames, uuid.uuid4().hex[:8])
+        else:
+            self.phases, failures = check_phases(self.phases)
+        self.total = sum(len(steps) for steps in self.phases)
+        journal = RenameJournal(self.journal_path) if self.journal_path else None
+        if journal is not None:
+            journal.write({"op": "begin", "time": time.time()})
+            if self.write_plan:
+                journal.write(*({"op": "plan", "phase": phase, "src": src, "dst": dst}
+                                for phase, steps in enumerate(self.phases) for src, dst in steps))
+        renamed = 0
+        # Temporary names given by an earlier run, that one is resumed
+        created = {dst for steps in self.phases for src, dst in steps}
+        temporary = {src: None for steps in self.phases for src, dst in steps if is_temp_path(src) and src not in created}
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                phase_failures = []
+                skipped = []
+                for phase, steps in enumerate(self.phases):
+                    if phase_failures or skipped:
+                        # Files that failed to move or were skipped stay put, later steps that
+                        # depended on them are dropped
+                        failed_targets = {failure.target for failure in phase_failures} | {dst for src, dst in skipped}
+                        steps = [(src, dst) for src, dst in steps if src not in failed_targets]
+                        steps, blocked = drop_blocked(steps, [failure.source for failure in phase_failures])
+                        failures.extend(conflict(src, dst, "Its new name belongs to a file that couldn't be moved") for src, dst in blocked)
+                        steps, blocked = drop_blocked(steps, [src for src, dst in skipped])
+                    finished, phase_failures, skipped = self.run_phase(pool, phase, steps, journal)
+                    failures.extend(phase_failures)
+                    renamed += sum(1 for src, dst in finished if not is_temp_path(dst))
+                    for src, dst in finished:
+                        temporary.pop(src, None)
+                        if is_temp_path(dst):
+                            temporary[dst] = src
+            left = self.restore_temporary(temporary, journal) if temporary else []
+        finally:
+            if journal is not None:
+                journal.write({"op": "end", "cancelled": self.cancel.is_set()})
+                journal.close()
+        self.report = RenameReport(renamed, failures, self.cancel.is_set(), self.journal_path, left)
+        return self.report
+
+def resume_executor(journal_path, workers=DEFAULT_WORKERS):
+    # Runs the steps of an interrupted run that aren't journaled as done, appending to its journal
+    planned, done = read_journal(journal_path)
+    finished = set(done)
+    remaining = [step for step in planned if step not in finished]
+    return RenameExecutor(workers=workers, journal_path=journal_path, phases=group_phases(remaining), write_plan=False)
+
+def undo_executor(journal_path, workers=DEFAULT_WORKERS, undo_journal_path=None):
+    # Replays the done steps of a journal backwards, last phase first, without rescanning the tree.
+    # The undo itself is journaled, so it can be undone as well
+    planned, done = read_journal(journal_path)
+    phases = [[(dst, src) for src, dst in steps] for steps in reversed(group_phases(done))]
+    return RenameExecutor(workers=workers, journal_path=undo_journal_path or default_journal_path(), phases=phases)
@@ -0,0 +1,205 @@
+import unittest
+import io
+import os
+import shutil
+import tempfile
+from unittest.mock import patch
+import cleanerengine
+from cleanerengine import CleanerOptions, DirectoryHandles, scan_directory, build_plan
+from cleanercli import main
+from cleanerrename import RenameExecutor, read_journal, resume_executor, undo_executor, is_temp_path
+
+class TestRenameExecutor(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_files(self, *paths):
+        for path in paths:
+            full_path = os.path.join(self.directory, path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            with open(full_path, 'w') as f:
+                f.write(path)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def read(self, name):
+        with open(self.path(name)) as f:
+            return f.read()
+
+    def test_rename_plan(self):
+        self.make_files('test_file1.txt', 'subdir1/test_file2.txt')
+        plan = build_plan(scan_directory(self.directory), CleanerOptions(string_to_remove='test_'))
+        report = RenameExecutor(plan.renames(), workers=4, chunk_size=1).run()
+        self.assertEqual((report.renamed, report.failures, report.cancelled), (2, [], False))
+        self.assertTrue(os.path.exists(os.path.join(self.directory, 'file1.txt')))
+        self.assertTrue(os.path.exists(os.path.join(self.directory, 'subdir1', 'file2.txt')))
+
+    def test_failures_are_collected(self):
+        self.make_files('test_file1.txt')
+        missing = [(os.path.join(self.directory, 'missing' + str(i)), os.path.join(self.directory, 'x' + str(i))) for i in range(25)]
+        report = RenameExecutor(missing + [(os.path.join(self.directory, 'test_file1.txt'), os.path.join(self.directory, 'file1.txt'))]).run()
+        self.assertEqual(report.renamed, 1)
+        self.assertEqual(len(report.failures), 25)
+        summary = report.summary()
+        self.assertIn('25 files couldn\'t be renamed', summary)
+        self.assertIn('... and 5 more', summary)
+
+    def test_cancel(self):
+        self.make_files('test_file1.txt')
+        executor = RenameExecutor([(os.path.join(self.directory, 'test_file1.txt'), os.path.join(self.directory, 'file1.txt'))])
+        executor.cancel.set()
+        report = executor.run()
+        self.assertTrue(report.cancelled)
+        self.assertEqual(report.renamed, 0)
+        self.assertTrue(os.path.exists(os.path.join(self.directory, 'test_file1.txt')))
+
+    def test_collisions_are_refused(self):
+        self.make_files('test_kick.wav', 'kick.wav.tmp', 'Test-kick.wav', 'snare.wav', 'test_snare.wav', 'test_hat.wav')
+        renames = [(self.path('test_kick.wav'), self.path('kick.wav')), (self.path('Test-kick.wav'), self.path('kick.wav')),
+                   (self.path('test_snare.wav'), self.path('snare.wav')), (self.path('test_hat.wav'), self.path('hat.wav'))]
+        report = RenameExecutor(renames).run()
+        self.assertEqual(report.renamed, 1)
+        self.assertEqual(sorted(os.path.basename(failure.source) for failure in report.failures), ['Test-kick.wav', 'test_kick.wav', 'test_snare.wav'])
+        self.assertEqual(self.read('snare.wav'), 'snare.wav')
+        self.assertFalse(os.path.exists(self.path('kick.wav')))
+        self.assertEqual(self.read('hat.wav'), 'test_hat.wav')
+
+    def test_cycles_and_chains_use_two_phases(self):
+        self.make_files('a.wav', 'b.wav', 'c.wav', 'd.wav')
+        # a and b swap names, c moves onto d while d moves to e
+        renames = [(self.path('a.wav'), self.path('b.wav')), (self.path('b.wav'), self.path('a.wav')),
+                   (self.path('c.wav'), self.path('d.wav')), (self.path('d.wav'), self.path('e.wav'))]
+        journal = self.path('journal.jsonl')
+        report = RenameExecutor(renames, chunk_size=1, journal_path=journal).run()
+        self.assertEqual((report.renamed, report.failures), (4, []))
+        self.assertEqual([self.read(name) for name in ('a.wav', 'b.wav', 'd.wav', 'e.wav')], ['b.wav', 'a.wav', 'c.wav', 'd.wav'])
+        self.assertFalse(os.path.exists(self.path('c.wav')))
+
+        # Undo replays the journal backwards
+        undo = undo_executor(journal, undo_journal_path=self.path('undo.jsonl')).run()
+        self.assertEqual(undo.failures, [])
+        self.assertEqual([self.read(name) for name in ('a.wav', 'b.wav', 'c.wav', 'd.wav')], ['a.wav', 'b.wav', 'c.wav', 'd.wav'])
+        self.assertEqual(sorted(os.listdir(self.directory)), ['a.wav', 'b.wav', 'c.wav', 'd.wav', 'journal.jsonl', 'undo.jsonl'])
+
+    def failing_renames(self, failing):
+        # Renames fail with EACCES when failing(src, dst) is true
+        rename = DirectoryHandles.rename
+        def fail(handles, src, dst):
+            if failing(src, dst):
+                raise PermissionError(13, 'Permission denied', src)
+            return rename(handles, src, dst)
+        return patch.object(DirectoryHandles, 'rename', autospec=True, side_effect=fail)
+
+    def test_cli_lists_each_failure_once(self):
+        self.make_files('test_a.wav', 'test_b.wav')
+        stderr = io.StringIO()
+        with self.failing_renames(lambda src, dst: src.endswith('test_a.wav')), patch('sys.stderr', stderr):
+            self.assertEqual(main(['apply', self.directory, '--remove', 'test_', '--ignore-saved-rules',
+                                   '--journal', self.path('journal.jsonl')], io.StringIO()), 1)
+        self.assertEqual(stderr.getvalue().splitlines()[:2], [
+            f"Couldn't rename file: {self.path('test_a.wav')} ([Errno 13] Permission denied: '{self.path('test_a.wav')}')",
+            "1 files renamed."])
+        self.assertNotIn("couldn't be renamed", stderr.getvalue())
+        self.assertNotIn("more", stderr.getvalue())
+
+    def test_two_phases_never_leave_temporary_names(self):
+        self.make_files('a.wav', 'b.wav', 'c.wav')
+        swap = [(self.path('a.wav'), self.path('b.wav')), (self.path('b.wav'), self.path('a.wav'))]
+        # Cancelled once the swapped files were moved out of the way, they still get their new names
+        executor = RenameExecutor(swap + [(self.path('c.wav'), self.path('d.wav'))])
+        run_phase = executor.run_phase
+        def cancel_after(pool, phase, steps, journal):
+            result = run_phase(pool, phase, steps, journal)
+            executor.cancel.set()
+            return result
+        executor.run_phase = cancel_after
+        report = executor.run()
+        self.assertEqual((report.renamed, report.failures, report.cancelled, report.temporary), (2, [], True, []))
+        self.assertEqual(sorted(os.listdir(self.directory)), ['a.wav', 'b.wav', 'c.wav'])
+        self.assertEqual(self.read('a.wav'), 'b.wav')
+
+        # b couldn't be moved out of the way, so a is moved back
+        with self.failing_renames(lambda src, dst: src.endswith('b.wav')):
+            report = RenameExecutor(swap).run()
+        self.assertEqual((report.renamed, len(report.failures), report.temporary), (0, 2, []))
+        self.assertEqual(sorted(os.listdir(self.directory)), ['a.wav', 'b.wav', 'c.wav'])
+
+        # a couldn't take its new name and its old one is taken, so it is reported
+        with self.failing_renames(lambda src, dst: is_temp_path(src) and dst.endswith('a.wav')):
+            report = RenameExecutor(swap).run()
+        self.assertEqual((report.renamed, len(report.failures)), (1, 1))
+        self.assertEqual(report.temporary, [report.failures[0].source])
+        self.assertTrue(os.path.exists(report.temporary[0]))
+        self.assertIn('1 files were left under a temporary name', report.summary())
+
+    def test_undo_refuses_collisions(self):
+        self.make_files('test_kick.wav', 'test_snare.wav')
+        journal = self.path('journal.jsonl')
+        renames = [(self.path('test_kick.wav'), self.path('kick.wav')), (self.path('test_snare.wav'), self.path('snare.wav'))]
+        RenameExecutor(renames, journal_path=journal).run()
+        # A new file took one of the old names since
+        self.make_files('test_kick.wav')
+        report = undo_executor(journal, undo_journal_path=self.path('undo.jsonl')).run()
+        self.assertEqual(report.renamed, 1)
+        self.assertEqual([os.path.basename(failure.source) for failure in report.failures], ['kick.wav'])
+        self.assertEqual([self.read(name) for name in ('test_kick.wav', 'kick.wav', 'test_snare.wav')],
+                         ['test_kick.wav', 'test_kick.wav', 'test_snare.wav'])
+
+    def test_resume(self):
+        self.make_files('test_1.wav', 'test_2.wav', 'test_3.wav')
+        journal = self.path('journal.jsonl')
+        renames = [(self.path('test_' + str(i) + '.wav'), self.path(str(i) + '.wav')) for i in range(1, 4)]
+        executor = RenameExecutor(renames, chunk_size=1, workers=1, journal_path=journal)
+        # Simulate a crash after the first rename by cutting the journal short
+        executor.run()
+        with open(journal) as f:
+            lines = f.readlines()
+        planned, done = read_journal(journal)
+        self.assertEqual((len(planned), len(done)), (3, 3))
+        for index in range(1, 3):
+            os.rename(self.path(str(index + 1) + '.wav'), self.path('test_' + str(index + 1) + '.wav'))
+        with open(journal, 'w') as f:
+            f.writelines(lines[:5] + ['{"op": "do'])
+
+        report = resume_executor(journal).run()
+        self.assertEqual((report.renamed, report.failures), (2, []))
+        self.assertEqual(sorted(name for name in os.listdir(self.directory) if name.endswith('.wav')), ['1.wav', '2.wav', '3.wav'])
+        self.assertEqual(len(read_journal(journal)[1]), 3)
+
+    @unittest.skipUnless(cleanerengine.USE_DIR_FD, 'directory handles are not supported here')
+    def test_directory_handles(self):
+        self.make_files('pack/a.wav', 'pack/b.wav', 'other/c.wav')
+        with DirectoryHandles(limit=1) as handles:
+            handles.rename(self.path('pack/a.wav'), self.path('pack/1.wav'))
+            # A folder moved during the run is still the one renamed in
+            os.rename(self.path('pack'), self.path('moved'))
+            handles.rename(self.path('pack/b.wav'), self.path('pack/2.wav'))
+            self.assertEqual(sorted(os.listdir(self.path('moved'))), ['1.wav', '2.wav'])
+            self.assertTrue(handles.lexists(self.path('other/c.wav')))
+            self.assertFalse(handles.lexists(self.path('other/d.wav')))
+            self.assertEqual(list(handles.handles), [self.path('other')])
+            # Moving to another folder keeps the handle of the first one open
+            handles.rename(self.path('other/c.wav'), self.path('moved/c.wav'))
+            self.assertEqual(sorted(os.listdir(self.path('moved'))), ['1.wav', '2.wav', 'c.wav'])
+        self.assertEqual(handles.handles, {})
+        # The least recently used handle is closed first
+        self.make_files('third/d.wav')
+        with DirectoryHandles(limit=2) as handles:
+            for name in ('moved', 'other', 'moved', 'third'):
+                handles.lexists(self.path(name + '/x.wav'))
+            self.assertEqual(list(handles.handles), [self.path('moved'), self.path('third')])
+        # Nothing is closed before the limit is reached
+        folders = [self.path(f'many/{index}') for index in range(cleanerengine.HANDLE_LIMIT + 1)]
+        for folder in folders:
+            os.makedirs(folder)
+        with DirectoryHandles() as handles:
+            for count, folder in enumerate(folders, 1):
+                handles.lexists(os.path.join(folder, 'x.wav'))
+                self.assertEqual(list(handles.handles), folders[max(0, count - cleanerengine.HANDLE_LIMIT):count])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+###################################################################################################
+# cleanerrules.py
+#
+# Keeps the ScanRules, which files and folders a scan takes in, in ~/.candlecleaner/rules.json.
+# The window saves them from Options > Scan Rules and the command line starts from them, so both
+# leave the same parts of a drive alone.
+#
+###################################################################################################
+
+import json
+import os
+from cleanerengine import data_directory, ScanRules
+
+RULES_FILE = "rules.json"
+
+def rules_path():
+    return os.path.join(data_directory(), RULES_FILE)
+
+def split_list(text):
+    # "wav, aif,,flac" -> ("wav", "aif", "flac")
+    return tuple(part.strip() for part in text.split(",") if part.strip())
+
+def rules_data(rules):
+    # The JSON form of ScanRules, also how the scan service receives them
+    return {"exclude": list(rules.exclude), "extensions": list(rules.extensions), "max_depth": rules.max_depth,
+            "include_hidden": rules.include_hidden}
+
+def rules_from_data(data):
+    # Raises ValueError or TypeError when data isn't the JSON form of ScanRules
+    max_depth = data.get("max_depth")
+    if max_depth is not None and (not isinstance(max_depth, int) or max_depth < 0):
+        raise ValueError("max_depth must be a number of folder levels")
+    return ScanRules(tuple(map(str, data.get("exclude", ()))), tuple(map(str, data.get("extensions", ()))),
+                     max_depth, bool(data.get("include_hidden", False)))
+
+def load_rules(path=None):
+    # The saved ScanRules, the defaults when there are none or they can't be read
+    try:
+        with open(path or rules_path(), encoding="utf-8") as file:
+            return rules_from_data(json.load(file))
+    except (OSError, ValueError, TypeError, AttributeError):
+        return ScanRules()
+
+def save_rules(rules, path=None):
+    path = path or rules_path()
+    temp = path + "." + str(os.getpid()) + ".tmp"
+    with open(temp, "w", encoding="utf-8") as file:
+        json.dump(rules_data(rules), file, indent=2)
+    os.replace(temp, path)
@@ -0,0 +1,54 @@
+import unittest
+import io
+import os
+import shutil
+import tempfile
+from unittest.mock import patch
+from cleanerengine import ScanRules
+from cleanerrules import load_rules, save_rules, rules_path, split_list
+from cleanercli import main
+
+class TestScanRules(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.home = tempfile.mkdtemp()
+        environment = patch.dict(os.environ, {'CANDLECLEANER_HOME': self.home})
+        environment.start()
+        self.addCleanup(environment.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        shutil.rmtree(self.home)
+
+    def make_files(self, *paths):
+        for path in paths:
+            path = os.path.join(self.directory, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').close()
+
+    def test_save_and_load(self):
+        self.assertEqual(load_rules(), ScanRules())
+        rules = ScanRules(('.git', 'Projects/'), ('wav', 'aif'), 3, True)
+        save_rules(rules)
+        self.assertEqual(load_rules(), rules)
+        with open(rules_path(), 'w') as f:
+            f.write('{"max_depth": -1}')
+        self.assertEqual(load_rules(), ScanRules())
+        self.assertEqual(split_list(' wav, aif,,flac '), ('wav', 'aif', 'flac'))
+
+    def test_cli_rules(self):
+        self.make_files('test_kick.wav', 'test_notes.txt', 'Renders/test_mix.wav', '.test_hidden.wav')
+        def planned(*arguments):
+            out = io.StringIO()
+            self.assertEqual(main(['plan', self.directory, '--remove', 'test_', *arguments], out), 0)
+            return sorted(line.split(' -> ')[1] for line in out.getvalue().splitlines())
+        self.assertEqual(planned(), ['kick.wav', 'mix.wav', 'notes.txt'])
+        self.assertEqual(planned('--exclude', 'Renders', '--extensions', 'wav'), ['kick.wav'])
+        self.assertEqual(planned('--max-depth', '0', '--include-hidden'), ['.hidden.wav', 'kick.wav', 'notes.txt'])
+        # Rules saved from the window apply too, unless ignored
+        save_rules(ScanRules(exclude=('*.txt',)))
+        self.assertEqual(planned(), ['kick.wav', 'mix.wav'])
+        self.assertEqual(planned('--ignore-saved-rules'), ['kick.wav', 'mix.wav', 'notes.txt'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+###################################################################################################
+# cleanersearch.py
+#
+# Finds files of a rename plan by name, for the search box and the Show Only Changed mode. The
+# lowercase old and new name of every file are kept one after another in a single string,
+# so a query is a run of str.find calls over it instead of a loop over the files, and each hit is
+# mapped back to its file by bisecting the offsets where the files start. Only the matching files
+# are handed to the window, at most SEARCH_LIMIT of them.
+#
+###################################################################################################
+
+import array
+import bisect
+
+# Matching files the window shows at most for one query, the rest are only counted
+SEARCH_LIMIT = 5000
+
+class NameIndex:
+    # Built from the PlannedDirectory list of a plan
+    __slots__ = ('text', 'starts', 'directories', 'positions')
+
+    def __init__(self, planned_directories):
+        parts = []
+        self.starts = array.array('Q')
+        self.directories = array.array('L')
+        self.positions = array.array('L')
+        offset = 0
+        for index, directory in enumerate(planned_directories):
+            for position, entry in enumerate(directory.entries):
+                # The separators can't be typed into the search box, so no match spans two names
+                part = entry.filename.lower() + "\0" + entry.target.lower() + "\n"
+                parts.append(part)
+                self.starts.append(offset)
+                self.directories.append(index)
+                self.positions.append(position)
+                offset += len(part)
+        self.text = "".join(parts)
+
+    def search(self, query):
+        # Yield (directory index, entry position) of every file whose old or new name contains
+        # query, ignoring case, in tree order
+        query = query.lower()
+        if not query or "\0" in query or "\n" in query:
+            return
+        text, starts = self.text, self.starts
+        found = text.find(query)
+        while found != -1:
+            file = bisect.bisect_right(starts, found) - 1
+            yield self.directories[file], self.positions[file]
+            # Files are reported once, however often the query is in their names
+            next_file = file + 1
+            if next_file == len(starts):
+                return
+            found = text.find(query, starts[next_file])
+
+    def __len__(self):
+        return len(self.starts)
+
+def filter_plan(planned_directories, query="", changed_only=False, index=None, limit=SEARCH_LIMIT):
+    # The files to show for a query and the Show Only Changed mode. Returns ([(directory index,
+    # [entry positions])] of the first limit matches in tree order, number of them, whether there
+    # are more). The search stops at the first match past the limit, so a query matching everything
+    # costs no more than one matching a few files. index is the NameIndex of planned_directories,
+    # only needed with a query
+    if query:
+        matches = index.search(query)
+    else:
+        matches = ((directory_index, position) for directory_index, directory in enumerate(planned_directories)
+                   for position in range(len(directory.entries)))
+    groups = []
+    count = 0
+    for directory_index, position in matches:
+        if changed_only:
+            entry = planned_directories[directory_index].entries[position]
+            if entry.target == entry.filename:
+                continue
+        if count == limit:
+            return groups, count, True
+        count += 1
+        if groups and groups[-1][0] == directory_index:
+            groups[-1][1].append(position)
+        else:
+            groups.append((directory_index, [position]))
+    return groups, count, False
@@ -0,0 +1,34 @@
+import unittest
+from cleanerengine import PlannedDirectory, RenameEntry
+from cleanersearch import NameIndex, filter_plan
+
+class TestSearch(unittest.TestCase):
+    def setUp(self):
+        self.planned = [
+            PlannedDirectory('/library', ('Kicks',), '', (RenameEntry('readme.txt', 'readme.txt', 1),)),
+            PlannedDirectory('/library/Kicks', (), 'pack_kick_', tuple(RenameEntry('Pack_Kick_%02d.wav' % number, '%02d.wav' % number, 2)
+                                                                   for number in range(1, 13))),
+        ]
+        self.index = NameIndex(self.planned)
+
+    def test_name_index(self):
+        self.assertEqual(len(self.index), 13)
+        # Old and new names are both searched, ignoring case, and every file is reported once
+        self.assertEqual(list(self.index.search('KICK_1')), [(1, 9), (1, 10), (1, 11)])
+        self.assertEqual(list(self.index.search('11.wav')), [(1, 10)])
+        self.assertEqual(list(self.index.search('wav')), [(1, position) for position in range(12)])
+        # No match spans the old and new name of a file, or two files
+        self.assertEqual(list(self.index.search('txtreadme')), [])
+        self.assertEqual(list(self.index.search('')), [])
+
+    def test_filter_plan(self):
+        self.assertEqual(filter_plan(self.planned, 'read', index=self.index), ([(0, [0])], 1, False))
+        groups, count, more = filter_plan(self.planned, changed_only=True)
+        self.assertEqual((groups, count, more), ([(1, list(range(12)))], 12, False))
+        self.assertEqual(filter_plan(self.planned, 'readme', True, self.index), ([], 0, False))
+        # Past the limit the search stops and says there are more
+        self.assertEqual(filter_plan(self.planned, 'kick', index=self.index, limit=5), ([(1, [0, 1, 2, 3, 4])], 5, True))
+        self.assertEqual(filter_plan(self.planned, 'kick', index=self.index, limit=12), ([(1, list(range(12)))], 12, False))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+###################################################################################################
+# cleanershard.py
+#
+# Splits the rename plan of a library into shards by subtree, written to a folder on shared
+# storage, so any number of worker processes, on one host or on several hosts mounting the share
+# at the same path, can apply it at once. A worker claims a shard by creating its lock file with
+# O_CREAT | O_EXCL, which only one of them can, applies the shard's plan file with its own journal
+# and writes the shard's result next to it. The merge step reads every result back into one
+# report. Files are only renamed within their folder, so shards never touch each other's files.
+#
+#     shards/manifest.json          the shards, largest first, and the plan they were made with
+#     shards/plans/<name>.jsonl     one plan file per shard, see cleanerplanfile
+#     shards/locks/<id>.lock        who claimed a shard
+#     shards/journals/<id>.<host>.<pid>.jsonl
+#     shards/results/<id>.json      what the worker did, written once the shard is done
+#
+###################################################################################################
+
+import json
+import os
+import socket
+import time
+from concurrent.futures import ProcessPoolExecutor
+from cleanerbatch import BatchResult, run_batch
+from cleanerplanfile import apply_plan_file
+from cleanerrename import DEFAULT_WORKERS
+
+MANIFEST_FILE = "manifest.json"
+MANIFEST_VERSION = 1
+
+class ShardError(ValueError):
+    pass
+
+def shard_path(shard_directory, kind, shard_id, suffix):
+    return os.path.join(shard_directory, kind, shard_id + suffix)
+
+def write_json(path, data):
+    # Written next to path and moved over it, so a worker on another host never reads half a file
+    temp = path + "." + socket.gethostname() + "." + str(os.getpid()) + ".tmp"
+    with open(temp, "w", encoding="utf-8") as file:
+        json.dump(data, file, indent=2)
+    os.replace(temp, path)
+
+def create_shards(roots, options, shard_directory, processes=None, rules=None):
+    # Plans roots with one shard for the files of each root and one per top level folder, planned
+    # in parallel by run_batch. Returns the planning BatchResults, shards that failed to plan are
+    # kept in the manifest with their error so the merged report shows them
+    for kind in ("plans", "locks", "journals", "results"):
+        os.makedirs(os.path.join(shard_directory, kind), exist_ok=True)
+    results = run_batch(roots, options, processes=processes, split=True, plans_directory=os.path.join(shard_directory, "plans"), rules=rules)
+    shards = []
+    for number, result in enumerate(results, 1):
+        shards.append({"id": format(number, "04d"), "path": result.path,
+                       "plan": None if result.plan_file is None else os.path.relpath(result.plan_file, shard_directory),
+                       "directories": result.directories, "files": result.files, "renames": result.renames,
+                       "error": result.error})
+    # Claimed largest first, so the last shards to finish are small ones
+    shards.sort(key=lambda shard: -shard["renames"])
+    write_json(os.path.join(shard_directory, MANIFEST_FILE),
+               {"version": MANIFEST_VERSION, "roots": [os.path.abspath(root) for root in roots],
+                "options": options._asdict(), "created": time.time(), "shards": shards})
+    return results
+
+def load_manifest(shard_directory):
+    path = os.path.join(shard_directory, MANIFEST_FILE)
+    try:
+        with open(path, encoding="utf-8") as file:
+            manifest = json.load(file)
+    except OSError as error:
+        raise ShardError(f"{path}: {error.strerror or error}")
+    except ValueError:
+        raise ShardError(f"{path}: not a shard manifest")
+    if not isinstance(manifest, dict) or manifest.get("version") != MANIFEST_VERSION:
+        raise ShardError(f"{path}: not a shard manifest of version {MANIFEST_VERSION}")
+    return manifest
+
+def claim_shard(shard_directory, shard_id):
+    # True when this process created the shard's lock file, only one process ever can. O_EXCL is
+    # atomic on local disks and on NFS 3 and later
+    lock = shard_path(shard_directory, "locks", shard_id, ".lock")
+    try:
+        fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, "w", encoding="utf-8") as file:
+        json.dump({"host": socket.gethostname(), "pid": os.getpid(), "claimed": time.time()}, file)
+    return True
+
+def lock_owner(shard_directory, shard_id):
+    # "host pid" of the process holding a shard, None when it isn't claimed
+    try:
+        with open(shard_path(shard_directory, "locks", shard_id, ".lock"), encoding="utf-8") as file:
+            owner = json.load(file)
+        return f"{owner['host']} {owner['pid']}"
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError):
+        # Claimed, but the owner hasn't finished writing the lock yet
+        return "unknown"
+
+def apply_shard(shard_directory, shard, workers=DEFAULT_WORKERS):
+    # Applies a claimed shard and writes its result, returns the BatchResult
+    start = time.perf_counter()
+    journal = shard_path(shard_directory, "journals", shard["id"], f".{socket.gethostname()}.{os.getpid()}.jsonl")
+    renamed = 0
+    failures = []
+    error = shard["error"]
+    if error is None and shard["renames"]:
+        try:
+            report = apply_plan_file(os.path.join(shard_directory, shard["plan"]), workers, journal_path=journal)
+            renamed = report.renamed
+            failures = [(failure.source, failure.target, failure.error.strerror or str(failure.error)) for failure in report.failures]
+        except Exception as exception:
+            error = str(exception)
+    else:
+        journal = None
+    result = BatchResult(shard["path"], shard["directories"], shard["files"], shard["renames"], renamed, failures,
+                         journal, shard["plan"], time.perf_counter() - start, error)
+    write_json(shard_path(shard_directory, "results", shard["id"], ".json"), result._asdict())
+    return result
+
+def work_shards(shard_directory, workers=DEFAULT_WORKERS, limit=None):
+    # Claims and applies shards until every shard is claimed, or limit of them were applied by
+    # this process. Returns the BatchResults of the shards this process applied
+    manifest = load_manifest(shard_directory)
+    results = []
+    for shard in manifest["shards"]:
+        if limit is not None and len(results) >= limit:
+            break
+        if os.path.exists(shard_path(shard_directory, "results", shard["id"], ".json")):
+            continue
+        if claim_shard(shard_directory, shard["id"]):
+            results.append(apply_shard(shard_directory, shard, workers))
+    return results
+
+def run_workers(shard_directory, processes=1, workers=DEFAULT_WORKERS):
+    # work_shards in several processes of this host, the shards they applied in claim order
+    load_manifest(shard_directory)
+    if processes <= 1:
+        return work_shards(shard_directory, workers)
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = [pool.submit(work_shards, shard_directory, workers) for process in range(processes)]
+        return [result for future in futures for result in future.result()]
+
+def merge_shards(shard_directory):
+    # The BatchResult of every shard in the order the library was planned. Shards without a result
+    # get an error saying whether they are still running, or were never claimed
+    manifest = load_manifest(shard_directory)
+    results = []
+    for shard in sorted(manifest["shards"], key=lambda shard: shard["id"]):
+        try:
+            with open(shard_path(shard_directory, "results", shard["id"], ".json"), encoding="utf-8") as file:
+                data = json.load(file)
+            result = BatchResult(**{field: data.get(field) for field in BatchResult._fields})
+            results.append(result._replace(failures=[tuple(failure) for failure in result.failures or ()]))
+            continue
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError):
+            raise ShardError(f"{shard_path(shard_directory, 'results', shard['id'], '.json')}: not a shard result")
+        owner = lock_owner(shard_directory, shard["id"])
+        error = "not claimed yet" if owner is None else f"claimed by {owner}, not finished"
+        results.append(BatchResult(shard["path"], shard["directories"], shard["files"], shard["renames"], 0, [],
+                                   None, shard["plan"], 0.0, error))
+    return results
@@ -0,0 +1,91 @@
+import unittest
+import io
+import json
+import os
+import shutil
+import tempfile
+from unittest.mock import patch
+from cleanerengine import CleanerOptions, scan_directory, build_plan
+from cleanershard import ShardError, create_shards, claim_shard, work_shards, run_workers, merge_shards, load_manifest
+from cleanercli import main
+
+class TestShards(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.environ = patch.dict(os.environ, {"CANDLECLEANER_HOME": os.path.join(self.directory, "home")})
+        self.environ.start()
+        self.library = os.path.join(self.directory, 'Library')
+        self.shards = os.path.join(self.directory, 'shards')
+        for path in ('PackA_Kick_01.wav', 'PackA_Kick_02.wav', 'Snares/PackA_Snare_01.wav', 'Snares/PackA_Snare_02.wav',
+                     'Loops/PackB_Loop_01.wav', 'Loops/PackB_Loop_02.wav', 'Loops/Long/PackB_Long_01.wav', 'Loops/Long/PackB_Long_02.wav'):
+            full_path = os.path.join(self.library, path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            open(full_path, 'w').close()
+
+    def tearDown(self):
+        self.environ.stop()
+        shutil.rmtree(self.directory)
+
+    def files(self):
+        return sorted(os.path.relpath(os.path.join(dirpath, name), self.library)
+                      for dirpath, dirnames, filenames in os.walk(self.library) for name in filenames)
+
+    def test_claim_apply_and_merge(self):
+        options = CleanerOptions(smart_update=True)
+        expected = sorted(os.path.relpath(dst, self.library) for src, dst in build_plan(scan_directory(self.library), options).renames())
+        create_shards([self.library], options, self.shards, processes=2)
+        shards = load_manifest(self.shards)["shards"]
+        self.assertEqual(len(shards), 3)
+        self.assertEqual([shard["renames"] for shard in shards], [4, 2, 2])
+
+        # One shard held by a worker that hasn't finished, one applied here, one left
+        self.assertTrue(claim_shard(self.shards, shards[2]["id"]))
+        self.assertFalse(claim_shard(self.shards, shards[2]["id"]))
+        applied = work_shards(self.shards, limit=1)
+        self.assertEqual([result.renamed for result in applied], [4])
+        self.assertTrue(os.path.exists(applied[0].journal))
+        merged = merge_shards(self.shards)
+        self.assertEqual(sorted(result.error or "" for result in merged), ["", "claimed by " + self.owner(shards[2]["id"]) + ", not finished", "not claimed yet"])
+
+        self.assertEqual([result.renamed for result in run_workers(self.shards, processes=2)], [2])
+        os.remove(os.path.join(self.shards, "locks", shards[2]["id"] + ".lock"))
+        run_workers(self.shards)
+        merged = merge_shards(self.shards)
+        self.assertEqual([result.error for result in merged], [None] * 3)
+        self.assertEqual(sum(result.renamed for result in merged), 8)
+        self.assertEqual(self.files(), expected)
+
+    def test_relative_roots_are_applied_from_anywhere(self):
+        cwd = os.getcwd()
+        try:
+            os.chdir(self.directory)
+            self.assertEqual(main(['shard', 'Library', '--smart', '--output', 'shards'], io.StringIO()), 0)
+            os.chdir(os.path.join(self.library, 'Loops'))
+            self.assertEqual(main(['shard-work', self.shards], io.StringIO()), 0)
+        finally:
+            os.chdir(cwd)
+        self.assertEqual(self.files(), ['01.wav', '02.wav', 'Loops/01.wav', 'Loops/02.wav', 'Loops/Long/01.wav',
+                                        'Loops/Long/02.wav', 'Snares/01.wav', 'Snares/02.wav'])
+        self.assertEqual([result.error for result in merge_shards(self.shards)], [None] * 3)
+
+    def owner(self, shard_id):
+        with open(os.path.join(self.shards, "locks", shard_id + ".lock")) as file:
+            owner = json.load(file)
+        return f"{owner['host']} {owner['pid']}"
+
+    def test_cli(self):
+        report_path = os.path.join(self.directory, 'report.json')
+        self.assertEqual(main(['shard', self.library, '--smart', '--output', self.shards], io.StringIO()), 0)
+        self.assertEqual(main(['shard-merge', self.shards], io.StringIO()), 1)
+        self.assertEqual(main(['shard-work', self.shards, '--processes', '2'], io.StringIO()), 0)
+        self.assertEqual(main(['shard-merge', self.shards, '--report', report_path], io.StringIO()), 0)
+        with open(report_path) as f:
+            report = json.load(f)
+        self.assertEqual((report['totals']['renamed'], report['totals']['failures'], report['totals']['errors']), (8, 0, 0))
+        self.assertEqual(self.files(), ['01.wav', '02.wav', 'Loops/01.wav', 'Loops/02.wav', 'Loops/Long/01.wav',
+                                        'Loops/Long/02.wav', 'Snares/01.wav', 'Snares/02.wav'])
+        with self.assertRaises(ShardError):
+            load_manifest(self.library)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+###################################################################################################
+# cleanerstats.py
+#
+# Timing and counters for one operation (a scan, a preview, a rename), so a slow run can be broken
+# down into the time spent listing folders, generating regexes, filling the trees and renaming.
+# The window shows them under Help > Timings and the command line writes them as JSON with
+# --stats. A single operation can also be run under cProfile to send along with a report.
+#
+###################################################################################################
+
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+from cleanerengine import data_directory
+
+class Stats:
+    # Wall time per phase and named counters, safe to update from worker threads
+    def __init__(self, operation):
+        self.operation = operation
+        self.phases = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def as_dict(self):
+        with self.lock:
+            return {"operation": self.operation, "phases": dict(self.phases), "counters": dict(self.counters)}
+
+    def summary(self):
+        data = self.as_dict()
+        lines = [self.operation.capitalize() + ":"]
+        lines.extend(f"  {name}: {seconds:.3f}s" for name, seconds in data["phases"].items())
+        lines.extend(f"  {name}: {value}" for name, value in data["counters"].items())
+        return "\n".join(lines)
+
+def count_scan(stats, snapshot, cache=None):
+    # The syscalls of a scan, counted from its results rather than by wrapping os: the root is
+    # stat'ed once, every listed folder is one scandir and every file in it one stat, and with a
+    # cache every folder is stat'ed once more to check its mtime
+    stats.count("directories", len(snapshot.directories))
+    stats.count("files", len(snapshot))
+    if cache is None:
+        stats.count("scandir_calls", len(snapshot.directories))
+        stats.count("stat_calls", 1 + len(snapshot))
+    else:
+        stats.count("scandir_calls", cache.misses)
+        stats.count("stat_calls", 1 + cache.hits + cache.misses + cache.listed_files)
+        stats.count("cache_hits", cache.hits)
+
+def write_stats(stats_list, destination):
+    # destination is a file name, or - for stderr
+    output = json.dumps([stats.as_dict() for stats in stats_list], indent=2)
+    if destination == "-":
+        sys.stderr.write(output + "\n")
+    else:
+        with open(destination, "w", encoding="utf-8") as file:
+            file.write(output + "\n")
+
+def profile_path(operation):
+    return os.path.join(data_directory("profiles"), operation + "-" + time.strftime("%Y%m%d-%H%M%S") + ".prof")
+
+@contextlib.contextmanager
+def profiled(path):
+    # Profiles the calling thread into path, readable with pstats or snakeviz, does nothing without
+    # a path. Threads started inside aren't profiled
+    if not path:
+        yield
+        return
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
@@ -0,0 +1,70 @@
+import unittest
+import io
+import json
+import os
+import pstats
+import shutil
+import tempfile
+from unittest.mock import patch
+from cleanerengine import scan_directory
+from cleanercache import ScanCache
+from cleanerstats import Stats, count_scan, profiled
+from cleanercli import main
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.home = tempfile.mkdtemp()
+        self.environ = patch.dict(os.environ, {"CANDLECLEANER_HOME": self.home})
+        self.environ.start()
+        for path in ('test_file1.txt', 'test_file2.txt', 'subdir1/test_file3.txt'):
+            os.makedirs(os.path.dirname(os.path.join(self.directory, path)), exist_ok=True)
+            open(os.path.join(self.directory, path), 'w').close()
+
+    def tearDown(self):
+        self.environ.stop()
+        shutil.rmtree(self.directory)
+        shutil.rmtree(self.home)
+
+    def test_phases_and_counters(self):
+        stats = Stats('scan')
+        with stats.phase('walk'):
+            pass
+        with stats.phase('walk'):
+            stats.count('files', 2)
+        stats.count('files')
+        data = stats.as_dict()
+        self.assertEqual(list(data['phases']), ['walk'])
+        self.assertEqual(data['counters'], {'files': 3})
+        self.assertIn('  files: 3', stats.summary())
+
+    def test_count_scan(self):
+        stats = Stats('scan')
+        count_scan(stats, scan_directory(self.directory))
+        self.assertEqual(stats.counters, {'directories': 2, 'files': 3, 'scandir_calls': 2, 'stat_calls': 4})
+        cache = ScanCache(self.directory)
+        stats = Stats('scan')
+        count_scan(stats, scan_directory(self.directory, cache=cache), cache)
+        self.assertEqual(stats.counters['stat_calls'], 6)
+
+    def test_profiled(self):
+        path = os.path.join(self.home, 'scan.prof')
+        with profiled(path):
+            scan_directory(self.directory)
+        self.assertTrue(any('scan_directory' in function[2] for function in pstats.Stats(path).stats))
+        with profiled(None):
+            pass
+
+    def test_cli_stats(self):
+        stats_path = os.path.join(self.home, 'stats.json')
+        profile = os.path.join(self.home, 'plan.prof')
+        self.assertEqual(main(['plan', self.directory, '--smart', '--stats', stats_path, '--profile', profile], io.StringIO()), 0)
+        with open(stats_path) as f:
+            stats, = json.load(f)
+        self.assertEqual(stats['operation'], 'plan')
+        self.assertEqual(list(stats['phases']), ['scan', 'regex', 'plan', 'print'])
+        self.assertEqual(stats['counters']['files'], 3)
+        self.assertTrue(os.path.exists(profile))
+
+if __name__ == '__main__':
+    unittest.main()
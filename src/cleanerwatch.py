@@ -0,0 +1,165 @@
+###################################################################################################
+# cleanerwatch.py
+#
+# Watches the directories of a scanned library for files being created, deleted or moved, so the
+# preview can relist just the directories that changed instead of rescanning the whole tree. Uses
+# inotify on Linux through ctypes, and falls back to polling directory mtimes elsewhere or for the
+# directories inotify can't watch, for example once the per-user watch limit is reached.
+#
+###################################################################################################
+
+import ctypes
+import ctypes.util
+import os
+import queue
+import select
+import struct
+import sys
+import threading
+
+# Seconds between two checks of the polled directories, also how long the inotify read waits
+POLL_INTERVAL = 2.0
+
+# inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# Creating, deleting and moving entries, and files being written, which changes their size
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+EVENT_HEADER = struct.Struct("iIII")
+
+def load_inotify():
+    # The libc functions, or None when inotify isn't available
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        for name, argtypes in (("inotify_init1", [ctypes.c_int]),
+                               ("inotify_add_watch", [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]),
+                               ("inotify_rm_watch", [ctypes.c_int, ctypes.c_int])):
+            getattr(libc, name).argtypes = argtypes
+            getattr(libc, name).restype = ctypes.c_int
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+def directory_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+class DirectoryWatcher(threading.Thread):
+    # Puts a set of changed directory paths on the changes queue whenever something changed. watch
+    # and unwatch can be called from any thread while the watcher runs
+    def __init__(self, paths=(), use_inotify=True, interval=POLL_INTERVAL):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.changes = queue.Queue()
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.libc = load_inotify() if use_inotify else None
+        self.fd = -1
+        if self.libc is not None:
+            self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        # inotify watch descriptors by path and paths by descriptor, and polled paths with their mtime
+        self.watch_ids = {}
+        self.watch_paths = {}
+        self.polled = {}
+        self.watch(paths)
+
+    @property
+    def backend(self):
+        return "inotify" if self.fd >= 0 else "polling"
+
+    def watch(self, paths):
+        with self.lock:
+            for path in paths:
+                if path in self.watch_ids or path in self.polled:
+                    continue
+                if self.fd >= 0:
+                    wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+                    if wd >= 0:
+                        self.watch_ids[path] = wd
+                        self.watch_paths[wd] = path
+                        continue
+                self.polled[path] = directory_mtime(path)
+
+    def unwatch(self, paths):
+        with self.lock:
+            for path in paths:
+                self.polled.pop(path, None)
+                wd = self.watch_ids.pop(path, None)
+                if wd is not None:
+                    self.watch_paths.pop(wd, None)
+                    # Fails harmlessly when the kernel already dropped the watch of a deleted folder
+                    self.libc.inotify_rm_watch(self.fd, wd)
+
+    def stop(self):
+        self.stopped.set()
+
+    def read_events(self):
+        changed = set()
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        with self.lock:
+            while offset + EVENT_HEADER.size <= len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:
+                    # Events were lost, so everything watched is relisted
+                    changed.update(self.watch_ids)
+                    continue
+                path = self.watch_paths.get(wd)
+                if path is None:
+                    continue
+                changed.add(path)
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    # The parent relists too, so the folder is dropped or found under its new name
+                    changed.add(os.path.dirname(path))
+                if mask & IN_IGNORED:
+                    del self.watch_paths[wd]
+                    if self.watch_ids.get(path) == wd:
+                        del self.watch_ids[path]
+        return changed
+
+    def poll(self):
+        changed = set()
+        with self.lock:
+            for path, mtime in list(self.polled.items()):
+                new_mtime = directory_mtime(path)
+                if new_mtime != mtime:
+                    self.polled[path] = new_mtime
+                    changed.add(path)
+        return changed
+
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                changed = set()
+                if self.fd >= 0:
+                    readable, writable, errors = select.select([self.fd], [], [], self.interval)
+                    if readable:
+                        changed.update(self.read_events())
+                else:
+                    self.stopped.wait(self.interval)
+                changed.update(self.poll())
+                if changed and not self.stopped.is_set():
+                    self.changes.put(changed)
+        finally:
+            if self.fd >= 0:
+                os.close(self.fd)
@@ -0,0 +1,57 @@
+import unittest
+import os
+import queue
+import shutil
+import tempfile
+from cleanerwatch import DirectoryWatcher
+
+class TestDirectoryWatcher(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.subdirectory = os.path.join(self.directory, 'drums')
+        os.mkdir(self.subdirectory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def watch(self, use_inotify):
+        watcher = DirectoryWatcher([self.directory, self.subdirectory], use_inotify=use_inotify, interval=0.05)
+        watcher.start()
+        self.addCleanup(watcher.join)
+        self.addCleanup(watcher.stop)
+        return watcher
+
+    # Collects changes until the expected directories showed up or nothing more arrives
+    def wait_for_changes(self, watcher, expected):
+        changed = set()
+        while not expected <= changed:
+            try:
+                changed.update(watcher.changes.get(timeout=2))
+            except queue.Empty:
+                break
+        return changed
+
+    def check_watcher(self, watcher):
+        open(os.path.join(self.subdirectory, 'kick.wav'), 'w').close()
+        self.assertEqual(self.wait_for_changes(watcher, {self.subdirectory}), {self.subdirectory})
+        os.rename(os.path.join(self.subdirectory, 'kick.wav'), os.path.join(self.directory, 'kick.wav'))
+        self.assertEqual(self.wait_for_changes(watcher, {self.directory, self.subdirectory}), {self.directory, self.subdirectory})
+
+    def test_polling(self):
+        watcher = self.watch(False)
+        self.assertEqual(watcher.backend, 'polling')
+        self.check_watcher(watcher)
+
+    def test_inotify(self):
+        watcher = self.watch(True)
+        if watcher.backend != 'inotify':
+            self.skipTest('inotify is not available')
+        self.check_watcher(watcher)
+        # Unwatched directories are no longer reported
+        watcher.unwatch([self.subdirectory])
+        open(os.path.join(self.subdirectory, 'snare.wav'), 'w').close()
+        open(os.path.join(self.directory, 'snare.wav'), 'w').close()
+        self.assertEqual(self.wait_for_changes(watcher, {self.directory}), {self.directory})
+
+if __name__ == '__main__':
+    unittest.main()